@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+Measure how much memory Server uses for each idle keep-alive connection.
+
+> python conn_memory.py [conns]
+
+Starts a Server in its own process, opens conns (default 5000) connections
+to it, makes one request on each and leaves them open, then reports the
+growth in the server's resident set size, divided by the number of
+connections. Kernel socket buffers aren't counted, since they aren't part
+of the process' RSS.
+
+The result is compared with target_bytes; it exits with status 1 if it's
+over, so that growth in per-connection state is noticed. Raise the number
+of open files allowed (ulimit -n) to measure larger numbers.
+
+To serve on its own:
+
+> python conn_memory.py serve port
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import socket
+import sys
+import time
+
+from run import _Process
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+target_bytes = 3072 # per idle connection
+request = "GET / HTTP/1.1\r\nHost: localhost\r\n\r\n"
+small_body = "x" * 100
+
+
+def handler(method, uri, req_hdrs, res_start, req_pause):
+    res_body, res_done = res_start("200", "OK", [
+        ("Content-Type", "text/plain"),
+        ("Content-Length", str(len(small_body))),
+    ], dummy)
+    res_body(small_body)
+    res_done(None)
+    return dummy, dummy
+
+def serve(port):
+    Server('127.0.0.1', port, handler).idle_timeout = None
+    push_tcp.run()
+
+def connect(port, num):
+    "Open num connections, making a request on each; return them."
+    socks = []
+    for i in range(num):
+        s = socket.socket()
+        s.connect(('127.0.0.1', port))
+        s.sendall(request)
+        socks.append(s)
+    for s in socks:
+        response = ""
+        while not response.endswith(small_body):
+            data = s.recv(4096)
+            if not data:
+                raise RuntimeError, "connection closed"
+            response += data
+    return socks
+
+def settle(proc):
+    "Return proc's RSS in KB once it's stopped changing."
+    last = proc.rss_kb()
+    while True:
+        time.sleep(0.5)
+        rss = proc.rss_kb()
+        if rss == last:
+            return rss
+        last = rss
+
+def main():
+    conns = int((sys.argv[1:2] or [5000])[0])
+    port = 18700
+    proc = _Process('server', [os.path.abspath(__file__), "serve",
+                               str(port)], port, cwd=bench_dir)
+    try:
+        connect(port, 100) # warm up; allocate the first few of everything.
+        before = settle(proc)
+        socks = connect(port, conns)
+        after = settle(proc)
+        per_conn = (after - before) * 1024 / conns
+        print "%s idle connections: rss %s -> %s KB, %s bytes each " \
+              "(target %s)" % (conns, before, after, per_conn, target_bytes)
+        for s in socks:
+            s.close()
+    finally:
+        proc.stop()
+    if per_conn > target_bytes:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["serve"]:
+        try: # run from dist without installation
+            sys.path.insert(0, os.path.join(bench_dir, ".."))
+            from src import Server, dummy, push_tcp
+        except ImportError:
+            from nbhttp import Server, dummy, push_tcp
+        serve(int(sys.argv[2]))
+    else:
+        main()
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+"""
+A multi-connection HTTP load generator, built on push_tcp.
+
+It speaks just enough HTTP/1.1 to keep connections alive and find the end
+of responses (Content-Length, chunked or close-delimited), so that what's
+being measured is the server, not nbhttp's own client.
+
+> gen = LoadGen('127.0.0.1', 8080, '/small', conns=50, duration=10)
+> gen.start(push_tcp.stop)
+> push_tcp.run()
+> print gen.results()
+
+Each connection sends a request, waits for the response and sends the
+next; with pipeline > 1, it keeps that many requests outstanding. If
+read_rate is set, each connection reads no more than that many bytes a
+second, to act as a slow client.
+
+To send requests through a proxy, set proxy to the (host, port) of the
+origin; request-targets will be absolute URIs for it.
+
+Run directly for a quick test:
+
+> python loadgen.py host port path [conns] [duration]
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import sys
+import time
+try: # run from dist without installation
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+    from src import push_tcp
+    from src.http_common import dummy
+except ImportError:
+    from nbhttp import push_tcp
+    from nbhttp.http_common import dummy
+
+# response parsing states
+HEADERS, COUNTED, CHUNK_SIZE, TRAILERS, CLOSE = range(5)
+
+
+def percentile(values, pct):
+    "Return the pct percentile of a sorted list of values, or None."
+    if not values:
+        return None
+    idx = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[idx]
+
+def latency_summary(latencies):
+    "Summarise a list of latencies (in seconds) in milliseconds."
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        'p50': ms(percentile(latencies, 50)),
+        'p99': ms(percentile(latencies, 99)),
+        'p999': ms(percentile(latencies, 99.9)),
+        'max': ms(latencies[-1]),
+        'mean': ms(sum(latencies) / len(latencies)),
+    }
+
+
+class LoadGen:
+    "Generate load against one URI from a number of connections."
+    connect_timeout = 10
+    grace = 30 # seconds to wait for outstanding responses after duration.
+
+    def __init__(self, host, port, path, conns=10, duration=5, pipeline=1,
+                 read_rate=None, proxy=None, label=None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.conns = conns
+        self.duration = duration
+        self.pipeline = pipeline
+        self.read_rate = read_rate
+        self.label = label or path
+        if proxy:
+            authority = "%s:%s" % proxy
+            target = "http://%s%s" % (authority, path)
+        else:
+            authority = "%s:%s" % (host, port)
+            target = path
+        self.request = "GET %s HTTP/1.1\r\nHost: %s\r\n\r\n" % (
+            target, authority)
+        self.running = False
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.connects = 0
+        self.bytes_in = 0
+        self._conns = []
+        self._done_cb = None
+        self._start = None
+        self._end = None
+        self._expire_ev = None
+
+    def start(self, done_cb=dummy):
+        "Start generating load; call done_cb when finished."
+        self._done_cb = done_cb
+        self.running = True
+        self._start = time.time()
+        self._conns = [_BenchConn(self) for i in range(self.conns)]
+        self._expire_ev = push_tcp.schedule(self.duration, self._expire)
+
+    def results(self):
+        "Return a dictionary of results."
+        elapsed = (self._end or time.time()) - self._start
+        return {
+            'label': self.label,
+            'conns': self.conns,
+            'pipeline': self.pipeline,
+            'read_rate': self.read_rate,
+            'requests': len(self.latencies),
+            'errors': self.errors,
+            'connects': self.connects,
+            'elapsed': round(elapsed, 3),
+            'req_per_sec': round(len(self.latencies) / elapsed, 1),
+            'bytes_in': self.bytes_in,
+            'mbytes_per_sec': round(self.bytes_in / elapsed / 1e6, 3),
+            'latency_ms': latency_summary(self.latencies),
+            'statuses': self.statuses,
+        }
+
+    def _expire(self):
+        "Stop sending requests, and wait for the outstanding ones."
+        self.running = False
+        self._end = time.time()
+        for conn in self._conns[:]:
+            if not conn.sent:
+                conn.finish()
+        if self._conns:
+            self._expire_ev = push_tcp.schedule(self.grace, self._abandon)
+
+    def _abandon(self):
+        "Give up on responses that haven't arrived."
+        self._expire_ev = None
+        for conn in self._conns[:]:
+            self.errors += len(conn.sent)
+            conn.sent = []
+            conn.finish()
+
+    def _conn_finished(self, conn):
+        self._conns.remove(conn)
+        if not self._conns and not self.running:
+            if self._expire_ev:
+                self._expire_ev.delete()
+                self._expire_ev = None
+            done_cb, self._done_cb = self._done_cb, None
+            if done_cb:
+                done_cb()
+
+
+class _BenchConn:
+    "A load generating connection."
+    def __init__(self, gen):
+        self.gen = gen
+        self.tcp_conn = None
+        self.sent = []      # start times of outstanding requests
+        self.finished = False
+        self._buf = ""
+        self._state = HEADERS
+        self._left = 0
+        self._status = None
+        self._close = False
+        self._budget = gen.read_rate
+        self._connect()
+
+    def _connect(self):
+        self.gen.connects += 1
+        push_tcp.create_client(self.gen.host, self.gen.port,
+            self._connected, self._connect_error, self.gen.connect_timeout)
+
+    def _connected(self, tcp_conn):
+        self.tcp_conn = tcp_conn
+        self._fill()
+        return self._read, self._closed, dummy
+
+    def _connect_error(self, reason):
+        self.gen.errors += 1
+        if self.gen.running:
+            push_tcp.schedule(1, self._connect)
+        else:
+            self.finish()
+
+    def _fill(self):
+        "Send requests until pipeline are outstanding."
+        if self.finished or not self.tcp_conn:
+            return
+        while self.gen.running and len(self.sent) < self.gen.pipeline:
+            self.sent.append(time.time())
+            self.tcp_conn.write(self.gen.request)
+        if not self.sent:
+            self.finish()
+
+    def finish(self):
+        "Close the connection and stop."
+        if self.finished:
+            return
+        self.finished = True
+        if self.tcp_conn:
+            tcp_conn, self.tcp_conn = self.tcp_conn, None
+            tcp_conn.close()
+        self.gen._conn_finished(self)
+
+    def _read(self, data):
+        self.gen.bytes_in += len(data)
+        if self.gen.read_rate and self.tcp_conn:
+            # read up to read_rate bytes, then wait for the next second.
+            self._budget -= len(data)
+            if self._budget <= 0:
+                self.tcp_conn.pause(True)
+                push_tcp.schedule(1, self._resume)
+        if self._state == CLOSE:
+            return
+        if self._buf:
+            data = self._buf + data
+        self._buf = self._parse(data)
+
+    def _resume(self):
+        self._budget += self.gen.read_rate
+        if self.tcp_conn and not self.finished:
+            self.tcp_conn.pause(False)
+
+    def _parse(self, buf):
+        "Consume as much of buf as possible; return the rest."
+        while buf:
+            if self._left:
+                if self._left >= len(buf):
+                    self._left -= len(buf)
+                    buf = ""
+                else:
+                    buf = buf[self._left:]
+                    self._left = 0
+                if self._left == 0 and self._state == COUNTED:
+                    self._response_done()
+                continue
+            if self._state == HEADERS:
+                end = buf.find("\r\n\r\n")
+                if end < 0:
+                    break
+                self._start_response(buf[:end])
+                buf = buf[end + 4:]
+            elif self._state == CHUNK_SIZE:
+                end = buf.find("\r\n")
+                if end < 0:
+                    break
+                size = int(buf[:end].split(";", 1)[0] or "0", 16)
+                buf = buf[end + 2:]
+                if size == 0:
+                    self._state = TRAILERS
+                else:
+                    self._left = size + 2 # the chunk, and its CRLF
+            elif self._state == TRAILERS:
+                end = buf.find("\r\n")
+                if end < 0:
+                    break
+                line, buf = buf[:end], buf[end + 2:]
+                if line == "":
+                    self._response_done()
+            else:
+                break
+        return buf
+
+    def _start_response(self, head):
+        lines = head.split("\r\n")
+        self._status = lines[0][9:12]
+        self._close = lines[0][:8] == "HTTP/1.0"
+        length = None
+        chunked = False
+        for line in lines[1:]:
+            name, value = (line.split(":", 1) + [""])[:2]
+            name, value = name.strip().lower(), value.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "transfer-encoding":
+                chunked = "chunked" in value
+            elif name == "connection":
+                self._close = "close" in value or \
+                    (self._close and "keep-alive" not in value)
+        if chunked:
+            self._state = CHUNK_SIZE
+        elif length is not None:
+            self._state = COUNTED
+            self._left = length
+            if length == 0:
+                self._response_done()
+        else:
+            self._state = CLOSE
+
+    def _response_done(self):
+        gen = self.gen
+        self._state = HEADERS
+        if self.sent:
+            gen.latencies.append(time.time() - self.sent.pop(0))
+            gen.statuses[self._status] = gen.statuses.get(self._status, 0) + 1
+        if self._close:
+            self._reconnect()
+        else:
+            self._fill()
+
+    def _closed(self):
+        if self._state == CLOSE:
+            self._close = True
+            self._response_done()
+            return
+        self.gen.errors += len(self.sent)
+        self.sent = []
+        self._reconnect()
+
+    def _reconnect(self):
+        "Drop the connection, and make another if we're still running."
+        if self.tcp_conn:
+            tcp_conn, self.tcp_conn = self.tcp_conn, None
+            tcp_conn.close()
+        self.gen.errors += len(self.sent)
+        self.sent = []
+        self._buf = ""
+        self._state = HEADERS
+        self._left = 0
+        if self.gen.running:
+            self._connect()
+        else:
+            self.finish()
+
+
+if __name__ == "__main__":
+    host, port, path = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+    conns = int((sys.argv[4:5] or [10])[0])
+    duration = int((sys.argv[5:6] or [5])[0])
+    gen = LoadGen(host, port, path, conns, duration)
+    gen.start(push_tcp.stop)
+    push_tcp.run()
+    import pprint
+    pprint.pprint(gen.results())
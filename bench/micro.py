@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+"""
+Microbenchmarks for nbhttp's hot paths.
+
+> python micro.py
+
+  - parse_headers: HttpMessageHandler._parse_headers on a typical request
+  - chunked: the chunked body decoder, fed in read-sized pieces
+  - schedule: push_tcp.schedule() and delete() with many timers pending
+  - websocket: WebSocket messages parsed and unmasked, fed in read-sized
+    pieces (small and large messages)
+  - loopback: Client requests to a Server, one after another on the same
+    connection, over an in-memory Loopback instead of sockets (small and
+    large responses)
+
+Each is run several times, and the best run is reported.
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import sys
+import time
+try: # run from dist without installation
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+    from src import push_tcp, Client, Server
+    from src.http_common import HttpMessageHandler, dummy
+    from src.loopback import Loopback
+    from src.websocket import WebSocket, frame, unmask
+except ImportError:
+    from nbhttp import push_tcp, Client, Server
+    from nbhttp.http_common import HttpMessageHandler, dummy
+    from nbhttp.loopback import Loopback
+    from nbhttp.websocket import WebSocket, frame, unmask
+
+repeat = 5
+
+request_head = "\r\n".join([
+    "GET /some/path/to/a/resource?with=query&args=1 HTTP/1.1",
+    "Host: www.example.com",
+    "User-Agent: Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/3.6",
+    "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language: en-us,en;q=0.5",
+    "Accept-Encoding: gzip,deflate",
+    "Accept-Charset: ISO-8859-1,utf-8;q=0.7,*;q=0.7",
+    "Connection: keep-alive",
+    "Cookie: session=0123456789abcdef; prefs=compact",
+    "Cache-Control: max-age=0",
+    "", "",
+])
+
+
+class _Parser(HttpMessageHandler):
+    "An HttpMessageHandler that throws away what it parses."
+    def __init__(self, allows_body=False):
+        HttpMessageHandler.__init__(self)
+        self.allows_body = allows_body
+        self.body_len = 0
+        self.ended = False
+    def _input_start(self, *args):
+        return self.allows_body
+    def _input_body(self, chunk):
+        self.body_len += len(chunk)
+    def _input_end(self):
+        self.ended = True
+    def _input_error(self, err, detail=None):
+        raise Exception, "parse error: %s (%s)" % (err['desc'], detail)
+
+
+class _TcpConn:
+    "Enough of a push_tcp connection to give to a WebSocket."
+    def write(self, data):
+        pass
+    pause = close = write
+
+
+def _best(fn, n):
+    "Run fn(n) repeat times; return the best time per operation, in seconds."
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        fn(n)
+        times.append((time.time() - start) / n)
+    return min(times)
+
+def bench_parse_headers(n=20000):
+    p = _Parser()
+    def run(n):
+        for i in xrange(n):
+            p._parse_headers(request_head)
+    per_op = _best(run, n)
+    return {
+        'ops_per_sec': round(1 / per_op),
+        'usec_per_op': round(per_op * 1e6, 3),
+    }
+
+def bench_chunked(n=200, chunk_size=1024, chunks=64, read_size=16384):
+    head = "HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+    body = ("%x\r\n%s\r\n" % (chunk_size, "x" * chunk_size)) * chunks + \
+        "0\r\n\r\n"
+    pieces = [body[i:i + read_size] for i in range(0, len(body), read_size)]
+    def run(n):
+        for i in xrange(n):
+            p = _Parser(allows_body=True)
+            p._handle_input(head)
+            for piece in pieces:
+                p._handle_input(piece)
+            assert p.ended and p.body_len == chunk_size * chunks
+    per_op = _best(run, n)
+    return {
+        'mbytes_per_sec': round(len(body) / per_op / 1e6, 3),
+        'usec_per_msg': round(per_op * 1e6, 3),
+    }
+
+def bench_schedule(n=20000, pending=10000):
+    pending_evs = [push_tcp.schedule(3600 + i, dummy)
+                   for i in range(pending)]
+    def run(n):
+        for i in xrange(n):
+            push_tcp.schedule(1800 + i % pending, dummy).delete()
+    try:
+        per_op = _best(run, n)
+    finally:
+        for ev in pending_evs:
+            ev.delete()
+    return {
+        'pending': pending,
+        'ops_per_sec': round(1 / per_op),
+        'usec_per_op': round(per_op * 1e6, 3),
+    }
+
+def bench_websocket(n=20, msgs=1000, size=100, read_size=16384):
+    mask = "\x12\x34\x56\x78"
+    head = frame(0x2, "m" * size)[:-size]
+    stream = (head[0] + chr(ord(head[1]) | 0x80) + head[2:] + mask +
+              unmask("m" * size, mask)) * msgs
+    pieces = [stream[i:i + read_size]
+              for i in range(0, len(stream), read_size)]
+    received = []
+    def run(n):
+        for i in xrange(n):
+            del received[:]
+            ws = WebSocket(_TcpConn(), lambda d, b: received.append(d),
+                           dummy, dummy)
+            for piece in pieces:
+                ws.handle_input(piece)
+            assert len(received) == msgs and received[-1] == "m" * size
+    per_op = _best(run, n)
+    return {
+        'msgs_per_sec': round(msgs / per_op),
+        'mbytes_per_sec': round(len(stream) / per_op / 1e6, 3),
+    }
+
+def bench_websocket_large(n=20, msgs=16, size=1024 * 256):
+    return bench_websocket(n, msgs, size)
+
+def bench_loopback(n=2000, size=100):
+    "Client and Server, one request after another over a Loopback."
+    body = "x" * size
+    def handler(method, uri, req_hdrs, res_start, req_pause):
+        res_body, res_done = res_start("200", "OK", [
+            ("Content-Length", str(size)),
+        ], dummy)
+        res_body(body)
+        res_done(None)
+        return dummy, dummy
+    received = [0]
+    def res_start(version, status, phrase, res_hdrs, res_pause):
+        def res_body(chunk):
+            received[0] += len(chunk)
+        return res_body, fetch
+    def fetch(err=None):
+        if left[0]:
+            left[0] -= 1
+            c = Client(res_start)
+            req_body, req_done = c.req_start("GET", "http://loopback/", [],
+                                             dummy)
+            req_done(None)
+    left = [0]
+    def run(n):
+        net = Loopback().install()
+        try:
+            Server("loopback", 80, handler)
+            received[0], left[0] = 0, n
+            fetch()
+            net.run()
+        finally:
+            net.uninstall()
+        assert received[0] == n * size
+    per_op = _best(run, n)
+    return {
+        'req_per_sec': round(1 / per_op),
+        'mbytes_per_sec': round(size / per_op / 1e6, 3),
+    }
+
+def bench_loopback_large(n=20, size=1024 * 1024):
+    return bench_loopback(n, size)
+
+benchmarks = [
+    ('parse_headers', bench_parse_headers),
+    ('chunked', bench_chunked),
+    ('schedule', bench_schedule),
+    ('websocket', bench_websocket),
+    ('websocket_large', bench_websocket_large),
+    ('loopback', bench_loopback),
+    ('loopback_large', bench_loopback_large),
+]
+
+def run_all(names=None):
+    "Run the named benchmarks (default all); return a dict of results."
+    results = {}
+    for name, fn in benchmarks:
+        if names and name not in names:
+            continue
+        results[name] = fn()
+    return results
+
+
+if __name__ == "__main__":
+    import pprint
+    pprint.pprint(run_all(sys.argv[1:]))
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+"""
+An origin server for benchmarking.
+
+> python origin.py port
+
+Serves:
+  - /small             a 100 byte response
+  - /large?n           an n byte response (default 1MB), sent in pieces
+  - /chunked?count&size  a chunked response of count chunks, each size bytes
+
+Anything else gets a 404. Request bodies are read and discarded.
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import sys
+try: # run from dist without installation
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+    from src import Server, run, dummy
+except ImportError:
+    from nbhttp import Server, run, dummy
+
+piece_size = 1024 * 64
+small_body = "x" * 100
+
+
+class _Sender:
+    "Send a body made of count pieces of size bytes, observing pause."
+    def __init__(self, res_start, res_hdrs, count, size, last_size):
+        self.count = count
+        self.piece = "x" * size
+        self.last = "x" * last_size
+        self.paused = False
+        self.res_body, self.res_done = res_start("200", "OK", res_hdrs,
+                                                 self.pause)
+        self.send()
+
+    def pause(self, paused):
+        self.paused = paused
+        if not paused:
+            self.send()
+
+    def send(self):
+        while self.count > 0 and not self.paused:
+            self.count -= 1
+            if self.count == 0:
+                self.res_body(self.last)
+            else:
+                self.res_body(self.piece)
+        if self.count == 0 and self.res_done:
+            res_done, self.res_done = self.res_done, None
+            res_done(None)
+
+
+def _args(query, defaults):
+    "Parse positional integer query arguments."
+    args = [a for a in query.split("&") if a]
+    try:
+        return [int(a) for a in args] + defaults[len(args):]
+    except ValueError:
+        return defaults
+
+def origin_handler(method, uri, req_hdrs, res_start, req_pause):
+    path, query = (uri.split("?", 1) + [""])[:2]
+    if path == "/small":
+        res_body, res_done = res_start("200", "OK", [
+            ("Content-Type", "text/plain"),
+            ("Content-Length", str(len(small_body))),
+        ], dummy)
+        res_body(small_body)
+        res_done(None)
+    elif path == "/large":
+        n = _args(query, [1024 * 1024])[0]
+        count, rest = divmod(n, piece_size)
+        if rest:
+            count += 1
+        _Sender(res_start, [
+            ("Content-Type", "application/octet-stream"),
+            ("Content-Length", str(n)),
+        ], max(count, 1), piece_size, rest or min(n, piece_size))
+    elif path == "/chunked":
+        count, size = _args(query, [64, 1024])
+        _Sender(res_start, [
+            ("Content-Type", "application/octet-stream"),
+        ], max(count, 1), size, size)
+    else:
+        res_body, res_done = res_start("404", "Not Found", [
+            ("Content-Type", "text/plain"),
+            ("Content-Length", "9"),
+        ], dummy)
+        res_body("Not Found")
+        res_done(None)
+    return dummy, dummy
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1])
+    server = Server('127.0.0.1', port, origin_handler)
+    run()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+"""
+Run the nbhttp benchmark suite.
+
+> python run.py [options]
+
+Starts the origin server (origin.py) and the demonstration proxy
+(scripts/proxy.py, with request collapsing turned off, so that every
+request reaches the origin) in their own processes, then runs each scenario
+against each target from this process:
+
+  - small_keepalive: small responses on persistent connections
+  - large_body: 1MB responses
+  - chunked_stream: chunked responses of many small chunks
+  - slow_clients: fast clients of small responses alongside clients
+    reading large responses slowly
+  - pipelining: eight requests outstanding on each connection; Server
+    doesn't support pipelining yet, so this only runs when it's named
+    with --scenario
+
+For each, it reports requests/second, latency percentiles, errors, and the
+CPU time and RSS of the server processes. Results can be saved as JSON
+(--out) and compared with an earlier run (--compare).
+
+Options:
+  --duration N       seconds to run each scenario (default 5)
+  --target NAME      server or proxy (default both)
+  --scenario NAME    run only this scenario (may be repeated)
+  --micro            also run the microbenchmarks (micro.py)
+  --out FILE         save results as JSON
+  --compare FILE     compare with results saved earlier
+  --port N           first port to use (default 18500)
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import micro
+from loadgen import LoadGen, push_tcp
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+scripts_dir = os.path.join(bench_dir, "..", "scripts")
+
+# name -> list of LoadGen arguments, run concurrently.
+scenarios = [
+    ('small_keepalive', [
+        dict(path='/small', conns=50),
+    ]),
+    ('large_body', [
+        dict(path='/large?1048576', conns=8),
+    ]),
+    ('chunked_stream', [
+        dict(path='/chunked?64&1024', conns=20),
+    ]),
+    ('slow_clients', [
+        dict(path='/large?262144', conns=20, read_rate=65536, label='slow'),
+        dict(path='/small', conns=10, label='fast'),
+    ]),
+    ('pipelining', [
+        dict(path='/small', conns=10, pipeline=8),
+    ]),
+]
+# scenarios that only run when named
+optional_scenarios = ['pipelining']
+
+
+class _Process:
+    "A benchmark target running in its own process."
+    def __init__(self, name, args, port, cwd=None):
+        self.name = name
+        self.port = port
+        self.proc = subprocess.Popen([sys.executable] + args, cwd=cwd)
+        self._wait_for_port()
+
+    def _wait_for_port(self, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            s = socket.socket()
+            try:
+                try:
+                    s.connect(('127.0.0.1', self.port))
+                    return
+                except socket.error:
+                    time.sleep(0.1)
+            finally:
+                s.close()
+        raise RuntimeError, "%s didn't start listening on %s" % (
+            self.name, self.port)
+
+    def cpu_time(self):
+        "Return user + system CPU seconds used so far, or None."
+        try:
+            fields = open("/proc/%s/stat" % self.proc.pid).read().split()
+            return (int(fields[13]) + int(fields[14])) / \
+                float(os.sysconf('SC_CLK_TCK'))
+        except (IOError, OSError, IndexError, ValueError):
+            return None
+
+    def rss_kb(self):
+        "Return the resident set size in kilobytes, or None."
+        try:
+            for line in open("/proc/%s/status" % self.proc.pid):
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            pass
+        return None
+
+    def stop(self):
+        try:
+            self.proc.terminate()
+        except OSError:
+            pass
+        self.proc.wait()
+
+
+def run_scenario(name, gen_args, target, procs, origin_port, duration):
+    "Run one scenario against one target; return its results."
+    if target == 'proxy':
+        host, port, proxy = '127.0.0.1', procs['proxy'].port, \
+            ('127.0.0.1', origin_port)
+    else:
+        host, port, proxy = '127.0.0.1', origin_port, None
+    gens = [LoadGen(host, port, duration=duration, proxy=proxy, **args)
+            for args in gen_args]
+    cpu_before = dict([(n, p.cpu_time()) for (n, p) in procs.items()])
+    own_before = os.times()
+    start = time.time()
+    running = [len(gens)]
+    def gen_done():
+        running[0] -= 1
+        if running[0] == 0:
+            push_tcp.stop()
+    for gen in gens:
+        gen.start(gen_done)
+    push_tcp.run()
+    elapsed = time.time() - start
+    own_after = os.times()
+    result = {
+        'loads': [gen.results() for gen in gens],
+        'elapsed': round(elapsed, 3),
+        'loadgen_cpu': round((own_after[0] + own_after[1]) - \
+                             (own_before[0] + own_before[1]), 3),
+        'processes': {},
+    }
+    for n, p in procs.items():
+        cpu = p.cpu_time()
+        if cpu is not None and cpu_before[n] is not None:
+            cpu = round(cpu - cpu_before[n], 3)
+        cpu_pct = None
+        if cpu is not None and elapsed:
+            cpu_pct = round(100 * cpu / elapsed, 1)
+        result['processes'][n] = {
+            'cpu': cpu,
+            'cpu_pct': cpu_pct,
+            'rss_kb': p.rss_kb(),
+        }
+    return result
+
+def report(name, target, result):
+    print "%s / %s" % (target, name)
+    for load in result['loads']:
+        lat = load['latency_ms']
+        print "  %-16s %9s req/s  p50 %s  p99 %s  p999 %s ms  %s errors" % (
+            load['label'], load['req_per_sec'], lat.get('p50'),
+            lat.get('p99'), lat.get('p999'), load['errors'])
+    for n, p in result['processes'].items():
+        if p['cpu'] is None:
+            cpu = "unknown"
+        else:
+            cpu = "%ss (%s%%)" % (p['cpu'], p['cpu_pct'])
+        print "  %-16s cpu %s  rss %s KB" % (n, cpu, p['rss_kb'])
+
+def compare(old, new):
+    "Print the differences between two sets of results."
+    def change(a, b):
+        if not a or b is None:
+            return "%s -> %s" % (a, b)
+        return "%s -> %s (%+.1f%%)" % (a, b, 100.0 * (b - a) / a)
+    for key, result in sorted(new.get('scenarios', {}).items()):
+        before = old.get('scenarios', {}).get(key)
+        if not before:
+            continue
+        print key
+        for load, old_load in zip(result['loads'], before['loads']):
+            print "  %-16s req/s %s  p99 %s" % (load['label'],
+                change(old_load['req_per_sec'], load['req_per_sec']),
+                change(old_load['latency_ms'].get('p99'),
+                       load['latency_ms'].get('p99')))
+    for name, result in sorted(new.get('micro', {}).items()):
+        before = old.get('micro', {}).get(name, {})
+        for metric, value in sorted(result.items()):
+            if metric in before and metric != 'pending':
+                print "micro %s %s %s" % (name, metric,
+                                          change(before[metric], value))
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--duration", type="int", default=5)
+    parser.add_option("--target", action="append", default=[])
+    parser.add_option("--scenario", action="append", default=[])
+    parser.add_option("--micro", action="store_true", default=False)
+    parser.add_option("--out")
+    parser.add_option("--compare")
+    parser.add_option("--port", type="int", default=18500)
+    options, args = parser.parse_args()
+    targets = options.target or ['server', 'proxy']
+
+    results = {
+        'meta': {
+            'time': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'duration': options.duration,
+        },
+        'scenarios': {},
+    }
+    origin_port, proxy_port = options.port, options.port + 1
+    procs = {}
+    try:
+        procs['origin'] = _Process('origin',
+            [os.path.join(bench_dir, "origin.py"), str(origin_port)],
+            origin_port)
+        if 'proxy' in targets:
+            procs['proxy'] = _Process('proxy',
+                ["proxy.py", str(proxy_port), "--no-collapse"],
+                proxy_port, cwd=scripts_dir)
+        for target in targets:
+            for name, gen_args in scenarios:
+                if options.scenario:
+                    if name not in options.scenario:
+                        continue
+                elif name in optional_scenarios:
+                    continue
+                result = run_scenario(name, gen_args, target, procs,
+                                      origin_port, options.duration)
+                results['scenarios']["%s/%s" % (target, name)] = result
+                report(name, target, result)
+    finally:
+        for p in procs.values():
+            p.stop()
+    if options.micro:
+        results['micro'] = micro.run_all()
+        for name, result in sorted(results['micro'].items()):
+            print "micro %s %s" % (name, result)
+    if options.out:
+        fh = open(options.out, 'w')
+        json.dump(results, fh, indent=2, sort_keys=True)
+        fh.close()
+    if options.compare:
+        compare(json.load(open(options.compare)), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+Benchmark nbhttp's WSGI gateway against the standard library's reference
+WSGI server (wsgiref).
+
+> python wsgi_bench.py [duration] [conns]
+
+Runs the same small WSGI application in its own process with:
+  - inline: WsgiGateway, running the application in the loop's thread
+  - threads: WsgiGateway, running it on a pool of four threads
+  - wsgiref: wsgiref.simple_server
+and reports requests/second and latency for each. Note that wsgiref
+closes the connection after each response, while nbhttp keeps them open.
+
+To serve the application on its own:
+
+> python wsgi_bench.py serve (inline|threads|wsgiref) port
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import sys
+
+from loadgen import LoadGen, push_tcp
+from run import _Process
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+small_body = "x" * 100
+modes = ['inline', 'threads', 'wsgiref']
+
+
+def app(environ, start_response):
+    "A WSGI application answering every request with 100 bytes."
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    if length:
+        environ['wsgi.input'].read(length)
+    start_response("200 OK", [
+        ("Content-Type", "text/plain"),
+        ("Content-Length", str(len(small_body))),
+    ])
+    return [small_body]
+
+def serve(mode, port):
+    if mode == 'wsgiref':
+        from wsgiref.simple_server import make_server, WSGIRequestHandler
+        class QuietHandler(WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+        make_server('127.0.0.1', port, app,
+                    handler_class=QuietHandler).serve_forever()
+        return
+    try:
+        from src.server import Server
+        from src.wsgi import WsgiGateway
+    except ImportError:
+        from nbhttp.server import Server
+        from nbhttp.wsgi import WsgiGateway
+    threads = mode == 'threads' and 4 or 0
+    Server('127.0.0.1', port, WsgiGateway(app, threads=threads))
+    push_tcp.run()
+
+def main():
+    duration = int((sys.argv[1:2] or [5])[0])
+    conns = int((sys.argv[2:3] or [20])[0])
+    port = 18600
+    for mode in modes:
+        proc = _Process(mode, [os.path.abspath(__file__), "serve", mode,
+                               str(port)], port, cwd=bench_dir)
+        try:
+            gen = LoadGen('127.0.0.1', port, '/', conns=conns,
+                          duration=duration, label=mode)
+            gen.start(push_tcp.stop)
+            push_tcp.run()
+            result = gen.results()
+            lat = result['latency_ms']
+            print "%-8s %9s req/s  p50 %s  p99 %s ms  %s errors  cpu %ss" % (
+                mode, result['req_per_sec'], lat.get('p50'), lat.get('p99'),
+                result['errors'], proc.cpu_time())
+        finally:
+            proc.stop()
+        port += 1
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["serve"]:
+        serve(sys.argv[2], int(sys.argv[3]))
+    else:
+        main()
@@ -2,39 +2,301 @@
 
 """
 A simple HTTP proxy as a demonstration.
+
+Concurrent GET and HEAD requests for the same URI (that don't carry
+credentials, or ask for a fresh response) are collapsed onto a single
+upstream request; its response is fanned out to all of them, as long as
+it can be shared. If it can't (e.g., it's private, or sets a cookie), the
+other requests are sent upstream on their own.
+
+Response bodies that go to a single downstream unchanged are relayed
+between the connections (see Client.relay_bodies), using splice() where
+it's available.
+
+Run it with --no-collapse to send every request upstream on its own.
+
+CONNECT requests open a tunnel (see push_tcp.tunnel) to the requested
+host and port, which is closed after tunnel_idle_timeout seconds without
+traffic.
 """
 
 
 import sys
 try: # run from dist without installation
     sys.path.insert(0, "..")
-    from src import Client, Server, header_dict, run, client, schedule
+    from src import Client, Server, header_dict, get_hdr, run, client, \
+        schedule, dummy, push_tcp
 except ImportError:
-    from nbhttp import Client, Server, header_dict, run, client, schedule
+    from nbhttp import Client, Server, header_dict, get_hdr, run, client, \
+        schedule, dummy, push_tcp
 
-# TODO: CONNECT support
 # TODO: remove headers nominated by Connection
 # TODO: add Via
 
+collapse_methods = ['GET', 'HEAD']
+collapse_key_hdrs = ['accept', 'accept-encoding', 'accept-language']
+no_collapse_hdrs = ['authorization', 'cookie', 'range']
+no_collapse_cc = ['no-cache', 'no-store', 'private']
+no_share_cc = ['private', 'no-store']
+tunnel_idle_timeout = 300
+
+ERR_SLOW_DOWNSTREAM = {
+    'desc': "Downstream too slow to follow a collapsed response",
+}
+
+# request / upstream fetch counts, for the collapse ratio
+stats = {
+    'requests': 0,
+    'collapsed': 0,
+    'reissued': 0,
+    'upstream': 0,
+    'tunnels': 0,
+}
+
+def collapse_ratio():
+    "Return the number of requests served per upstream fetch."
+    if not stats['upstream']:
+        return 1.0
+    return float(stats['requests']) / stats['upstream']
+
+
 class ProxyClient(Client):
     read_timeout = 10
     connect_timeout = 15
+    relay_bodies = True
+
+
+class CollapsedFetch:
+    """
+    An upstream fetch shared by concurrent requests with the same key.
+
+    Each downstream has its own pause state; a paused downstream has the
+    response body buffered for it (up to max_buffer bytes), so that it
+    doesn't hold up the others. The upstream is only paused when all of
+    the downstreams are.
+    """
+    in_flight = {}
+    max_buffer = 1024 * 1024
+
+    def __init__(self, key, method, uri, req_hdrs, s_res_start):
+        self.key = key
+        self.method = method
+        self.uri = uri
+        self.downstreams = [_Downstream(self, req_hdrs, s_res_start)]
+        self._res_pause = None
+        self._upstream_paused = False
+        self.in_flight[key] = self
+        stats['upstream'] += 1
+        c = ProxyClient(self._res_start)
+        self.req_body, self.req_done = c.req_start(
+            method, uri, req_hdrs, dummy
+        )
+
+    def req_finished(self, err):
+        # collapsed requests don't have bodies, so an error here is only
+        # a problem with the first downstream; the others still want it.
+        self.req_done(None)
+
+    def follow(self, req_hdrs, s_res_start):
+        "Add a downstream response to the fetch."
+        self.downstreams.append(_Downstream(self, req_hdrs, s_res_start))
+
+    def _res_start(self, version, status, phrase, res_hdrs, res_pause):
+        # the response has started; later requests need a new fetch.
+        if self.in_flight.get(self.key, None) is self:
+            del self.in_flight[self.key]
+        self._res_pause = res_pause
+        if len(self.downstreams) > 1 and not shareable(res_hdrs):
+            # only the first request gets this one; send the others.
+            for d in self.downstreams[1:]:
+                stats['reissued'] += 1
+                req_body, req_done = forward(
+                    self.method, self.uri, d.req_hdrs, d.s_res_start, dummy
+                )
+                req_done(None)
+            del self.downstreams[1:]
+        for d in self.downstreams:
+            d.start(status, phrase, res_hdrs)
+        if len(self.downstreams) == 1:
+            # nothing else can follow now, so pass the body straight on.
+            d = self.downstreams[0]
+            return d.res_body, d.res_done
+        return self._res_body, self._res_done
+
+    def _res_body(self, chunk):
+        for d in self.downstreams[:]:
+            d.body(chunk)
+
+    def _res_done(self, err):
+        for d in self.downstreams[:]:
+            d.done(err)
+
+    def drop(self, downstream):
+        "Stop sending to downstream."
+        self.downstreams.remove(downstream)
+        self.update_pause()
+
+    def update_pause(self):
+        "Pause the upstream if and only if every downstream is paused."
+        if not self.downstreams:
+            return
+        paused = len([d for d in self.downstreams if not d.paused]) == 0
+        if paused != self._upstream_paused and self._res_pause:
+            self._upstream_paused = paused
+            self._res_pause(paused)
+
+
+class _Downstream:
+    "One of the server responses following a CollapsedFetch."
+    def __init__(self, fetch, req_hdrs, s_res_start):
+        self.fetch = fetch
+        self.req_hdrs = req_hdrs
+        self.s_res_start = s_res_start
+        self.res_body = None
+        self.res_done = None
+        self.paused = False
+        self._buffer = []
+        self._buffered = 0
+        self._done = False
+        self._err = None
+
+    def start(self, status, phrase, res_hdrs):
+        self.res_body, self.res_done = self.s_res_start(
+            status, phrase, res_hdrs, self.pause
+        )
+
+    def body(self, chunk):
+        if not self.paused:
+            self.res_body(chunk)
+        elif self._buffered + len(chunk) > self.fetch.max_buffer:
+            self._finish(ERR_SLOW_DOWNSTREAM)
+        else:
+            self._buffer.append(chunk)
+            self._buffered += len(chunk)
+
+    def done(self, err):
+        self._done, self._err = True, err
+        if not self._buffer:
+            self._finish(err)
+
+    def pause(self, paused):
+        self.paused = paused
+        if self not in self.fetch.downstreams:
+            return # already finished
+        while self._buffer and not self.paused:
+            chunk = self._buffer.pop(0)
+            self._buffered -= len(chunk)
+            self.res_body(chunk)
+        if self._done and not self._buffer:
+            self._finish(self._err)
+        else:
+            self.fetch.update_pause()
+
+    def _finish(self, err):
+        self.fetch.drop(self)
+        self._buffer = []
+        self.res_done(err)
+
+
+def collapse_key(method, uri, req_hdrs):
+    "Return the key to collapse the request on, or None if it can't be."
+    if method not in collapse_methods:
+        return None
+    hdrs = header_dict(req_hdrs)
+    for name in no_collapse_hdrs:
+        if name in hdrs:
+            return None
+    if 'content-length' in hdrs or 'transfer-encoding' in hdrs:
+        return None
+    cc = [d.split("=", 1)[0].strip().lower()
+          for d in get_hdr(req_hdrs, 'cache-control')]
+    for directive in no_collapse_cc:
+        if directive in cc:
+            return None
+    if 'no-cache' in [p.lower() for p in get_hdr(req_hdrs, 'pragma')]:
+        return None
+    return (method, uri) + tuple([hdrs.get(n, None)
+                                  for n in collapse_key_hdrs])
+
+def shareable(res_hdrs):
+    "Return True if a response can be sent to more than one client."
+    cc = [d.split("=", 1)[0].strip().lower()
+          for d in get_hdr(res_hdrs, 'cache-control')]
+    for directive in no_share_cc:
+        if directive in cc:
+            return False
+    if get_hdr(res_hdrs, 'set-cookie'):
+        return False
+    for name in get_hdr(res_hdrs, 'vary'):
+        if name and name.lower() not in collapse_key_hdrs: # or "*"
+            return False
+    return True
 
 def proxy_handler(method, uri, req_hdrs, s_res_start, req_pause):
+    stats['requests'] += 1
+    key = collapse_key(method, uri, req_hdrs)
+    if key is not None:
+        fetch = CollapsedFetch.in_flight.get(key, None)
+        if fetch is not None:
+            stats['collapsed'] += 1
+            fetch.follow(req_hdrs, s_res_start)
+            return dummy, dummy
+        fetch = CollapsedFetch(key, method, uri, req_hdrs, s_res_start)
+        return fetch.req_body, fetch.req_finished
+    return forward(method, uri, req_hdrs, s_res_start, req_pause)
+
+def forward(method, uri, req_hdrs, s_res_start, req_pause):
+    "Send a request upstream on its own."
     # can modify method, uri, req_hdrs here
     def c_res_start(version, status, phrase, res_hdrs, res_pause):
         # can modify status, phrase, res_hdrs here
         res_body, res_done = s_res_start(status, phrase, res_hdrs, res_pause)
         # can modify res_body here
         return res_body, res_done
+    stats['upstream'] += 1
     c = ProxyClient(c_res_start)
     req_body, req_done = c.req_start(method, uri, req_hdrs, req_pause)
     # can modify req_body here
-    return req_body, req_done 
+    return req_body, req_done
+
+def connect_handler(authority, req_hdrs, s_res_start, detach):
+    "Open a tunnel to authority."
+    def error(status, phrase, message):
+        res_body, res_done = s_res_start(status, phrase, [
+            ("Content-Type", "text/plain"),
+            ("Content-Length", str(len(message))),
+        ], dummy)
+        res_body(message)
+        res_done(None)
+    try:
+        host, port = authority.rsplit(":", 1)
+        port = int(port)
+    except ValueError:
+        error("400", "Bad Request", "CONNECT needs a host and port.")
+        return
+    def connected(up_conn):
+        s_res_start("200", "Connection established", [], dummy)
+        down_conn, data = detach()
+        if not down_conn or not down_conn.tcp_connected:
+            up_conn.close()
+            return dummy, dummy, dummy
+        stats['tunnels'] += 1
+        if data:
+            up_conn.write(data)
+        push_tcp.tunnel(down_conn, up_conn, dummy, tunnel_idle_timeout)
+        return dummy, dummy, dummy
+    def failed(err):
+        error("502", "Bad Gateway", "Can't connect to %s (%s)." % (
+            authority, err[1]))
+    push_tcp.create_client(host, port, connected, failed,
+                           ProxyClient.connect_timeout)
 
 
 if __name__ == "__main__":
     import sys
     port = int(sys.argv[1])
+    if '--no-collapse' in sys.argv[2:]:
+        collapse_methods = []
     server = Server('', port, proxy_handler)
-    run()
\ No newline at end of file
+    server.connect_handler = connect_handler
+    run()
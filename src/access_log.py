@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""
+Buffered access logging for Server
+
+> server = Server(host, port, handler)
+> server.access_log = AccessLog("/var/log/nbhttp/access.log")
+
+Each response the server finishes is recorded in memory, and records are
+written out in batches every flush_interval seconds, so that the event loop
+doesn't do file I/O for every request. By default the batches are written
+by a background thread; if the writer falls behind (e.g., because the disk
+is slow), up to max_batches are queued and after that, batches are dropped
+and counted in dropped rather than holding up the loop. With
+use_thread = False, batches are written from the loop itself, on a timer.
+
+At most max_pending records are held between flushes; again, records past
+that are dropped and counted. To log only some requests when there are
+very many, set sample to N to log one in every N.
+
+format is either a string to be formatted with a dictionary of:
+  - remote: client IP address
+  - time: time the response finished, in Common Log Format
+  - method, uri, status
+  - bytes: bytes sent, including headers
+  - duration: seconds from request headers to the end of the response
+  - duration_ms
+or a callable that takes that dictionary and returns a line of text.
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import logging
+import threading
+import time
+from Queue import Queue, Full
+
+import push_tcp
+
+log = logging.getLogger('access_log')
+
+common_format = '%(remote)s - - [%(time)s] "%(method)s %(uri)s" ' \
+                '%(status)s %(bytes)s %(duration_ms).3f\n'
+
+
+class AccessLog:
+    "A buffered, non-blocking access log."
+    format = common_format
+    flush_interval = 1
+    max_pending = 10000
+    max_batches = 10
+    sample = 1
+    use_thread = True
+
+    def __init__(self, path_or_file, format=None, sample=None,
+                 use_thread=None):
+        if hasattr(path_or_file, 'write'):
+            self._file = path_or_file
+        else:
+            self._file = open(path_or_file, 'a')
+        if format is not None:
+            self.format = format
+        if sample is not None:
+            self.sample = sample
+        if use_thread is not None:
+            self.use_thread = use_thread
+        self.seen = 0
+        self.logged = 0
+        self.dropped = 0
+        self._count_lock = threading.Lock() # the writer counts, too
+        self._pending = []
+        self._flush_ev = None
+        self._time_cache = (None, None)
+        self._queue = None
+        self._thread = None
+        if self.use_thread:
+            self._queue = Queue(self.max_batches)
+            self._thread = threading.Thread(target=self._writer,
+                                            name="access_log")
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def log(self, remote, method, uri, status, nbytes, duration):
+        "Record a finished response."
+        self.seen += 1
+        if self.sample > 1 and self.seen % self.sample:
+            return
+        if len(self._pending) >= self.max_pending:
+            self._count('dropped', 1)
+            return
+        self._pending.append(
+            (time.time(), remote, method, uri, status, nbytes, duration))
+        if self._flush_ev is None:
+            self._flush_ev = push_tcp.schedule(self.flush_interval,
+                                               self.flush)
+
+    def flush(self):
+        "Write out (or hand off) the records held so far."
+        self._flush_ev = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        if self._queue is None:
+            self._write(batch)
+            return
+        try:
+            self._queue.put_nowait(batch)
+        except Full:
+            self._count('dropped', len(batch))
+
+    def close(self):
+        "Flush what's held, wait for the writer and close the file."
+        if self._flush_ev:
+            self._flush_ev.delete()
+        self.flush()
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._file.close()
+
+    def stats(self):
+        "Return a dictionary of counts."
+        return {
+            'seen': self.seen,
+            'logged': self.logged,
+            'dropped': self.dropped,
+            'pending': len(self._pending),
+        }
+
+    def _writer(self):
+        "Write batches from the queue, in the background."
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            self._write(batch)
+
+    def _write(self, batch):
+        lines = [self._format(r) for r in batch]
+        try:
+            self._file.write("".join(lines))
+            self._file.flush()
+        except (IOError, OSError), why:
+            log.warning("Can't write access log: %s" % why)
+            self._count('dropped', len(batch))
+            return
+        self._count('logged', len(batch))
+
+    def _count(self, name, num):
+        "Add num to the named count; safe from either thread."
+        self._count_lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + num)
+        finally:
+            self._count_lock.release()
+
+    def _format(self, record):
+        when, remote, method, uri, status, nbytes, duration = record
+        second = int(when)
+        if self._time_cache[0] != second:
+            self._time_cache = (second, time.strftime(
+                "%d/%b/%Y:%H:%M:%S +0000", time.gmtime(second)))
+        fields = {
+            'remote': remote or "-",
+            'time': self._time_cache[1],
+            'method': method,
+            'uri': uri,
+            'status': status,
+            'bytes': nbytes,
+            'duration': duration,
+            'duration_ms': duration * 1000,
+        }
+        if callable(self.format):
+            return self.format(fields)
+        return self.format % fields
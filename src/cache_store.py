@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+
+"""
+Disk-backed cache store
+
+This module stores HTTP response bodies (and their status and headers) on
+disk, so that a client or intermediary can cache a working set that doesn't
+fit in memory.
+
+Responses are appended to a series of segment files in a directory; a
+small in-memory index maps each key to the segment, offset and length of
+its record, and hits are read from memory-mapped segments. When the store
+gets too big, the oldest segment is evicted as a whole, so that writes are
+always sequential.
+
+> store = DiskCacheStore("/var/cache/nbhttp", max_segments=16)
+
+To store a response, get a writer and push the body into it;
+
+> write, done = store.writer(key, "200", "OK", res_hdrs)
+> write(chunk)
+> done(None)
+
+If done is called with an error dictionary, the response isn't stored.
+Responses are written to the active segment one at a time; while one is
+being written, other writers hold up to spill_size bytes in memory, then
+spill the rest to a temporary file, and are written in the order they
+were started.
+
+To look up a response;
+
+> hit = store.get(key)
+> if hit:
+>     status, phrase, res_hdrs, body = hit
+
+body is a read-only buffer over the mapped segment, so it isn't copied
+into memory unless you ask for it. To answer a server request from the
+store, use respond with the res_start callable handed to a request_handler;
+
+> if store.respond(key, res_start):
+>     return dummy, dummy
+
+It sends the body in bounded pieces, observing res_body_pause.
+
+When a DiskCacheStore is created on a directory that already holds
+segments, the index is rebuilt from their record headers.
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+
+from http_common import linesep, hop_by_hop_hdrs
+
+# record header: magic, flags, key length, meta length, body length
+_rec_hdr = struct.Struct("!4sBHIQ")
+_magic = "NBC1"
+_COMPLETE = 1
+_seg_suffix = ".seg"
+_strip_hdrs = hop_by_hop_hdrs + ['content-length']
+
+
+class DiskCacheStore:
+    "An append-only, segmented store for response bodies."
+    max_segment_size = 1024 * 1024 * 64
+    max_segments = 16
+    respond_chunk = 1024 * 64
+    spill_size = 1024 * 64 # bytes a waiting writer holds in memory
+
+    def __init__(self, path, max_segments=None, max_segment_size=None):
+        self.path = path
+        if max_segments is not None:
+            self.max_segments = max_segments
+        if max_segment_size is not None:
+            self.max_segment_size = max_segment_size
+        self._index = {} # key -> (segment, record offset, body length)
+        self._seg_keys = {} # segment -> [keys]
+        self._maps = {} # segment -> (mmap, mapped length)
+        self._segments = [] # oldest first
+        self._active = None # (segment, file)
+        self._active_size = 0
+        self._writing = None # the writer currently streaming to disk
+        self._waiting = [] # writers waiting for their turn, in order
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._rebuild()
+        self._roll()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get(self, key):
+        """
+        Return (status, phrase, hdr_tuples, body) for key, or None if it
+        isn't stored. body is a read-only buffer over the mapped segment.
+        """
+        try:
+            seg, offset, body_len = self._index[key]
+        except KeyError:
+            return None
+        smap = self._map(seg, offset + _rec_hdr.size)
+        magic, flags, key_len, meta_len, _ = \
+            _rec_hdr.unpack_from(smap, offset)
+        meta_start = offset + _rec_hdr.size + key_len
+        body_start = meta_start + meta_len
+        smap = self._map(seg, body_start + body_len)
+        status, phrase, hdr_tuples = _parse_meta(
+            smap[meta_start:body_start]
+        )
+        return status, phrase, hdr_tuples, buffer(smap, body_start, body_len)
+
+    def remove(self, key):
+        "Forget key. Its bytes are reclaimed when its segment is evicted."
+        try:
+            del self._index[key]
+        except KeyError:
+            pass
+
+    def writer(self, key, status, phrase, hdr_tuples):
+        """
+        Start storing a response under key. Returns a (write, done) tuple
+        of callables.
+        """
+        meta = _format_meta(status, phrase, hdr_tuples)
+        w = _CacheWriter(self, key, meta)
+        if self._writing is None:
+            self._start_write(w)
+        else:
+            self._waiting.append(w)
+        return w.write, w.done
+
+    def respond(self, key, res_start):
+        """
+        Answer a request for key using res_start (as handed to a server
+        request_handler). Returns False if key isn't stored.
+        """
+        hit = self.get(key)
+        if hit is None:
+            return False
+        status, phrase, hdr_tuples, body = hit
+        hdr_tuples = [h for h in hdr_tuples
+                      if h[0].lower() not in _strip_hdrs]
+        hdr_tuples.append(("Content-Length", str(len(body))))
+        _BodySender(body, res_start, status, phrase, hdr_tuples,
+                    self.respond_chunk)
+        return True
+
+    def close(self):
+        "Close the active segment and release mapped segments."
+        if self._active:
+            self._active[1].close()
+            self._active = None
+        self._maps = {}
+
+    # segment management
+
+    def _seg_name(self, seg):
+        return os.path.join(self.path, "%08d%s" % (seg, _seg_suffix))
+
+    def _map(self, seg, min_len):
+        "Return a mmap of seg that's at least min_len long."
+        try:
+            smap, mapped = self._maps[seg]
+            if mapped >= min_len:
+                return smap
+        except KeyError:
+            pass
+        fd = os.open(self._seg_name(seg), os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            smap = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        self._maps[seg] = (smap, size)
+        return smap
+
+    def _roll(self):
+        "Start a new active segment, evicting old ones if necessary."
+        if self._active:
+            self._active[1].close()
+        if self._segments:
+            seg = self._segments[-1] + 1
+        else:
+            seg = 0
+        self._active = (seg, open(self._seg_name(seg), 'wb'))
+        self._active_size = 0
+        self._segments.append(seg)
+        self._seg_keys[seg] = []
+        while len(self._segments) > self.max_segments:
+            self._evict(self._segments[0])
+
+    def _evict(self, seg):
+        "Drop a whole segment and its index entries."
+        for key in self._seg_keys.pop(seg, []):
+            entry = self._index.get(key, None)
+            if entry and entry[0] == seg:
+                del self._index[key]
+        # readers may still hold a buffer over the map; let GC close it.
+        self._maps.pop(seg, None)
+        self._segments.remove(seg)
+        try:
+            os.unlink(self._seg_name(seg))
+        except OSError:
+            pass
+
+    def _rebuild(self):
+        "Rebuild the index from the segments on disk."
+        segs = []
+        for name in os.listdir(self.path):
+            if name.endswith(_seg_suffix):
+                try:
+                    segs.append(int(name[:-len(_seg_suffix)]))
+                except ValueError:
+                    continue
+        segs.sort()
+        for seg in segs:
+            self._segments.append(seg)
+            self._seg_keys[seg] = []
+            self._scan(seg)
+
+    def _scan(self, seg):
+        "Index the complete records in seg."
+        fh = open(self._seg_name(seg), 'rb')
+        try:
+            size = os.fstat(fh.fileno()).st_size
+            offset = 0
+            while offset + _rec_hdr.size <= size:
+                fh.seek(offset)
+                magic, flags, key_len, meta_len, body_len = \
+                    _rec_hdr.unpack(fh.read(_rec_hdr.size))
+                rec_len = _rec_hdr.size + key_len + meta_len + body_len
+                if magic != _magic or offset + rec_len > size:
+                    break # torn write; ignore the rest of the segment.
+                if flags & _COMPLETE:
+                    key = fh.read(key_len)
+                    self._index[key] = (seg, offset, body_len)
+                    self._seg_keys[seg].append(key)
+                offset += rec_len
+        finally:
+            fh.close()
+
+    # writing
+
+    def _start_write(self, w):
+        "Let w stream to the active segment."
+        if self._active_size >= self.max_segment_size:
+            self._roll()
+        self._writing = w
+        w.seg = self._active[0]
+        w.offset = self._active_size
+        fh = self._active[1]
+        fh.write(_rec_hdr.pack(_magic, 0, len(w.key), len(w.meta), 0))
+        fh.write(w.key)
+        fh.write(w.meta)
+        self._active_size += _rec_hdr.size + len(w.key) + len(w.meta)
+        for chunk in w.pending:
+            self._append(chunk)
+        w.pending = []
+        if w.spill:
+            w.spill.seek(0)
+            while True:
+                chunk = w.spill.read(self.respond_chunk)
+                if not chunk:
+                    break
+                self._append(chunk)
+            w.spill.close()
+            w.spill = None
+
+    def _append(self, chunk):
+        self._active[1].write(chunk)
+        self._active_size += len(chunk)
+        self._writing.body_len += len(chunk)
+
+    def _finish_write(self, w, ok):
+        "Seal the record that w has been writing, and start the next one."
+        self._seal(w, ok)
+        while self._waiting and self._writing is None:
+            nxt = self._waiting.pop(0)
+            self._start_write(nxt)
+            if nxt.finished:
+                self._seal(nxt, True)
+
+    def _seal(self, w, ok):
+        "Finish the record that w has been writing."
+        fh = self._active[1]
+        flags = ok and _COMPLETE or 0
+        fh.seek(w.offset)
+        fh.write(_rec_hdr.pack(_magic, flags, len(w.key), len(w.meta),
+                               w.body_len))
+        fh.seek(0, os.SEEK_END)
+        fh.flush()
+        if ok:
+            self._index[w.key] = (w.seg, w.offset, w.body_len)
+            self._seg_keys[w.seg].append(w.key)
+        self._writing = None
+
+
+class _CacheWriter:
+    "A response being written to a DiskCacheStore."
+    def __init__(self, store, key, meta):
+        self.store = store
+        self.key = key
+        self.meta = meta
+        self.pending = []
+        self.pending_len = 0
+        self.spill = None # temporary file, once pending is too big
+        self.finished = False
+        self.closed = False # done has been called
+        self.seg = None
+        self.offset = None
+        self.body_len = 0
+
+    def write(self, chunk):
+        "Add chunk to the stored body."
+        if self.closed:
+            return
+        store = self.store
+        if store._writing is self:
+            store._append(chunk)
+        elif self.spill:
+            self.spill.write(chunk)
+        else:
+            # another response is being written; hold on to it.
+            self.pending.append(chunk)
+            self.pending_len += len(chunk)
+            if self.pending_len > store.spill_size:
+                self.spill = tempfile.TemporaryFile(dir=store.path)
+                self.spill.write("".join(self.pending))
+                self.pending = []
+                self.pending_len = 0
+
+    def done(self, err=None):
+        "Finish storing the response; don't store it if err is set."
+        if self.closed:
+            return
+        self.closed = True
+        store = self.store
+        if store._writing is self:
+            store._finish_write(self, err is None)
+        elif err is None:
+            self.finished = True # written when its turn comes.
+        else:
+            if self in store._waiting:
+                store._waiting.remove(self)
+            self.pending = []
+            if self.spill:
+                self.spill.close()
+                self.spill = None
+
+
+class _BodySender:
+    "Send a buffer as a response body, in pieces, observing pause."
+    def __init__(self, body, res_start, status, phrase, hdr_tuples,
+                 chunk_size):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.sent = 0
+        self.paused = False
+        self.res_body, self.res_done = res_start(
+            status, phrase, hdr_tuples, self.pause
+        )
+        self.send()
+
+    def pause(self, paused):
+        self.paused = paused
+        if not paused:
+            self.send()
+
+    def send(self):
+        body, size = self.body, len(self.body)
+        while not self.paused and self.sent < size:
+            start = self.sent
+            self.sent = min(start + self.chunk_size, size)
+            self.res_body(body[start:self.sent])
+        if self.sent >= size and self.res_done:
+            res_done, self.res_done = self.res_done, None
+            res_done(None)
+
+
+def _format_meta(status, phrase, hdr_tuples):
+    "Serialise a response's status and headers."
+    return linesep.join(
+        ["%s %s" % (status, phrase)] +
+        ["%s: %s" % (k, v) for k, v in hdr_tuples]
+    )
+
+def _parse_meta(meta):
+    "Parse a serialised response status and headers."
+    lines = meta.split(linesep)
+    try:
+        status, phrase = lines.pop(0).split(" ", 1)
+    except ValueError:
+        status, phrase = lines[0], ""
+    hdr_tuples = []
+    for line in lines:
+        try:
+            name, value = line.split(":", 1)
+        except ValueError:
+            continue
+        hdr_tuples.append((name, value.strip()))
+    return status, phrase, hdr_tuples
@@ -60,6 +60,57 @@ an error dictionary). However, if a response has already been started, the
 connection will be dropped (for example, when the response chunking or
 indicated length are incorrect). In these cases, res_done will still be called
 with the appropriate error dictionary.
+
+If expect_100_threshold is set on the Client (or a subclass), requests with
+a body at least that many bytes long are sent with "Expect: 100-continue",
+and req_body_pause is called to hold the body back until the server sends
+100 Continue, or expect_100_timeout seconds pass. If the server sends a
+final response first, the body is discarded and the connection is closed 
+once the response is done.
+
+To send a request body whose length isn't known in advance, include
+"Transfer-Encoding: chunked" in req_hdrs; if the server is known to only 
+support HTTP/1.0, the request will fail with ERR_LEN_REQ.
+
+The client remembers the HTTP version, keep-alive behaviour and 100-continue
+support of each server it talks to (see _NextHopCache), and uses them to
+decide how to send later requests.
+
+Idempotent requests are retried (up to retry_limit times) when the server
+closes the connection before responding, after a random delay that grows
+exponentially from retry_delay up to retry_delay_max seconds.
+
+Idempotent requests without a body can also be hedged; if hedge_delay is
+set, or hedge_percentile is set and the server's recent response latency is
+known, the request is sent again on another connection if a response hasn't
+started by then. The first response to start is used, and the other request
+is cancelled and its connection closed.
+
+Requests to an authority that has an upstream group (see the upstream 
+module) are balanced across the group's backends.
+
+https URLs are fetched using TLS, with tls_context (an ssl.SSLContext) if
+it's set on the Client, or push_tcp.client_context() otherwise.
+
+Connections are pooled and reused for each origin (host and port); by 
+default, at most 16 connections are opened to an origin, and requests beyond 
+that wait for one to become free. The limits are attributes of 
+_HttpConnectionPool (max_conns, max_idle, idle_timeout and max_requests).
+
+To open connections to an origin before they're needed, call prewarm: 
+  - host (string)
+  - port (int)
+  - num (int)
+
+pool_stats returns a dictionary of connection pool statistics.
+
+If timing_sink is set, it's called with a TimingRecord for each request once
+the response is done; see the timing module.
+
+If relay_bodies is set and res_start returns a Server's res_body unchanged,
+a response body delimited by Content-Length or by closing the connection is
+passed to the Server's connection with push_tcp.relay, instead of through
+res_body (see HttpServerConnection.res_body_relay).
 """
 
 __author__ = "Mark Nottingham <mnot@mnot.net>"
@@ -87,27 +138,44 @@ THE SOFTWARE.
 
 import errno
 import os
+import random
+import time
 from urlparse import urlsplit, urlunsplit
 
+import metrics
 import push_tcp
+import timing
+import upstream
 from http_common import HttpMessageHandler, \
-    CLOSE, COUNTED, NOBODY, \
-    WAITING, \
+    CLOSE, COUNTED, CHUNKED, NOBODY, \
+    WAITING, HEADERS_DONE, \
     idempotent_methods, no_body_status, hop_by_hop_hdrs, \
     dummy, get_hdr
-from error import ERR_URL, ERR_CONNECT, \
+from error import ERR_URL, ERR_CONNECT, ERR_LEN_REQ, \
     ERR_READ_TIMEOUT, ERR_HTTP_VERSION
 
 req_remove_hdrs = hop_by_hop_hdrs + ['host']
 
 # TODO: proxy support
-# TODO: next-hop version cache for Expect/Continue, etc.
 
 class Client(HttpMessageHandler):
     "An asynchronous HTTP client."
     connect_timeout = None
     read_timeout = None
     retry_limit = 2
+    retry_delay = 0.1
+    retry_delay_max = 10
+    retry_buffer = 1024 * 64
+    hedge_delay = None
+    hedge_percentile = None
+    hedge_min_samples = 20
+    expect_100_threshold = None
+    expect_100_timeout = 1
+    timing_sink = None
+    write_high = None # per-connection write watermarks; see push_tcp
+    write_low = None
+    relay_bodies = False
+    tls_context = None
 
     def __init__(self, res_start_cb):
         HttpMessageHandler.__init__(self)
@@ -119,18 +187,41 @@ class Client(HttpMessageHandler):
         self.req_hdrs = []
         self._host = None
         self._port = None
+        self._tls = None
         self._tcp_conn = None
         self._conn_reusable = False
         self._req_body_pause_cb = None
         self._retries = 0
+        self._retry_ev = None
+        self._replay = []
+        self._replay_len = 0
         self._read_timeout_ev = None
         self._output_buffer = []
+        self._req_args = None
+        self._start_time = None
+        self._hedge_ev = None
+        self._hedge_peer = None
+        self._hedge_of = None
+        self._cancelled = False
+        self._expect_waiting = False
+        self._expect_ev = None
+        self._held_body = []
+        self._held_done = None
+        self._body_aborted = False
+        self._timing = None
+        self._relay_to = None
+        self._asked_close = False
+        self._res_finished = False
 
     def __getstate__(self):
         props = ['method', 'uri', 'req_hdrs', 
             'input_header_length', 'input_transfer_length']
-        return dict([(k, v) for (k, v) in self.__dict__.items() 
-                     if k in props])
+        # some of these are slots, so they aren't in __dict__.
+        return dict([(k, getattr(self, k)) for k in props])
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
 
     def req_start(self, method, uri, req_hdrs, req_body_pause):
         """
@@ -141,10 +232,22 @@ class Client(HttpMessageHandler):
         Returns a (req_body, req_done) tuple.
         """
         self._req_body_pause_cb = req_body_pause
+        self._req_args = (method, uri, req_hdrs)
+        self._start_time = push_tcp.now()
+        if self.timing_sink or timing.current:
+            self._timing = timing.TimingRecord('client', method, uri,
+                                               timing.current)
+        chunked_body = 'chunked' in get_hdr(req_hdrs, "transfer-encoding")
         req_hdrs = [i for i in req_hdrs \
             if not i[0].lower() in req_remove_hdrs]
         (scheme, authority, path, query, fragment) = urlsplit(uri)
-        if scheme.lower() != 'http':
+        scheme = scheme.lower()
+        if scheme == 'https':
+            self._tls = self.tls_context or push_tcp.client_context()
+            default_port = 443
+        elif scheme == 'http':
+            default_port = 80
+        else:
             self._handle_error(ERR_URL, "Only HTTP URLs are supported")
             return dummy, dummy
         if "@" in authority:
@@ -157,33 +260,61 @@ class Client(HttpMessageHandler):
                 self._handle_error(ERR_URL, "Non-integer port in URL")
                 return dummy, dummy
         else:
-            self._host, self._port = authority, 80
+            self._host, self._port = authority, default_port
         if path == "":
             path = "/"
         uri = urlunsplit(('', '', path, query, ''))
         self.method, self.uri, self.req_hdrs = method, uri, req_hdrs
+        if method not in idempotent_methods:
+            self._replay = None # it can't be retried anyway.
+        hop = _next_hops.get(self._host, self._port)
         self.req_hdrs.append(("Host", authority))
-        self.req_hdrs.append(("Connection", "keep-alive"))
+        if hop and not hop.use_keep_alive():
+            self.req_hdrs.append(("Connection", "close"))
+            self._asked_close = True
+        else:
+            self.req_hdrs.append(("Connection", "keep-alive"))
         try:
             body_len = int(get_hdr(req_hdrs, "content-length").pop(0))
             delimit = COUNTED
         except (IndexError, ValueError):
             body_len = None
             delimit = NOBODY
+            if chunked_body:
+                if hop and hop.version < 1.1:
+                    self._handle_error(ERR_LEN_REQ, 
+                        "Next hop is HTTP/%s" % hop.version)
+                    return dummy, dummy
+                self.req_hdrs.append(("Transfer-Encoding", "chunked"))
+                delimit = CHUNKED
+        if self.expect_100_threshold is not None and body_len \
+        and body_len >= self.expect_100_threshold \
+        and (hop is None or hop.use_expect()) \
+        and not get_hdr(req_hdrs, "expect"):
+            self.req_hdrs.append(("Expect", "100-continue"))
+            self._expect_waiting = True
         self._output_start("%s %s HTTP/1.1" % (self.method, self.uri),
             self.req_hdrs, delimit
         )
         _idle_pool.attach(self._host, self._port, self._handle_connect,
-            self._handle_connect_error, self.connect_timeout
+            self._handle_connect_error, self.connect_timeout, self._tls
         )
+        if self._expect_waiting:
+            self._req_body_pause(True)
+        if delimit == NOBODY and method in idempotent_methods \
+        and self._hedge_of is None:
+            hedge_delay = self._hedge_after(hop)
+            if hedge_delay is not None:
+                self._hedge_ev = push_tcp.schedule(hedge_delay, self._hedge)
         return self.req_body, self.req_done
-    # TODO: if we sent Expect: 100-continue, don't wait forever 
-    # (i.e., schedule something)
 
     def req_body(self, chunk):
         "Send part of the request body. May be called zero to many times."
         # FIXME: self._handle_error(ERR_LEN_REQ)
-        self._output_body(chunk)
+        if self._expect_waiting:
+            self._held_body.append(chunk)
+        elif not self._body_aborted:
+            self._output_body(chunk)
         
     def req_done(self, err=None):
         """
@@ -194,7 +325,12 @@ class Client(HttpMessageHandler):
         indicating that an HTTP-specific (i.e., non-application) error
         occurred while satisfying the request; this is useful for debugging.
         """
-        self._output_end(err)            
+        if err:
+            self._abort(err) # the request can't be completed.
+        elif self._expect_waiting:
+            self._held_done = (err,)
+        elif not self._body_aborted:
+            self._output_end(err)            
 
     def res_body_pause(self, paused):
         "Temporarily stop / restart sending the response body."
@@ -205,17 +341,44 @@ class Client(HttpMessageHandler):
 
     def _handle_connect(self, tcp_conn):
         "The connection has succeeded."
+        if self._cancelled:
+            _idle_pool.abandon(tcp_conn)
+            return dummy, dummy, dummy
         self._tcp_conn = tcp_conn
+        if self.write_high:
+            tcp_conn.set_watermarks(self.write_high, self.write_low)
+        if self._timing:
+            self._timing.mark('conn')
+            self._timing.conn_reused = tcp_conn.pool_requests > 1
         self._output("") # kick the output buffer
+        if self._expect_waiting and not self._expect_ev:
+            self._expect_ev = push_tcp.schedule(
+                self.expect_100_timeout, self._expect_timeout
+            )
         if self.read_timeout:
             self._read_timeout_ev = push_tcp.schedule(
                 self.read_timeout, self._handle_error, 
                 ERR_READ_TIMEOUT, 'connect'
             )
-        return self._handle_input, self._conn_closed, self._req_body_pause
+        if self._timing:
+            read_cb = self._timed_input
+        else:
+            read_cb = self._handle_input
+        return read_cb, self._conn_closed, self._req_body_pause
+
+    def _timed_input(self, instr):
+        "_handle_input, keeping track of timing."
+        if self._timing:
+            now = time.time()
+            self._timing.mark('res_first_byte', now)
+            self._timing.marks['res_last_byte'] = now
+            self._timing.bytes_in += len(instr)
+        self._handle_input(instr)
 
     def _handle_connect_error(self, err):
         "The connection has failed."
+        if self._cancelled:
+            return
         if err[0] == errno.EINVAL: # weirdness.
             err = (errno.ECONNREFUSED, os.strerror(errno.ECONNREFUSED))
         self._handle_error(ERR_CONNECT, err[1])
@@ -224,41 +387,187 @@ class Client(HttpMessageHandler):
         "The server closed the connection."
         if self.read_timeout:
             self._read_timeout_ev.delete()
+        if self._tcp_conn:
+            # a response delimited by close is complete now.
+            _idle_pool.discard(self._tcp_conn,
+                answered=self._input_delimit == CLOSE
+            )
+            self._tcp_conn = None
         if self._input_buffer:
             self._handle_input("")
         if self._input_delimit == CLOSE:
             self._input_end()
         elif self._input_state == WAITING:
-            if self.method in idempotent_methods:
-                if self._retries < self.retry_limit:
-                    self._retry()
-                else:
-                    self._handle_error(ERR_CONNECT, 
-                        "Tried to connect %s times." % (self._retries + 1)
-                    )
-            else:
+            if self.method not in idempotent_methods:
                 self._handle_error(ERR_CONNECT, 
                     "Can't retry %s method" % self.method
                 )
+            elif self._replay is None:
+                self._handle_error(ERR_CONNECT, 
+                    "Request too large to retry"
+                )
+            elif self._retries < self.retry_limit:
+                self._retry()
+            else:
+                self._handle_error(ERR_CONNECT, 
+                    "Tried to connect %s times." % (self._retries + 1)
+                )
         else:
             self._input_error(ERR_CONNECT, 
                 "Server dropped connection before the response was received."
             )
 
     def _retry(self):
-        "Retry the request."
+        """
+        Retry the request, after a randomised delay that grows 
+        exponentially with the number of retries.
+        """
         if self._read_timeout_ev:
             self._read_timeout_ev.delete()
+        delay = random.uniform(0, min(self.retry_delay_max,
+            self.retry_delay * (2 ** self._retries)))
         self._retries += 1
+        self._retry_ev = push_tcp.schedule(delay, self._reattach)
+
+    def _reattach(self):
+        "Send the request again on another connection."
+        self._retry_ev = None
+        if self._cancelled:
+            return
+        self._output_buffer = self._replay[:]
         _idle_pool.attach(self._host, self._port, self._handle_connect,
-            self._handle_connect_error, self.connect_timeout
+            self._handle_connect_error, self.connect_timeout, self._tls
         )
 
+    def _hedge_after(self, hop):
+        "How long to wait before hedging the request, or None to not."
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        if self.hedge_percentile is not None and hop \
+        and len(hop.latencies) >= self.hedge_min_samples:
+            return hop.latency(self.hedge_percentile)
+        return None
+
+    def _hedge(self):
+        """
+        The response is slow; send the same request on another connection.
+        Whichever response starts first is used, and the other is cancelled.
+        """
+        self._hedge_ev = None
+        if self._cancelled or self._hedge_peer:
+            return
+        method, uri, req_hdrs = self._req_args
+        peer = self.__class__(self._hedge_res_start)
+        peer._hedge_of = self
+        self._hedge_peer = peer
+        # the hedge's timing goes alongside this request's.
+        previous = timing.current
+        timing.current = self._timing and self._timing.parent
+        try:
+            req_body, req_done = peer.req_start(method, uri, req_hdrs, dummy)
+        finally:
+            timing.current = previous
+        req_done(None)
+
+    def _hedge_res_start(self, *args):
+        "The hedged request won; cancel this one and use its response."
+        peer, self._hedge_peer = self._hedge_peer, None
+        peer._hedge_of = None
+        res_start_cb = self.res_start_cb
+        self._cancel()
+        return res_start_cb(*args)
+
+    def _hedge_settle(self):
+        "This response is starting; stop hedging, and cancel any hedge."
+        if self._hedge_ev:
+            self._hedge_ev.delete()
+            self._hedge_ev = None
+        if self._hedge_peer:
+            peer, self._hedge_peer = self._hedge_peer, None
+            peer._hedge_of = None
+            peer._cancel()
+
+    def _abort(self, err):
+        """
+        The application gave up on the request; finish the response with
+        err, and abandon the request.
+        """
+        if self._cancelled or self._res_finished:
+            return
+        if self._hedge_peer:
+            peer, self._hedge_peer = self._hedge_peer, None
+            peer._hedge_of = None
+            peer._cancel(err)
+        if self.res_done_cb is None: # the response hasn't started.
+            self._handle_error(err)
+        else:
+            self._input_error(err, err.get('detail', None))
+        self._cancelled = True
+        for ev in [self._expect_ev, self._hedge_ev, self._retry_ev]:
+            if ev:
+                ev.delete()
+
+    def _cancel(self, err=None):
+        "Abandon the request, discarding its connection."
+        self._cancelled = True
+        if self._timing:
+            self._timing.finish(self.timing_sink, err)
+        for ev in [self._read_timeout_ev, self._expect_ev, 
+                   self._hedge_ev, self._retry_ev]:
+            if ev:
+                ev.delete()
+        if self._tcp_conn:
+            _idle_pool.abandon(self._tcp_conn)
+            self._tcp_conn = None
+        self.res_start_cb = self.res_body_cb = self.res_done_cb = None
+
     def _req_body_pause(self, paused):
         "The client needs the application to pause/unpause the request body."
         if self._req_body_pause_cb:
             self._req_body_pause_cb(paused)
 
+    def _expect_continue(self):
+        "Send the request body we've held while waiting for 100 Continue."
+        if not self._expect_waiting:
+            return
+        self._expect_waiting = False
+        if self._expect_ev:
+            self._expect_ev.delete()
+            self._expect_ev = None
+        held, self._held_body = self._held_body, []
+        for chunk in held:
+            self._output_body(chunk)
+        if self._held_done:
+            self._output_end(self._held_done[0])
+            self._held_done = None
+        else:
+            self._req_body_pause(False)
+
+    def _expect_timeout(self):
+        "The server didn't send 100 Continue in time; send the body anyway."
+        if self._expect_waiting:
+            _next_hops.update(self._host, self._port, expect=False)
+            self._expect_continue()
+
+    def _expect_abort(self):
+        """
+        A final response arrived before 100 Continue; don't send the body,
+        and don't reuse the connection, since the server may still be
+        waiting for it.
+        """
+        self._expect_waiting = False
+        if self._expect_ev:
+            self._expect_ev.delete()
+            self._expect_ev = None
+        self._held_body = []
+        self._body_aborted = True
+        self._conn_reusable = False
+        if self._held_done:
+            self._held_done = None
+        else:
+            # let the application finish the body; the rest is dropped.
+            self._req_body_pause(False)
+
     # Methods called by common.HttpMessageHandler
 
     def _input_start(self, top_line, hdr_tuples, conn_tokens, 
@@ -281,23 +590,94 @@ class Client(HttpMessageHandler):
         except ValueError:
             res_code = status_txt.rstrip()
             res_phrase = ""
+        if res_code[:1] == "1": # interim response; wait for the final one.
+            if res_code == "100":
+                _next_hops.update(self._host, self._port, expect=True)
+                self._expect_continue()
+            if self.read_timeout:
+                self._read_timeout_ev = push_tcp.schedule(
+                    self.read_timeout, self._input_error, 
+                    ERR_READ_TIMEOUT, 'start'
+                )
+            self._input_interim = True
+            return False
         if 'close' not in conn_tokens:
             if (res_version == 1.0 and 'keep-alive' in conn_tokens) or \
                 res_version > 1.0:
                 self._conn_reusable = True
+        if self._asked_close: # its answer says nothing about keep-alive.
+            _next_hops.update(self._host, self._port, version=res_version)
+        else:
+            _next_hops.update(self._host, self._port, version=res_version,
+                keep_alive=self._conn_reusable or res_version > 1.0)
+        if self._expect_waiting:
+            self._expect_abort()
+            if res_code == "417":
+                _next_hops.update(self._host, self._port, expect=False)
+        _next_hops.add_latency(self._host, self._port,
+                               push_tcp.now() - self._start_time)
+        self._hedge_settle()
         if self.read_timeout:
             self._read_timeout_ev = push_tcp.schedule(
                  self.read_timeout, self._input_error, 
                  ERR_READ_TIMEOUT, 'start'
             )
+        if self._timing:
+            self._timing.status = res_code
+            self._timing.mark('res_headers')
         self.res_body_cb, self.res_done_cb = self.res_start_cb(
             res_version, res_code, res_phrase, 
             hdr_tuples, self.res_body_pause
         )
         allows_body = (res_code not in no_body_status) \
-            or (self.method == "HEAD")
+            and (self.method != "HEAD")
+        if self.relay_bodies and allows_body and not transfer_codes:
+            # only if the body is going straight to a server response.
+            target = getattr(self.res_body_cb, 'im_self', None)
+            self._relay_to = getattr(target, 'res_body_relay', None)
         return allows_body 
 
+    def _handle_input(self, instr):
+        HttpMessageHandler._handle_input(self, instr)
+        if self._relay_to:
+            self._start_relay()
+
+    def _start_relay(self):
+        "Relay the rest of the response body, if it's still possible."
+        res_body_relay, self._relay_to = self._relay_to, None
+        if self._input_state != HEADERS_DONE or not self._tcp_conn \
+        or self._input_buffer:
+            return
+        if self._input_delimit == COUNTED:
+            length = self._input_body_left
+        elif self._input_delimit == CLOSE:
+            length = None
+        else:
+            return
+        if res_body_relay(self._tcp_conn, length, self._relay_done,
+                          self.read_timeout):
+            if self.read_timeout:
+                self._read_timeout_ev.delete()
+
+    def _relay_done(self, moved, err):
+        "The response body has been relayed."
+        if self._cancelled:
+            return
+        self.input_transfer_length += moved
+        if self._timing:
+            self._timing.mark('res_first_byte')
+            self._timing.marks['res_last_byte'] = time.time()
+            self._timing.bytes_in += moved
+        self._input_state = WAITING
+        if err == push_tcp.relay_timeout:
+            self._input_error(ERR_READ_TIMEOUT, 'body')
+        elif err:
+            self._input_error(ERR_CONNECT, err)
+        else:
+            if self._input_delimit == CLOSE:
+                self._conn_reusable = False
+            self._input_end()
+
     def _input_body(self, chunk):
         "Process a response body chunk from the wire."
         if self.read_timeout:
@@ -318,24 +698,42 @@ class Client(HttpMessageHandler):
                 # before the next request, we'll still get them.
                 _idle_pool.release(self._tcp_conn)
             else:
-                self._tcp_conn.close()
-                self._tcp_conn = None
+                _idle_pool.discard(self._tcp_conn, answered=True)
+            self._tcp_conn = None
+        self._res_finished = True
         self.res_done_cb(None)
+        if self._timing:
+            self._timing.finish(self.timing_sink)
 
     def _input_error(self, err, detail=None):
         "Indicate a parsing problem with the response body."
+        metrics.client_errors.inc(labels=(err['desc'],))
         if self.read_timeout:
             self._read_timeout_ev.delete()
         if self._tcp_conn:
-            self._tcp_conn.close()
+            _idle_pool.discard(self._tcp_conn, err is ERR_READ_TIMEOUT)
             self._tcp_conn = None
         err['detail'] = detail
+        self._res_finished = True
         self.res_done_cb(err)
+        if self._timing:
+            self._timing.finish(self.timing_sink, err)
 
     def _output(self, chunk):
         self._output_buffer.append(chunk)
+        if self._replay is not None:
+            # keep a copy of the request, in case we need to retry it.
+            self._replay.append(chunk)
+            self._replay_len += len(chunk)
+            if len(self._replay) > 1 and \
+            self._replay_len > self.retry_buffer:
+                self._replay = None
         if self._tcp_conn and self._tcp_conn.tcp_connected:
-            self._tcp_conn.write("".join(self._output_buffer))
+            data = "".join(self._output_buffer)
+            if self._timing and data:
+                self._timing.mark('req_headers')
+                self._timing.bytes_out += len(data)
+            self._tcp_conn.write(data)
             self._output_buffer = []
 
     # misc
@@ -346,10 +744,23 @@ class Client(HttpMessageHandler):
         response.
         """
         assert self._input_state == WAITING
+        if self._cancelled:
+            return
+        metrics.client_errors.inc(labels=(err['desc'],))
+        if self._hedge_peer or self._hedge_of:
+            # leave it to the other request.
+            other = self._hedge_peer or self._hedge_of
+            other._hedge_peer = other._hedge_of = None
+            if self._hedge_peer:
+                # the hedge now answers for this request.
+                other.res_start_cb = self.res_start_cb
+            self._cancel()
+            return
+        self._hedge_settle()
         if self._read_timeout_ev:
             self._read_timeout_ev.delete()
         if self._tcp_conn:
-            self._tcp_conn.close()
+            _idle_pool.discard(self._tcp_conn, err is ERR_READ_TIMEOUT)
             self._tcp_conn = None
         if detail:
             err['detail'] = detail
@@ -366,49 +777,398 @@ class Client(HttpMessageHandler):
         res_body_cb, res_done_cb = self.res_start_cb(
               "1.1", status_code, status_phrase, hdrs, dummy)
         res_body_cb(str(body))
+        self._res_finished = True
         push_tcp.schedule(0, res_done_cb, err)
+        if self._timing:
+            self._timing.finish(self.timing_sink, err)
 
 
 class _HttpConnectionPool:
-    "A pool of idle TCP connections for use by the client."
-    _conns = {}
+    """
+    A pool of TCP connections for use by the client.
+
+    At most max_conns connections (idle, in use or connecting) are open
+    to each origin; requests beyond that wait for a connection, first come
+    first served. Idle connections are closed after idle_timeout seconds,
+    or when there are more than max_idle of them for an origin. If
+    max_requests is set, connections are closed after that many requests.
+    """
+    max_conns = 16
+    max_idle = 8
+    idle_timeout = 60
+    max_requests = None
+    sweep_interval = 5
+
+    def __init__(self):
+        self._origins = {}
+        self._sweep_ev = None
+        self.stats = {
+            'hits': 0,          # requests given an idle connection
+            'misses': 0,        # requests that opened a new connection
+            'queued': 0,        # requests that had to wait
+            'queue_wait': 0.0,  # total seconds spent waiting
+            'queue_wait_max': 0.0,
+            'expired': 0,       # idle connections closed by the pool
+        }
 
     def attach(self, host, port, handle_connect, 
-        handle_connect_error, connect_timeout):
-        "Find an idle connection for (host, port), or create a new one."
-        while True:
-            try:
-                tcp_conn = self._conns[(host, port)].pop()
-            except (IndexError, KeyError):
-                push_tcp.create_client(host, port, 
-                    handle_connect, handle_connect_error, connect_timeout
-                )
-                break        
-            if tcp_conn.tcp_connected:
-                tcp_conn.read_cb, tcp_conn.close_cb, tcp_conn.pause_cb = \
-                    handle_connect(tcp_conn)
-                break
-        
+        handle_connect_error, connect_timeout, tls=None):
+        """
+        Find an idle connection for (host, port), create a new one, or
+        wait for one to become available. If tls (an ssl.SSLContext) is
+        given, the connection uses TLS.
+
+        If (host, port) is the authority of an upstream group, one of its
+        backends is used instead.
+        """
+        group = upstream.lookup(host, port)
+        if group:
+            backend = group.select()
+            if backend is None:
+                handle_connect_error((errno.EHOSTUNREACH,
+                    "No available upstream for %s:%s" % (host, port)))
+                return
+            host, port = backend.host, backend.port
+            backend.outstanding += 1
+            handle_connect, handle_connect_error = \
+                self._watch(backend, handle_connect, handle_connect_error)
+        origin = self._origin(host, port, tls)
+        now = push_tcp.now()
+        while origin.idle:
+            tcp_conn, idle_since = origin.idle.pop()
+            if tcp_conn.tcp_connected \
+            and now - idle_since < self.idle_timeout:
+                self.stats['hits'] += 1
+                self._hand_over(tcp_conn, handle_connect)
+                return
+            self._drop(origin, tcp_conn)
+        if origin.conns < self.max_conns:
+            self.stats['misses'] += 1
+            self._connect(origin, handle_connect, handle_connect_error,
+                          connect_timeout)
+        else:
+            self.stats['queued'] += 1
+            origin.waiting.append((handle_connect, handle_connect_error,
+                                   connect_timeout, now))
+
     def release(self, tcp_conn):
-        "Add an idle connection back to the pool."
-        if tcp_conn.tcp_connected:
-            def idle_close():
-                "Remove the connection from the pool when it closes."
-                try:
-                    self._conns[
-                        (tcp_conn.host, tcp_conn.port)
-                    ].remove(tcp_conn)
-                except ValueError:
-                    pass
-            tcp_conn.close_cb = idle_close
-            if not self._conns.has_key((tcp_conn.host, tcp_conn.port)):
-                self._conns[(tcp_conn.host, tcp_conn.port)] = [tcp_conn]
-            else:
-                self._conns[(tcp_conn.host, tcp_conn.port)].append(tcp_conn)
+        "Give a connection back to the pool, once a request is done with it."
+        self._done(tcp_conn, True)
+        origin = self._conn_origin(tcp_conn)
+        if not tcp_conn.tcp_connected or (self.max_requests and \
+        tcp_conn.pool_requests >= self.max_requests):
+            self._drop(origin, tcp_conn)
+            self._service(origin)
+            return
+        tcp_conn.pause(False) # the response may have left it paused.
+        if origin.waiting:
+            self.stats['hits'] += 1
+            self._hand_over(tcp_conn, self._next_waiting(origin)[0])
+        else:
+            tcp_conn.close_cb = self._idle(origin, tcp_conn)
+
+    def discard(self, tcp_conn, failed=False, answered=False):
+        """
+        Close a connection that a request is done with, and forget it. 
+        failed indicates that the server didn't respond in time; answered
+        that it sent a complete response.
+        """
+        if failed:
+            self._done(tcp_conn, False)
+        else:
+            self._done(tcp_conn, answered or None)
+        origin = self._conn_origin(tcp_conn)
+        self._drop(origin, tcp_conn)
+        self._service(origin)
+
+    def abandon(self, tcp_conn):
+        """
+        Close a connection whose request was given up on (e.g., a hedge
+        that lost), and forget it. This says nothing about the server's
+        health.
+        """
+        self._done(tcp_conn, None)
+        origin = self._conn_origin(tcp_conn)
+        self._drop(origin, tcp_conn)
+        self._service(origin)
+
+    def prewarm(self, host, port, num, connect_timeout=None, tls=None):
+        "Open up to num idle connections to (host, port) in advance."
+        hop = _next_hops.get(host, port)
+        if hop and not hop.keep_alive:
+            return # they'd only be good for one request anyway.
+        origin = self._origin(host, port, tls)
+        for i in range(min(num, self.max_conns - origin.conns)):
+            self._connect(origin, self._prewarmed, dummy, connect_timeout)
+
+    def origin_stats(self):
+        "Return a dictionary of (idle, open, waiting) counts per origin."
+        return dict([(k, (len(o.idle), o.conns, len(o.waiting)))
+                     for (k, o) in self._origins.items()])
+
+    # internals
+
+    def _origin(self, host, port, tls=None):
+        key = tls and (host, port, 'tls') or (host, port)
+        try:
+            origin = self._origins[key]
+        except KeyError:
+            origin = self._origins[key] = _PoolOrigin(key, tls)
+            return origin
+        if tls:
+            origin.tls = tls
+        return origin
+
+    def _conn_origin(self, tcp_conn):
+        "Return the origin that tcp_conn belongs to."
+        if tcp_conn.tls:
+            return self._origins[(tcp_conn.host, tcp_conn.port, 'tls')]
+        return self._origin(tcp_conn.host, tcp_conn.port)
+
+    def _watch(self, backend, handle_connect, handle_connect_error):
+        "Wrap connection callbacks to track backend's health."
+        def connected(tcp_conn):
+            tcp_conn.pool_backend = backend # until the request is done.
+            return handle_connect(tcp_conn)
+        def failed(err):
+            backend.outstanding -= 1
+            backend.failure()
+            handle_connect_error(err)
+        return connected, failed
+
+    def _done(self, tcp_conn, ok):
+        """
+        A request is done with tcp_conn; if it was sent to an upstream
+        group's backend, update the backend (unless ok is None).
+        """
+        backend = getattr(tcp_conn, 'pool_backend', None)
+        if backend:
+            tcp_conn.pool_backend = None
+            backend.outstanding = max(0, backend.outstanding - 1)
+            if ok:
+                backend.success()
+            elif ok is not None:
+                backend.failure()
+
+    def _connect(self, origin, handle_connect, handle_connect_error,
+                 connect_timeout):
+        "Open a new connection to origin."
+        origin.conns += 1
+        state = {'failed': False}
+        def connected(tcp_conn):
+            if state['failed']: # timed out; too late.
+                tcp_conn.close()
+                return dummy, dummy, dummy
+            tcp_conn.pool_requests = 0
+            return self._use(tcp_conn, handle_connect)
+        def failed(err):
+            if state['failed']:
+                return
+            state['failed'] = True
+            origin.conns -= 1
+            handle_connect_error(err)
+            self._service(origin)
+        push_tcp.create_client(origin.host, origin.port, 
+            connected, failed, connect_timeout, origin.tls
+        )
+
+    def _prewarmed(self, tcp_conn):
+        "A prewarmed connection is open; use or idle it."
+        origin = self._conn_origin(tcp_conn)
+        if origin.waiting:
+            self.stats['hits'] += 1
+            return self._use(tcp_conn, self._next_waiting(origin)[0])
+        return dummy, self._idle(origin, tcp_conn), dummy
+
+    def _use(self, tcp_conn, handle_connect):
+        "Give tcp_conn to a request; returns its callbacks."
+        tcp_conn.pool_requests += 1
+        return handle_connect(tcp_conn)
+
+    def _hand_over(self, tcp_conn, handle_connect):
+        "Give a connected tcp_conn to a request."
+        tcp_conn.read_cb, tcp_conn.close_cb, tcp_conn.pause_cb = \
+            self._use(tcp_conn, handle_connect)
+
+    def _idle(self, origin, tcp_conn):
+        "Add tcp_conn to origin's idle list; returns its close_cb."
+        origin.idle.append((tcp_conn, push_tcp.now()))
+        if len(origin.idle) > self.max_idle:
+            self.stats['expired'] += 1
+            self._drop(origin, origin.idle.pop(0)[0])
+        if self._sweep_ev is None:
+            self._sweep_ev = push_tcp.schedule(self.sweep_interval,
+                                               self._sweep)
+        def idle_close():
+            "Remove the connection from the pool when it closes."
+            for i in range(len(origin.idle)):
+                if origin.idle[i][0] is tcp_conn:
+                    del origin.idle[i]
+                    self._drop(origin, tcp_conn)
+                    break
+        return idle_close
+
+    def _drop(self, origin, tcp_conn):
+        "Close tcp_conn and stop counting it."
+        origin.conns -= 1
+        tcp_conn.close_cb = dummy
+        tcp_conn.close()
+
+    def _next_waiting(self, origin):
+        "Take the longest-waiting request for origin off the queue."
+        waiter = origin.waiting.pop(0)
+        wait = push_tcp.now() - waiter[3]
+        self.stats['queue_wait'] += wait
+        if wait > self.stats['queue_wait_max']:
+            self.stats['queue_wait_max'] = wait
+        return waiter
+
+    def _service(self, origin):
+        "Open connections for waiting requests, if there's room."
+        while origin.waiting and origin.conns < self.max_conns:
+            self.stats['misses'] += 1
+            self._connect(origin, *self._next_waiting(origin)[:3])
+
+    def _sweep(self):
+        "Close connections that have been idle for too long."
+        self._sweep_ev = None
+        deadline = push_tcp.now() - self.idle_timeout
+        idle = 0
+        for origin in self._origins.values():
+            while origin.idle and origin.idle[0][1] <= deadline:
+                self.stats['expired'] += 1
+                self._drop(origin, origin.idle.pop(0)[0])
+            idle += len(origin.idle)
+            if not (origin.idle or origin.conns or origin.waiting):
+                del self._origins[origin.key]
+        if idle:
+            self._sweep_ev = push_tcp.schedule(self.sweep_interval,
+                                               self._sweep)
+
+
+class _PoolOrigin:
+    "The connections and waiting requests for an origin."
+    def __init__(self, key, tls=None):
+        self.key = key
+        self.host, self.port = key[:2]
+        self.tls = tls # ssl.SSLContext, if the origin uses TLS
+        self.idle = [] # (tcp_conn, idle_since), oldest first
+        self.conns = 0 # idle, in use and connecting
+        self.waiting = [] # (handle_connect, handle_connect_error,
+                          #  connect_timeout, queued_at)
 
 _idle_pool = _HttpConnectionPool()
 
 
+class _NextHopCache:
+    """
+    What we've learnt about each next hop (host, port) from its responses,
+    so that requests can choose framing, keep-alive and Expect without
+    having to find out the hard way.
+
+    At most max_entries are kept (the least recently updated are forgotten
+    first), and entries are forgotten max_age seconds after their last
+    update. A next hop that didn't keep a connection alive, or didn't send
+    100 Continue, is tried again once every retry_after seconds, in case
+    that has changed.
+    """
+    max_entries = 1000
+    max_age = 60 * 60
+    max_latencies = 100
+
+    def __init__(self):
+        self._hops = {}
+
+    def get(self, host, port):
+        "Return the _NextHop for (host, port), or None if it isn't known."
+        hop = self._hops.get((host, port), None)
+        if hop and push_tcp.now() - hop.updated > self.max_age:
+            del self._hops[(host, port)]
+            return None
+        return hop
+
+    def update(self, host, port, **kw):
+        "Record what we've seen of (host, port)."
+        hop = self.get(host, port)
+        if hop is None:
+            if len(self._hops) >= self.max_entries:
+                oldest = min([(h.updated, k) for (k, h) 
+                              in self._hops.items()])[1]
+                del self._hops[oldest]
+            hop = self._hops[(host, port)] = _NextHop()
+        for (k, v) in kw.items():
+            setattr(hop, k, v)
+            if v is False:
+                hop.doubted[k] = push_tcp.now()
+        hop.updated = push_tcp.now()
+
+    def add_latency(self, host, port, latency):
+        "Record how long it took (host, port) to start a response."
+        self.update(host, port)
+        samples = self._hops[(host, port)].latencies
+        samples.append(latency)
+        if len(samples) > self.max_latencies:
+            del samples[0]
+
+    def clear(self):
+        "Forget everything."
+        self._hops = {}
+
+
+class _NextHop:
+    "The capabilities of a next hop."
+    retry_after = 60 * 5
+
+    def __init__(self):
+        self.version = 1.1
+        self.keep_alive = True
+        self.expect = None # True: sends 100 Continue, False: doesn't
+        self.latencies = [] # recent response start times, in seconds
+        self.updated = None
+        self.doubted = {} # capability -> when it was last found lacking
+
+    def use_keep_alive(self):
+        "Whether to ask for the connection to be kept alive."
+        return self.keep_alive or self._retry('keep_alive')
+
+    def use_expect(self):
+        "Whether it's worth sending Expect: 100-continue."
+        return self.version >= 1.1 and \
+            (self.expect is not False or self._retry('expect'))
+
+    def _retry(self, capability):
+        """
+        Whether it's time to try a capability that the next hop lacked;
+        if so, it isn't tried again for another retry_after seconds.
+        """
+        now = push_tcp.now()
+        if now - self.doubted.get(capability, 0) < self.retry_after:
+            return False
+        self.doubted[capability] = now
+        return True
+
+    def latency(self, percentile):
+        "Return the given percentile (0-100) of recent latencies."
+        ordered = sorted(self.latencies)
+        idx = int(round((len(ordered) - 1) * percentile / 100.0))
+        return ordered[idx]
+
+_next_hops = _NextHopCache()
+
+def prewarm(host, port, num, connect_timeout=None, tls=None):
+    """
+    Open up to num idle connections to (host, port) in advance, using TLS
+    if tls (an ssl.SSLContext) is given.
+    """
+    _idle_pool.prewarm(host, port, num, connect_timeout, tls)
+
+def pool_stats():
+    "Return a dictionary of connection pool statistics."
+    stats = _idle_pool.stats.copy()
+    stats['origins'] = _idle_pool.origin_stats()
+    return stats
+
+
 def test_client(request_uri, out, err):
     "A simple demonstration of a client."
 
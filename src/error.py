@@ -84,3 +84,14 @@ ERR_CONNECT = {
 ERR_HOST_REQ = {
     'desc': "Host header required",
 }
+
+ERR_REQ_TIMEOUT = {
+    'desc': "Request timeout",
+    'status': ("408", "Request Timeout"),
+}
+
+# HTTP/2 errors
+
+ERR_STREAM_RESET = {
+    'desc': "HTTP/2 stream reset",
+}
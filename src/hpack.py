@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+
+"""
+HPACK header compression for HTTP/2 (RFC 7541)
+
+> encoder = Encoder()
+> block = encoder.encode([(":status", "200"), ("content-type", "text/html")])
+> decoder = Decoder()
+> hdr_tuples = decoder.decode(block)
+
+Each side of a connection keeps its own Encoder and Decoder, since each
+has a dynamic table that lives as long as the connection. Decoder raises
+ValueError if a header block can't be decoded; the connection is then
+unusable.
+
+The encoder adds headers to its dynamic table so that they can be sent as
+an index next time, except for those in no_index (which change too often
+to be worth it) and never_index (which are sensitive, and which
+intermediaries are asked not to index either). Strings are Huffman coded
+when that makes them shorter.
+
+Header names are expected to be lowercase.
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from collections import deque
+
+default_table_size = 4096
+entry_overhead = 32 # bytes counted for each table entry, besides its strings
+
+_static_table = [
+    (":authority", ""),
+    (":method", "GET"),
+    (":method", "POST"),
+    (":path", "/"),
+    (":path", "/index.html"),
+    (":scheme", "http"),
+    (":scheme", "https"),
+    (":status", "200"),
+    (":status", "204"),
+    (":status", "206"),
+    (":status", "304"),
+    (":status", "400"),
+    (":status", "404"),
+    (":status", "500"),
+    ("accept-charset", ""),
+    ("accept-encoding", "gzip, deflate"),
+    ("accept-language", ""),
+    ("accept-ranges", ""),
+    ("accept", ""),
+    ("access-control-allow-origin", ""),
+    ("age", ""),
+    ("allow", ""),
+    ("authorization", ""),
+    ("cache-control", ""),
+    ("content-disposition", ""),
+    ("content-encoding", ""),
+    ("content-language", ""),
+    ("content-length", ""),
+    ("content-location", ""),
+    ("content-range", ""),
+    ("content-type", ""),
+    ("cookie", ""),
+    ("date", ""),
+    ("etag", ""),
+    ("expect", ""),
+    ("expires", ""),
+    ("from", ""),
+    ("host", ""),
+    ("if-match", ""),
+    ("if-modified-since", ""),
+    ("if-none-match", ""),
+    ("if-range", ""),
+    ("if-unmodified-since", ""),
+    ("last-modified", ""),
+    ("link", ""),
+    ("location", ""),
+    ("max-forwards", ""),
+    ("proxy-authenticate", ""),
+    ("proxy-authorization", ""),
+    ("range", ""),
+    ("referer", ""),
+    ("refresh", ""),
+    ("retry-after", ""),
+    ("server", ""),
+    ("set-cookie", ""),
+    ("strict-transport-security", ""),
+    ("transfer-encoding", ""),
+    ("user-agent", ""),
+    ("vary", ""),
+    ("via", ""),
+    ("www-authenticate", ""),
+]
+
+_huffman_codes = [ # (code, bit length) for each symbol; 256 is EOS
+    (0x1ff8, 13), (0x7fffd8, 23), (0xfffffe2, 28), (0xfffffe3, 28),
+    (0xfffffe4, 28), (0xfffffe5, 28), (0xfffffe6, 28), (0xfffffe7, 28),
+    (0xfffffe8, 28), (0xffffea, 24), (0x3ffffffc, 30), (0xfffffe9, 28),
+    (0xfffffea, 28), (0x3ffffffd, 30), (0xfffffeb, 28), (0xfffffec, 28),
+    (0xfffffed, 28), (0xfffffee, 28), (0xfffffef, 28), (0xffffff0, 28),
+    (0xffffff1, 28), (0xffffff2, 28), (0x3ffffffe, 30), (0xffffff3, 28),
+    (0xffffff4, 28), (0xffffff5, 28), (0xffffff6, 28), (0xffffff7, 28),
+    (0xffffff8, 28), (0xffffff9, 28), (0xffffffa, 28), (0xffffffb, 28),
+    (0x14, 6), (0x3f8, 10), (0x3f9, 10), (0xffa, 12), (0x1ff9, 13), (0x15, 6),
+    (0xf8, 8), (0x7fa, 11), (0x3fa, 10), (0x3fb, 10), (0xf9, 8), (0x7fb, 11),
+    (0xfa, 8), (0x16, 6), (0x17, 6), (0x18, 6), (0x0, 5), (0x1, 5), (0x2, 5),
+    (0x19, 6), (0x1a, 6), (0x1b, 6), (0x1c, 6), (0x1d, 6), (0x1e, 6),
+    (0x1f, 6), (0x5c, 7), (0xfb, 8), (0x7ffc, 15), (0x20, 6), (0xffb, 12),
+    (0x3fc, 10), (0x1ffa, 13), (0x21, 6), (0x5d, 7), (0x5e, 7), (0x5f, 7),
+    (0x60, 7), (0x61, 7), (0x62, 7), (0x63, 7), (0x64, 7), (0x65, 7),
+    (0x66, 7), (0x67, 7), (0x68, 7), (0x69, 7), (0x6a, 7), (0x6b, 7),
+    (0x6c, 7), (0x6d, 7), (0x6e, 7), (0x6f, 7), (0x70, 7), (0x71, 7),
+    (0x72, 7), (0xfc, 8), (0x73, 7), (0xfd, 8), (0x1ffb, 13), (0x7fff0, 19),
+    (0x1ffc, 13), (0x3ffc, 14), (0x22, 6), (0x7ffd, 15), (0x3, 5), (0x23, 6),
+    (0x4, 5), (0x24, 6), (0x5, 5), (0x25, 6), (0x26, 6), (0x27, 6), (0x6, 5),
+    (0x74, 7), (0x75, 7), (0x28, 6), (0x29, 6), (0x2a, 6), (0x7, 5), (0x2b, 6),
+    (0x76, 7), (0x2c, 6), (0x8, 5), (0x9, 5), (0x2d, 6), (0x77, 7), (0x78, 7),
+    (0x79, 7), (0x7a, 7), (0x7b, 7), (0x7ffe, 15), (0x7fc, 11), (0x3ffd, 14),
+    (0x1ffd, 13), (0xffffffc, 28), (0xfffe6, 20), (0x3fffd2, 22),
+    (0xfffe7, 20), (0xfffe8, 20), (0x3fffd3, 22), (0x3fffd4, 22),
+    (0x3fffd5, 22), (0x7fffd9, 23), (0x3fffd6, 22), (0x7fffda, 23),
+    (0x7fffdb, 23), (0x7fffdc, 23), (0x7fffdd, 23), (0x7fffde, 23),
+    (0xffffeb, 24), (0x7fffdf, 23), (0xffffec, 24), (0xffffed, 24),
+    (0x3fffd7, 22), (0x7fffe0, 23), (0xffffee, 24), (0x7fffe1, 23),
+    (0x7fffe2, 23), (0x7fffe3, 23), (0x7fffe4, 23), (0x1fffdc, 21),
+    (0x3fffd8, 22), (0x7fffe5, 23), (0x3fffd9, 22), (0x7fffe6, 23),
+    (0x7fffe7, 23), (0xffffef, 24), (0x3fffda, 22), (0x1fffdd, 21),
+    (0xfffe9, 20), (0x3fffdb, 22), (0x3fffdc, 22), (0x7fffe8, 23),
+    (0x7fffe9, 23), (0x1fffde, 21), (0x7fffea, 23), (0x3fffdd, 22),
+    (0x3fffde, 22), (0xfffff0, 24), (0x1fffdf, 21), (0x3fffdf, 22),
+    (0x7fffeb, 23), (0x7fffec, 23), (0x1fffe0, 21), (0x1fffe1, 21),
+    (0x3fffe0, 22), (0x1fffe2, 21), (0x7fffed, 23), (0x3fffe1, 22),
+    (0x7fffee, 23), (0x7fffef, 23), (0xfffea, 20), (0x3fffe2, 22),
+    (0x3fffe3, 22), (0x3fffe4, 22), (0x7ffff0, 23), (0x3fffe5, 22),
+    (0x3fffe6, 22), (0x7ffff1, 23), (0x3ffffe0, 26), (0x3ffffe1, 26),
+    (0xfffeb, 20), (0x7fff1, 19), (0x3fffe7, 22), (0x7ffff2, 23),
+    (0x3fffe8, 22), (0x1ffffec, 25), (0x3ffffe2, 26), (0x3ffffe3, 26),
+    (0x3ffffe4, 26), (0x7ffffde, 27), (0x7ffffdf, 27), (0x3ffffe5, 26),
+    (0xfffff1, 24), (0x1ffffed, 25), (0x7fff2, 19), (0x1fffe3, 21),
+    (0x3ffffe6, 26), (0x7ffffe0, 27), (0x7ffffe1, 27), (0x3ffffe7, 26),
+    (0x7ffffe2, 27), (0xfffff2, 24), (0x1fffe4, 21), (0x1fffe5, 21),
+    (0x3ffffe8, 26), (0x3ffffe9, 26), (0xffffffd, 28), (0x7ffffe3, 27),
+    (0x7ffffe4, 27), (0x7ffffe5, 27), (0xfffec, 20), (0xfffff3, 24),
+    (0xfffed, 20), (0x1fffe6, 21), (0x3fffe9, 22), (0x1fffe7, 21),
+    (0x1fffe8, 21), (0x7ffff3, 23), (0x3fffea, 22), (0x3fffeb, 22),
+    (0x1ffffee, 25), (0x1ffffef, 25), (0xfffff4, 24), (0xfffff5, 24),
+    (0x3ffffea, 26), (0x7ffff4, 23), (0x3ffffeb, 26), (0x7ffffe6, 27),
+    (0x3ffffec, 26), (0x3ffffed, 26), (0x7ffffe7, 27), (0x7ffffe8, 27),
+    (0x7ffffe9, 27), (0x7ffffea, 27), (0x7ffffeb, 27), (0xffffffe, 28),
+    (0x7ffffec, 27), (0x7ffffed, 27), (0x7ffffee, 27), (0x7ffffef, 27),
+    (0x7fffff0, 27), (0x3ffffee, 26), (0x3fffffff, 30),
+]
+
+_static_index = {} # (name, value) -> index
+_static_names = {} # name -> index
+for _i in range(len(_static_table) - 1, -1, -1):
+    _static_index[_static_table[_i]] = _i + 1
+    _static_names[_static_table[_i][0]] = _i + 1
+_static_len = len(_static_table)
+
+
+def encode_int(value, prefix_bits, flags=0):
+    "Encode value as an integer with an prefix_bits prefix, ORed with flags."
+    limit = (1 << prefix_bits) - 1
+    if value < limit:
+        return chr(flags | value)
+    out = [chr(flags | limit)]
+    value -= limit
+    while value >= 128:
+        out.append(chr((value & 127) | 128))
+        value >>= 7
+    out.append(chr(value))
+    return "".join(out)
+
+def decode_int(data, pos, prefix_bits):
+    "Decode the integer at data[pos]; return (value, position after it)."
+    limit = (1 << prefix_bits) - 1
+    try:
+        value = ord(data[pos]) & limit
+        pos += 1
+        if value < limit:
+            return value, pos
+        shift = 0
+        while True:
+            byte = ord(data[pos])
+            pos += 1
+            value += (byte & 127) << shift
+            if not byte & 128:
+                return value, pos
+            shift += 7
+            if shift > 28:
+                raise ValueError, "Integer too large"
+    except IndexError:
+        raise ValueError, "Truncated integer"
+
+def encode_str(value):
+    "Encode a string literal, Huffman coded if that's shorter."
+    length = huffman_length(value)
+    if length < len(value):
+        return encode_int(length, 7, 128) + huffman_encode(value)
+    return encode_int(len(value), 7) + value
+
+def decode_str(data, pos):
+    "Decode the string literal at data[pos]; return (value, next position)."
+    if pos >= len(data):
+        raise ValueError, "Truncated string"
+    huffman = ord(data[pos]) & 128
+    length, pos = decode_int(data, pos, 7)
+    end = pos + length
+    if end > len(data):
+        raise ValueError, "Truncated string"
+    if huffman:
+        return huffman_decode(data[pos:end]), end
+    return data[pos:end], end
+
+
+def huffman_length(value):
+    "Return the number of bytes value takes when Huffman coded."
+    bits = 0
+    for char in value:
+        bits += _huffman_codes[ord(char)][1]
+    return (bits + 7) >> 3
+
+def huffman_encode(value):
+    out = []
+    bits = 0
+    nbits = 0
+    for char in value:
+        code, length = _huffman_codes[ord(char)]
+        bits = (bits << length) | code
+        nbits += length
+        while nbits >= 8:
+            nbits -= 8
+            out.append(chr((bits >> nbits) & 255))
+        bits &= (1 << nbits) - 1
+    if nbits: # pad with the most significant bits of EOS (all ones)
+        out.append(chr(((bits << (8 - nbits)) | (255 >> nbits)) & 255))
+    return "".join(out)
+
+def huffman_decode(value):
+    out = []
+    state = 0
+    table = _decode_table
+    for char in value:
+        byte = ord(char)
+        for nibble in (byte >> 4, byte & 15):
+            state, emit = table[(state << 4) | nibble]
+            if state is None:
+                raise ValueError, "Invalid Huffman code"
+            if emit:
+                out.append(emit)
+    if not _accepting[state]:
+        raise ValueError, "Invalid Huffman padding"
+    return "".join(out)
+
+def _build_decode_table():
+    """
+    Build a table for decoding Huffman codes four bits at a time. Each
+    state is a node in the code tree; for each state and nibble, the table
+    holds the next state and any characters decoded on the way. A state
+    of None means an invalid code (e.g., EOS).
+    """
+    children = [[None, None]] # node -> [child for 0, child for 1]
+    depth = [0]
+    all_ones = [True]
+    leaves = {} # (node, bit) -> symbol
+    for symbol, (code, length) in enumerate(_huffman_codes):
+        node = 0
+        for i in range(length - 1, -1, -1):
+            bit = (code >> i) & 1
+            if i == 0:
+                leaves[(node, bit)] = symbol
+                break
+            if children[node][bit] is None:
+                children[node][bit] = len(children)
+                children.append([None, None])
+                depth.append(depth[node] + 1)
+                all_ones.append(all_ones[node] and bit == 1)
+            node = children[node][bit]
+    table = []
+    for node in range(len(children)):
+        for nibble in range(16):
+            state = node
+            emit = []
+            for i in (3, 2, 1, 0):
+                bit = (nibble >> i) & 1
+                if leaves.has_key((state, bit)):
+                    symbol = leaves[(state, bit)]
+                    if symbol == 256: # EOS
+                        state = None
+                        break
+                    emit.append(chr(symbol))
+                    state = 0
+                else:
+                    state = children[state][bit]
+            table.append((state, "".join(emit)))
+    accepting = [node == 0 or (all_ones[node] and depth[node] < 8)
+                 for node in range(len(children))]
+    return table, accepting
+
+_decode_table, _accepting = _build_decode_table()
+
+
+class _Table:
+    "A dynamic table, newest entry first."
+    def __init__(self, max_size=default_table_size):
+        self.entries = deque()
+        self.size = 0
+        self.max_size = max_size
+        self.inserted = 0 # entries ever added
+
+    def get(self, index):
+        "Return the (name, value) at index (in the combined index space)."
+        if index < 1:
+            raise ValueError, "Invalid header index 0"
+        if index <= _static_len:
+            return _static_table[index - 1]
+        try:
+            return self.entries[index - _static_len - 1]
+        except IndexError:
+            raise ValueError, "Invalid header index %s" % index
+
+    def add(self, name, value):
+        size = len(name) + len(value) + entry_overhead
+        if size > self.max_size:
+            self.evict(0)
+            return False
+        self.evict(self.max_size - size)
+        self.entries.appendleft((name, value))
+        self.size += size
+        self.inserted += 1
+        return True
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self.evict(max_size)
+
+    def evict(self, max_size):
+        "Drop the oldest entries until the table is no bigger than max_size."
+        while self.size > max_size:
+            name, value = self.entries.pop()
+            self.size -= len(name) + len(value) + entry_overhead
+            self.evicted(name, value)
+
+    def evicted(self, name, value):
+        pass
+
+
+class Encoder(_Table):
+    "Encodes header blocks."
+    no_index = [':path', 'content-length', 'date', 'etag', 'last-modified',
+                'age', 'expires', 'location', 'content-range']
+    never_index = ['authorization', 'proxy-authorization', 'cookie',
+                   'set-cookie']
+
+    def __init__(self, max_size=default_table_size):
+        _Table.__init__(self, max_size)
+        self._index = {} # (name, value) -> insertion number
+        self._names = {} # name -> insertion number
+        self._size_update = None
+
+    def set_max_table_size(self, max_size):
+        "The peer has changed the table size (SETTINGS_HEADER_TABLE_SIZE)."
+        if max_size < self.max_size:
+            self.resize(max_size)
+            self._size_update = max_size
+
+    def encode(self, hdr_tuples):
+        "Return a header block for a list of (name, value) tuples."
+        out = []
+        if self._size_update is not None:
+            out.append(encode_int(self._size_update, 5, 32))
+            self._size_update = None
+        for name, value in hdr_tuples:
+            index = _static_index.get((name, value), None) or \
+                self._dynamic(self._index.get((name, value), None))
+            if index:
+                out.append(encode_int(index, 7, 128))
+                continue
+            name_index = _static_names.get(name, None) or \
+                self._dynamic(self._names.get(name, None))
+            if name in self.never_index:
+                prefix, flags = 4, 16
+            elif name in self.no_index:
+                prefix, flags = 4, 0
+            else:
+                prefix, flags = 6, 64
+            if name_index:
+                out.append(encode_int(name_index, prefix, flags))
+            else:
+                out.append(chr(flags))
+                out.append(encode_str(name))
+            out.append(encode_str(value))
+            if flags == 64 and self.add(name, value):
+                self._index[(name, value)] = self.inserted
+                self._names[name] = self.inserted
+        return "".join(out)
+
+    def _dynamic(self, inserted):
+        "Return the index of the entry with that insertion number, or None."
+        if inserted is None:
+            return None
+        return _static_len + self.inserted - inserted + 1
+
+    def evicted(self, name, value):
+        oldest = self.inserted - len(self.entries)
+        if self._index.get((name, value), None) == oldest:
+            del self._index[(name, value)]
+        if self._names.get(name, None) == oldest:
+            del self._names[name]
+
+
+class Decoder(_Table):
+    "Decodes header blocks."
+    def __init__(self, max_size=default_table_size):
+        _Table.__init__(self, max_size)
+        self.settings_max_size = max_size
+
+    def decode(self, data):
+        "Return a list of (name, value) tuples for a header block."
+        hdr_tuples = []
+        pos = 0
+        end = len(data)
+        while pos < end:
+            byte = ord(data[pos])
+            if byte & 128: # indexed
+                index, pos = decode_int(data, pos, 7)
+                hdr_tuples.append(self.get(index))
+                continue
+            if byte & 64: # literal, with incremental indexing
+                index, pos = decode_int(data, pos, 6)
+                indexing = True
+            elif byte & 32: # dynamic table size update
+                size, pos = decode_int(data, pos, 5)
+                if size > self.settings_max_size:
+                    raise ValueError, "Table size update too large"
+                self.resize(size)
+                continue
+            else: # literal, without (or never) indexing
+                index, pos = decode_int(data, pos, 4)
+                indexing = False
+            if index:
+                name = self.get(index)[0]
+            else:
+                name, pos = decode_str(data, pos)
+            value, pos = decode_str(data, pos)
+            hdr_tuples.append((name, value))
+            if indexing:
+                self.add(name, value)
+        return hdr_tuples
@@ -0,0 +1,637 @@
+#!/usr/bin/env python
+
+"""
+HTTP/2 for Server (RFC 7540, cleartext)
+
+If http2 is set on a Server, clients can use HTTP/2 without TLS ("h2c"),
+either by starting the connection with the HTTP/2 preface ("prior
+knowledge"), or by asking to switch with Upgrade: h2c on an HTTP/1.1
+request that has no body. Either way, the connection is then handled by an
+Http2ServerConnection, which presents each stream to the Server's
+request_handler exactly as an HTTP/1 request would be (with the request's
+:authority as a Host header), so applications don't need to change; many
+requests can be in progress on one connection at once.
+
+Request bodies are flow controlled per stream; while an application has
+paused a request body, the client isn't given any more window for that
+stream. Response bodies are sent as the client's flow control windows
+allow, and a stream's res_body_pause is called with True when more than
+stream_write_high bytes are waiting to be sent on it (or the connection
+itself is full), and False once it can take more.
+
+Server push, priorities and CONNECT (which gets passed to request_handler
+like any other method) aren't supported.
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import base64
+import logging
+import socket
+import struct
+import time
+
+import metrics
+from hpack import Encoder, Decoder
+from http_common import hop_by_hop_hdrs, no_body_status
+from error import ERR_STREAM_RESET
+
+log = logging.getLogger('http2')
+
+preface = "PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+
+# frame types
+DATA, HEADERS, PRIORITY, RST_STREAM, SETTINGS, PUSH_PROMISE, PING, \
+    GOAWAY, WINDOW_UPDATE, CONTINUATION = range(10)
+
+# flags
+END_STREAM = ACK = 0x1
+END_HEADERS = 0x4
+PADDED = 0x8
+PRIORITY_FLAG = 0x20
+
+# settings
+SETTINGS_HEADER_TABLE_SIZE, SETTINGS_ENABLE_PUSH, \
+    SETTINGS_MAX_CONCURRENT_STREAMS, SETTINGS_INITIAL_WINDOW_SIZE, \
+    SETTINGS_MAX_FRAME_SIZE, SETTINGS_MAX_HEADER_LIST_SIZE = range(1, 7)
+
+# error codes
+NO_ERROR, PROTOCOL_ERROR, INTERNAL_ERROR, FLOW_CONTROL_ERROR, \
+    SETTINGS_TIMEOUT, STREAM_CLOSED, FRAME_SIZE_ERROR, REFUSED_STREAM, \
+    CANCEL, COMPRESSION_ERROR = range(10)
+
+default_window = 65535
+default_frame_size = 16384
+max_window = 2 ** 31 - 1
+
+_frame_hdr = struct.Struct("!IBI") # length << 8 | type, flags, stream id
+_setting = struct.Struct("!HI")
+_uint32 = struct.Struct("!I")
+
+# headers that mustn't be sent in HTTP/2
+_strip_hdrs = hop_by_hop_hdrs + ['host', 'proxy-connection']
+
+
+class _ConnectionError(Exception):
+    "A problem that means the connection has to be closed."
+    def __init__(self, code, detail):
+        Exception.__init__(self, detail)
+        self.code = code
+
+
+class Http2ServerConnection:
+    "A handler for an HTTP/2 server connection."
+    max_streams = 100
+    initial_window = default_window # for each request body
+    conn_window = 1024 * 1024 # for all request bodies on the connection
+    max_frame_size = default_frame_size
+    max_header_block = 1024 * 64
+    stream_write_high = 1024 * 64
+
+    def __init__(self, tcp_conn, request_handler, server=None,
+                 access_log=None, upgrade=None):
+        """
+        Take over tcp_conn. If upgrade is given, it's the (method, uri,
+        req_hdrs, settings) of the HTTP/1.1 request that asked to switch,
+        which becomes stream 1.
+        """
+        self._tcp_conn = tcp_conn
+        self.request_handler = request_handler
+        self.server = server
+        self.access_log = access_log
+        self._remote = None
+        if access_log:
+            try:
+                self._remote = tcp_conn.socket.getpeername()[0]
+            except (socket.error, AttributeError):
+                pass
+        self._buf = ""
+        self._preface = True # still waiting for the client's
+        self._streams = {}
+        self._last_stream = 0
+        self._headers = None # (stream id, flags, fragments) in progress
+        self._encoder = Encoder()
+        self._decoder = Decoder()
+        self._send_window = default_window
+        self._recv_window = self.conn_window
+        self._recv_unacked = 0
+        self._peer_window = default_window # initial window for streams
+        self._peer_frame_size = default_frame_size
+        self._blocked = [] # streams waiting for the connection's window
+        self._write_paused = False
+        self._goaway = False
+        self._deadline = None
+        tcp_conn.read_cb = self.handle_input
+        tcp_conn.close_cb = self._conn_closed
+        tcp_conn.pause_cb = self._write_pause
+        if server:
+            server._conns[self] = None
+        self._send_frame(SETTINGS, 0, 0, "".join([
+            _setting.pack(SETTINGS_MAX_CONCURRENT_STREAMS, self.max_streams),
+            _setting.pack(SETTINGS_INITIAL_WINDOW_SIZE, self.initial_window),
+            _setting.pack(SETTINGS_MAX_FRAME_SIZE, self.max_frame_size),
+        ]))
+        if self.conn_window > default_window:
+            self._send_frame(WINDOW_UPDATE, 0, 0,
+                             _uint32.pack(self.conn_window - default_window))
+        if upgrade:
+            method, uri, req_hdrs, settings = upgrade
+            try:
+                self._settings(base64.urlsafe_b64decode(
+                    settings + "=" * (-len(settings) % 4)))
+            except (TypeError, _ConnectionError):
+                pass # just use the defaults
+            self._last_stream = 1
+            self._start_stream(1, method, uri, req_hdrs, True)
+        elif server:
+            server._conn_idle(self)
+
+    def __repr__(self):
+        return "<Http2ServerConnection %s streams at %#x>" % (
+            len(self._streams), id(self))
+
+    def close(self, code=NO_ERROR, detail=""):
+        "Close the connection, telling the client why."
+        if self._tcp_conn:
+            self._send_frame(GOAWAY, 0, 0, _uint32.pack(self._last_stream) +
+                             _uint32.pack(code) + detail)
+            tcp_conn, self._tcp_conn = self._tcp_conn, None
+            tcp_conn.close()
+        self._gone()
+
+    def handle_input(self, data):
+        "Process data from the client."
+        buf = self._buf and self._buf + data or data
+        pos = 0
+        try:
+            if self._preface:
+                if len(buf) < len(preface):
+                    if preface[:len(buf)] != buf:
+                        raise _ConnectionError(PROTOCOL_ERROR, "preface")
+                    self._buf = buf
+                    return
+                if buf[:len(preface)] != preface:
+                    raise _ConnectionError(PROTOCOL_ERROR, "preface")
+                self._preface = False
+                pos = len(preface)
+            end = len(buf)
+            while self._tcp_conn and end - pos >= 9:
+                length_type, flags, stream_id = \
+                    _frame_hdr.unpack_from(buf, pos)
+                length = length_type >> 8
+                if length > self.max_frame_size:
+                    raise _ConnectionError(FRAME_SIZE_ERROR, "frame size")
+                if end - pos - 9 < length:
+                    break
+                self._frame(length_type & 255, flags, stream_id & max_window,
+                            buf[pos + 9:pos + 9 + length])
+                pos += 9 + length
+        except _ConnectionError, why:
+            log.info("%s closing: %s" % (id(self), why))
+            self._buf = ""
+            self.close(why.code, str(why))
+            return
+        self._buf = buf[pos:]
+        if self._tcp_conn and self._recv_unacked >= self.conn_window / 2:
+            self._send_frame(WINDOW_UPDATE, 0, 0,
+                             _uint32.pack(self._recv_unacked))
+            self._recv_window += self._recv_unacked
+            self._recv_unacked = 0
+
+    # Frames from the client
+
+    def _frame(self, frame_type, flags, stream_id, payload):
+        if self._headers is not None and frame_type != CONTINUATION:
+            raise _ConnectionError(PROTOCOL_ERROR, "expected CONTINUATION")
+        if frame_type == DATA:
+            self._data(flags, stream_id, payload)
+        elif frame_type == HEADERS:
+            if stream_id == 0 or stream_id % 2 == 0:
+                raise _ConnectionError(PROTOCOL_ERROR, "bad stream id")
+            payload = _unpad(flags, payload)
+            if flags & PRIORITY_FLAG:
+                payload = payload[5:]
+            if flags & END_HEADERS:
+                self._header_block(stream_id, flags, payload)
+            else:
+                self._headers = (stream_id, flags, [payload])
+        elif frame_type == CONTINUATION:
+            if self._headers is None or self._headers[0] != stream_id:
+                raise _ConnectionError(PROTOCOL_ERROR, "bad CONTINUATION")
+            fragments = self._headers[2]
+            fragments.append(payload)
+            if sum([len(f) for f in fragments]) > self.max_header_block:
+                raise _ConnectionError(PROTOCOL_ERROR, "headers too big")
+            if flags & END_HEADERS:
+                stream_id, flags, fragments = self._headers
+                self._headers = None
+                self._header_block(stream_id, flags, "".join(fragments))
+        elif frame_type == WINDOW_UPDATE:
+            if len(payload) != 4:
+                raise _ConnectionError(FRAME_SIZE_ERROR, "WINDOW_UPDATE")
+            self._window_update(stream_id,
+                                _uint32.unpack(payload)[0] & max_window)
+        elif frame_type == SETTINGS:
+            if stream_id != 0:
+                raise _ConnectionError(PROTOCOL_ERROR, "SETTINGS stream")
+            if not flags & ACK:
+                self._settings(payload)
+                self._send_frame(SETTINGS, ACK, 0, "")
+        elif frame_type == RST_STREAM:
+            if stream_id == 0 or len(payload) != 4:
+                raise _ConnectionError(PROTOCOL_ERROR, "bad RST_STREAM")
+            stream = self._streams.get(stream_id, None)
+            if stream:
+                stream.reset(ERR_STREAM_RESET, None) # no RST_STREAM back
+        elif frame_type == PING:
+            if len(payload) != 8:
+                raise _ConnectionError(FRAME_SIZE_ERROR, "PING")
+            if not flags & ACK:
+                self._send_frame(PING, ACK, 0, payload)
+        elif frame_type == GOAWAY:
+            self._goaway = True
+            if not self._streams:
+                self.close()
+        elif frame_type == PUSH_PROMISE:
+            raise _ConnectionError(PROTOCOL_ERROR, "PUSH_PROMISE")
+        # PRIORITY and unknown frame types are ignored.
+
+    def _data(self, flags, stream_id, payload):
+        if stream_id == 0:
+            raise _ConnectionError(PROTOCOL_ERROR, "DATA on stream 0")
+        self._recv_window -= len(payload)
+        if self._recv_window < 0:
+            raise _ConnectionError(FLOW_CONTROL_ERROR, "connection window")
+        self._recv_unacked += len(payload)
+        stream = self._streams.get(stream_id, None)
+        if stream is None or stream.req_complete:
+            if stream_id > self._last_stream:
+                raise _ConnectionError(PROTOCOL_ERROR, "idle stream")
+            self._reset(stream_id, STREAM_CLOSED)
+            return
+        stream.recv_window -= len(payload)
+        if stream.recv_window < 0:
+            stream.reset(ERR_STREAM_RESET, FLOW_CONTROL_ERROR)
+            return
+        stream.recv_unacked += len(payload)
+        chunk = _unpad(flags, payload)
+        if chunk:
+            stream.req_body_cb(chunk)
+        if flags & END_STREAM:
+            stream.req_end()
+        else:
+            stream.ack()
+
+    def _header_block(self, stream_id, flags, block):
+        try:
+            hdr_tuples = self._decoder.decode(block)
+        except ValueError, why:
+            raise _ConnectionError(COMPRESSION_ERROR, str(why))
+        stream = self._streams.get(stream_id, None)
+        if stream is not None: # trailers
+            if stream.req_complete or not flags & END_STREAM:
+                raise _ConnectionError(PROTOCOL_ERROR, "unexpected HEADERS")
+            stream.req_end()
+            return
+        if stream_id <= self._last_stream:
+            raise _ConnectionError(STREAM_CLOSED, "stream already used")
+        self._last_stream = stream_id
+        if self._goaway or len(self._streams) >= self.max_streams:
+            self._reset(stream_id, REFUSED_STREAM)
+            return
+        method = path = authority = None
+        req_hdrs = []
+        cookies = []
+        for name, value in hdr_tuples:
+            if name[:1] == ":":
+                if req_hdrs:
+                    method = None # pseudo-headers must come first
+                    break
+                if name == ":method":
+                    method = value
+                elif name == ":path":
+                    path = value
+                elif name == ":authority":
+                    authority = value
+            elif name in _strip_hdrs and name != 'host' \
+            and (name != 'te' or value != 'trailers'):
+                method = None
+                break
+            elif name == 'cookie':
+                cookies.append(value)
+            else:
+                req_hdrs.append((name, value))
+        if method == "CONNECT":
+            path = authority
+        if method is None or not path:
+            self._reset(stream_id, PROTOCOL_ERROR)
+            return
+        if cookies:
+            req_hdrs.append(("cookie", "; ".join(cookies)))
+        if authority and 'host' not in [n for (n, v) in req_hdrs]:
+            req_hdrs.insert(0, ("Host", authority))
+        self._start_stream(stream_id, method, path, req_hdrs,
+                           flags & END_STREAM)
+
+    def _window_update(self, stream_id, increment):
+        if stream_id == 0:
+            if increment == 0:
+                raise _ConnectionError(PROTOCOL_ERROR, "empty WINDOW_UPDATE")
+            self._send_window += increment
+            if self._send_window > max_window:
+                raise _ConnectionError(FLOW_CONTROL_ERROR, "window too big")
+            blocked, self._blocked = self._blocked, []
+            for stream in blocked:
+                stream.flush()
+            return
+        stream = self._streams.get(stream_id, None)
+        if stream is None:
+            return
+        if increment == 0:
+            stream.reset(ERR_STREAM_RESET, PROTOCOL_ERROR)
+            return
+        stream.send_window += increment
+        if stream.send_window > max_window:
+            stream.reset(ERR_STREAM_RESET, FLOW_CONTROL_ERROR)
+            return
+        stream.flush()
+
+    def _settings(self, payload):
+        if len(payload) % 6:
+            raise _ConnectionError(FRAME_SIZE_ERROR, "SETTINGS")
+        grown = False
+        for i in range(0, len(payload), 6):
+            ident, value = _setting.unpack_from(payload, i)
+            if ident == SETTINGS_HEADER_TABLE_SIZE:
+                self._encoder.set_max_table_size(value)
+            elif ident == SETTINGS_INITIAL_WINDOW_SIZE:
+                if value > max_window:
+                    raise _ConnectionError(FLOW_CONTROL_ERROR,
+                                           "initial window too big")
+                delta = value - self._peer_window
+                self._peer_window = value
+                for stream in self._streams.values():
+                    stream.send_window += delta
+                grown = grown or delta > 0
+            elif ident == SETTINGS_MAX_FRAME_SIZE:
+                if not default_frame_size <= value <= 16777215:
+                    raise _ConnectionError(PROTOCOL_ERROR, "frame size")
+                self._peer_frame_size = value
+            elif ident == SETTINGS_ENABLE_PUSH and value > 1:
+                raise _ConnectionError(PROTOCOL_ERROR, "ENABLE_PUSH")
+        if grown:
+            for stream in self._streams.values():
+                stream.flush()
+
+    # Streams
+
+    def _start_stream(self, stream_id, method, uri, req_hdrs, end_stream):
+        stream = _Stream(self, stream_id, method, uri)
+        self._streams[stream_id] = stream
+        if len(self._streams) == 1 and self.server:
+            self.server._conn_busy(self)
+        stream.start(req_hdrs, end_stream)
+
+    def _stream_done(self, stream):
+        "stream is finished (both ways)."
+        if self._streams.pop(stream.id, None) is None:
+            return
+        if stream in self._blocked:
+            self._blocked.remove(stream)
+        if not self._streams and self._tcp_conn:
+            if self._goaway:
+                self.close()
+            elif self.server:
+                self.server._conn_idle(self)
+
+    def _reset(self, stream_id, code):
+        self._send_frame(RST_STREAM, 0, stream_id, _uint32.pack(code))
+
+    def _send_headers(self, stream_id, hdr_tuples):
+        block = self._encoder.encode(hdr_tuples)
+        size = self._peer_frame_size
+        if len(block) <= size:
+            self._send_frame(HEADERS, END_HEADERS, stream_id, block)
+            return
+        self._send_frame(HEADERS, 0, stream_id, block[:size])
+        for start in range(size, len(block), size):
+            flags = start + size >= len(block) and END_HEADERS or 0
+            self._send_frame(CONTINUATION, flags, stream_id,
+                             block[start:start + size])
+
+    def _send_frame(self, frame_type, flags, stream_id, payload):
+        if self._tcp_conn:
+            self._tcp_conn.write(_frame_hdr.pack(
+                (len(payload) << 8) | frame_type, flags, stream_id) + payload)
+
+    # Methods called by push_tcp
+
+    def _write_pause(self, paused):
+        self._write_paused = paused
+        for stream in self._streams.values():
+            stream.check_pause()
+
+    def _conn_closed(self):
+        "The client has closed the connection."
+        self._tcp_conn = None
+        self._gone()
+
+    def _gone(self):
+        streams, self._streams = self._streams, {}
+        for stream in streams.values():
+            stream.reset(ERR_STREAM_RESET, None)
+        if self.server:
+            self.server._conn_gone(self)
+
+
+class _Stream:
+    "A request/response exchange on an HTTP/2 connection."
+    req_version = 2.0
+
+    def __init__(self, conn, stream_id, method, uri):
+        self.conn = conn
+        self.id = stream_id
+        self.method = method
+        self.uri = uri
+        self.send_window = conn._peer_window
+        self.recv_window = conn.initial_window
+        self.recv_unacked = 0
+        self.req_body_cb = None
+        self.req_done_cb = None
+        self.req_paused = False
+        self.req_complete = False
+        self.res_status = None
+        self.res_bytes = 0
+        self.res_nobody = False
+        self.res_pause_cb = None
+        self.res_paused = False
+        self.res_ending = False
+        self.res_complete = False
+        self.closed = False
+        self._out = []
+        self._out_len = 0
+        self._start = time.time()
+
+    def start(self, req_hdrs, end_stream):
+        self.req_body_cb, self.req_done_cb = self.conn.request_handler(
+            self.method, self.uri, req_hdrs, self.res_start, self.req_pause)
+        if end_stream:
+            self.req_end()
+
+    def req_pause(self, paused):
+        self.req_paused = paused
+        if not paused:
+            self.ack()
+
+    def req_end(self):
+        self.req_complete = True
+        self.req_done_cb(None)
+        self.check_done()
+
+    def ack(self):
+        "Give the client more window for the request body, if it's due."
+        if self.req_paused or self.req_complete or self.closed:
+            return
+        if self.recv_unacked >= self.conn.initial_window / 2:
+            self.conn._send_frame(WINDOW_UPDATE, 0, self.id,
+                                  _uint32.pack(self.recv_unacked))
+            self.recv_window += self.recv_unacked
+            self.recv_unacked = 0
+
+    def res_start(self, status_code, status_phrase, res_hdrs, res_body_pause):
+        "Start a response. Must only be called once per response."
+        self.res_status = status_code
+        self.res_nobody = status_code in no_body_status or \
+            self.method == "HEAD"
+        self.res_pause_cb = res_body_pause
+        metrics.server_requests.inc(labels=(status_code,))
+        hdr_tuples = [(":status", status_code)]
+        for name, value in res_hdrs:
+            name = name.lower()
+            if name not in _strip_hdrs:
+                hdr_tuples.append((name, value))
+        if not self.closed:
+            self.conn._send_headers(self.id, hdr_tuples)
+            self.check_pause()
+        return self.res_body, self.res_done
+
+    def res_body(self, chunk):
+        "Send part of the response body. May be called zero to many times."
+        if not chunk or self.closed or self.res_nobody:
+            return
+        self.res_bytes += len(chunk)
+        self._out.append(chunk)
+        self._out_len += len(chunk)
+        self.flush()
+
+    def res_done(self, err=None):
+        """
+        Signal the end of the response, whether or not there was a body.
+        MUST be called exactly once for each response.
+        """
+        duration = time.time() - self._start
+        metrics.server_duration.observe(duration)
+        if self.conn.access_log:
+            self.conn.access_log.log(self.conn._remote, self.method,
+                self.uri, self.res_status, self.res_bytes, duration)
+        if self.closed:
+            return
+        if err:
+            self.reset(None, INTERNAL_ERROR)
+            return
+        self.res_ending = True
+        self.flush()
+
+    def flush(self):
+        "Send as much of the response body as the windows allow."
+        conn = self.conn
+        while self._out and not self.closed:
+            allowed = min(conn._send_window, self.send_window,
+                          conn._peer_frame_size)
+            if allowed <= 0:
+                if conn._send_window <= 0 and self not in conn._blocked:
+                    conn._blocked.append(self)
+                break
+            chunk = self._out[0]
+            if len(chunk) > allowed:
+                self._out[0] = chunk[allowed:]
+                chunk = chunk[:allowed]
+            else:
+                self._out.pop(0)
+            self._out_len -= len(chunk)
+            conn._send_window -= len(chunk)
+            self.send_window -= len(chunk)
+            end = self.res_ending and not self._out
+            conn._send_frame(DATA, end and END_STREAM or 0, self.id, chunk)
+            if end:
+                self.res_complete = True
+        if self.res_ending and not self._out and not self.res_complete \
+        and not self.closed:
+            conn._send_frame(DATA, END_STREAM, self.id, "")
+            self.res_complete = True
+        self.check_pause()
+        self.check_done()
+
+    def check_pause(self):
+        "Tell the application whether to pause the response body."
+        paused = self.conn._write_paused or \
+            self._out_len > self.conn.stream_write_high
+        if paused != self.res_paused and self.res_pause_cb \
+        and not self.res_complete:
+            self.res_paused = paused
+            self.res_pause_cb(paused)
+
+    def check_done(self):
+        if self.req_complete and self.res_complete and not self.closed:
+            self.closed = True
+            self.conn._stream_done(self)
+
+    def reset(self, err, code=CANCEL):
+        """
+        Abandon the stream; tell the application (with err) if the request
+        wasn't complete, and the client (with code) if given.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._out = []
+        self._out_len = 0
+        if code is not None:
+            self.conn._reset(self.id, code)
+        self.conn._stream_done(self)
+        if not self.req_complete:
+            self.req_complete = True
+            self.req_done_cb(err or ERR_STREAM_RESET)
+
+
+def _unpad(flags, payload):
+    "Remove any padding from a DATA or HEADERS frame's payload."
+    if not flags & PADDED:
+        return payload
+    if not payload:
+        raise _ConnectionError(PROTOCOL_ERROR, "bad padding")
+    pad = ord(payload[0])
+    if pad >= len(payload):
+        raise _ConnectionError(PROTOCOL_ERROR, "bad padding")
+    return payload[1:len(payload) - pad]
@@ -87,7 +87,7 @@ def get_hdr(hdr_tuples, name):
             , [])]
 
 
-class HttpMessageHandler:
+class HttpMessageHandler(object):
     """
     This is a base class for something that has to parse and/or serialise 
     HTTP messages, request or response.
@@ -96,7 +96,14 @@ class HttpMessageHandler:
     _input_end, and call _handle_input when you get bytes from the network.
 
     For serialising, it expects you to override _output.
+
+    Its state is kept in slots; subclasses that don't define __slots__
+    themselves get a __dict__ as usual.
     """
+    __slots__ = ['input_header_length', 'input_transfer_length',
+                 '_input_buffer', '_input_state', '_input_delimit',
+                 '_input_body_left', '_input_interim', '_output_state',
+                 '_output_delimit']
 
     def __init__(self):
         self.input_header_length = 0
@@ -105,6 +112,7 @@ class HttpMessageHandler:
         self._input_state = WAITING
         self._input_delimit = None
         self._input_body_left = 0
+        self._input_interim = False
         self._output_state = WAITING
         self._output_delimit = None
 
@@ -164,6 +172,12 @@ class HttpMessageHandler:
 
     def _handle_nobody(self, instr):
         "Handle input that shouldn't have a body."
+        if self._input_interim: # a 1xx response; the final one follows.
+            self._input_interim = False
+            self._input_state = WAITING
+            if instr:
+                self._handle_input(instr)
+            return
         if instr:
             # FIXME: will not work with pipelining
             self._input_error(ERR_BODY_FORBIDDEN, instr) 
@@ -359,8 +373,8 @@ class HttpMessageHandler:
         """
         Output a part of a HTTP message.
         """
-        if not chunk:
-            return
+        if not chunk or self._output_delimit == NOBODY:
+            return # e.g., a response to HEAD.
         if self._output_delimit == CHUNKED:
             chunk = "%s\r\n%s\r\n" % (hex(len(chunk))[2:], chunk)
         self._output(chunk)
@@ -374,9 +388,9 @@ class HttpMessageHandler:
         Finish outputting a HTTP message.
         """
         if err:
-            self.output_body_cb, self.output_done_cb = dummy, dummy
-            self._tcp_conn.close()
-            self._tcp_conn = None
+            if self._tcp_conn: # may already have failed.
+                self._tcp_conn.close()
+                self._tcp_conn = None
         elif self._output_delimit == NOBODY:
             pass # didn't have a body at all.
         elif self._output_delimit == CHUNKED:
@@ -384,7 +398,8 @@ class HttpMessageHandler:
         elif self._output_delimit == COUNTED:
             pass # TODO: double-check the length
         elif self._output_delimit == CLOSE:
-            self._tcp_conn.close() # FIXME: abstract out?
+            if self._tcp_conn:
+                self._tcp_conn.close() # FIXME: abstract out?
         else:
             raise AssertionError, "Unknown request delimiter %s" % \
                                   self._output_delimit
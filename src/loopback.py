@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+"""
+In-memory loopback transport, for testing and benchmarking
+
+A Loopback stands in for the network and the clock. Once it's installed,
+push_tcp's create_server, create_client, schedule, now, run and stop use
+it, so Server and Client work as usual, without sockets;
+
+> net = loopback.Loopback().install()
+> server = Server("origin.example", 80, request_handler)
+> c = Client(res_start)
+> req_body, req_done = c.req_start("GET", "http://origin.example/", [], pause)
+> req_done(None)
+> net.run()
+> net.uninstall()
+
+Connections are pairs of in-memory ends, each of which acts like a push_tcp
+connection (tcp_conn); what's written to one is read from the other, up to
+read_bufsize bytes at a time. An end takes at most window bytes that
+haven't been read yet; beyond that, the writer's own buffer fills, and its
+pause_cb is called, just as when a TCP window is full. Connecting to a
+host and port that nothing is listening on is refused. A tls argument is
+recorded (as tcp_conn.tls), but nothing is encrypted. Relays and tunnels
+(see push_tcp) need real sockets.
+
+Time is virtual; it starts at start, and only moves forward when there's
+nothing else to do, straight to the next scheduled event. run returns
+when there are no more bytes to move or events to run (or stop is
+called), so timeouts of minutes take no time at all, and the order in
+which things happen is the same every time. advance runs for a number of
+(virtual) seconds instead.
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import asyncore
+import errno
+import heapq
+import os
+from collections import deque
+
+import push_tcp
+
+# the push_tcp functions that a Loopback replaces
+_replaced = ['create_server', 'create_client', 'schedule', 'now', 'run',
+             'stop']
+
+
+class Loopback:
+    "An in-memory network, with a virtual clock."
+    window = 1024 * 64 # unread bytes an end will take
+
+    def __init__(self, start=1000000000.0):
+        self._now = start
+        self._events = [] # heap of [when, sequence, callback, args]
+        self._sequence = 0
+        self._listeners = {} # (host, port) -> conn_handler
+        self._ends = []
+        self._activity = 0 # counts bytes and closes, to notice progress
+        self._running = False
+        self._saved = None
+        self.stats = {
+            'conns': 0,
+            'refused': 0,
+            'bytes': 0,
+        }
+
+    def install(self):
+        "Use this Loopback in place of push_tcp's network and clock."
+        if self._saved is None:
+            self._saved = dict([(name, getattr(push_tcp, name))
+                                for name in _replaced])
+            for name in _replaced:
+                setattr(push_tcp, name, getattr(self, name))
+        return self
+
+    def uninstall(self):
+        """
+        Put push_tcp's own functions back. Any connections left are marked
+        closed, and scheduled events are dropped.
+        """
+        if self._saved is not None:
+            for name, function in self._saved.items():
+                setattr(push_tcp, name, function)
+            self._saved = None
+        for end in self._ends:
+            end.tcp_connected = False
+        self._ends = []
+        self._events = []
+        self._listeners = {}
+
+    # push_tcp's interface
+
+    def create_server(self, host, port, conn_handler, tls=None):
+        "Listen on host and port; returns an object with close()."
+        self._listeners[(host, port)] = conn_handler
+        return _Listener(self, (host, port))
+
+    def create_client(self, host, port, conn_handler, connect_error_handler,
+                      connect_timeout=None, tls=None):
+        "Connect to host and port (once the loop runs)."
+        self.schedule(0, self._connect, host, port, conn_handler,
+                      connect_error_handler, tls)
+
+    def schedule(self, delta, callback, *args):
+        "Run callback with args in delta (virtual) seconds."
+        self._sequence += 1
+        event = [self._now + delta, self._sequence, callback, args]
+        heapq.heappush(self._events, event)
+        return _Event(event)
+
+    def now(self):
+        "Return the (virtual) time."
+        return self._now
+
+    def run(self):
+        """
+        Move bytes and run events until there's nothing left to do, or stop
+        is called.
+        """
+        self._loop(None)
+
+    def stop(self):
+        "Stop run (or advance) once the current callback returns."
+        self._running = False
+
+    # extras
+
+    def advance(self, seconds):
+        "Run for seconds of virtual time."
+        until = self._now + seconds
+        self._loop(until)
+        if self._now < until:
+            self._now = until
+
+    def pending(self):
+        "Return the number of scheduled events."
+        return len([e for e in self._events if e[2] is not None])
+
+    # internals
+
+    def _loop(self, until):
+        self._running = True
+        while self._running:
+            if self._run_due() or self._pump():
+                continue
+            when = self._next_event()
+            if when is None or (until is not None and when > until):
+                break
+            self._now = when
+        self._running = False
+
+    def _run_due(self):
+        "Run the events that are due; return True if there were any."
+        events = self._events
+        ran = False
+        while events and events[0][0] <= self._now and self._running:
+            when, sequence, callback, args = heapq.heappop(events)
+            if callback is not None:
+                ran = True
+                callback(*args)
+        return ran
+
+    def _next_event(self):
+        "Return when the next event is due, or None if there aren't any."
+        events = self._events
+        while events and events[0][2] is None: # deleted
+            heapq.heappop(events)
+        if events:
+            return events[0][0]
+        return None
+
+    def _pump(self):
+        """
+        Let each end write and read what it can; return True if anything
+        happened.
+        """
+        before = self._activity
+        for end in self._ends:
+            if end.writable():
+                end.handle_write()
+            if (end._inbound or end._eof) and end.readable():
+                end.handle_read()
+        self._ends = [e for e in self._ends if e.tcp_connected]
+        return self._activity != before
+
+    def _connect(self, host, port, conn_handler, connect_error_handler, tls):
+        try:
+            accept = self._listeners[(host, port)]
+        except KeyError:
+            self.stats['refused'] += 1
+            connect_error_handler((errno.ECONNREFUSED,
+                                   os.strerror(errno.ECONNREFUSED)))
+            return
+        self.stats['conns'] += 1
+        server_end = _End(self, host, port, tls)
+        client_end = _End(self, host, port, tls)
+        server_end.peer, client_end.peer = client_end, server_end
+        self._ends.extend([server_end, client_end])
+        server_end.read_cb, server_end.close_cb, server_end.pause_cb = \
+            accept(server_end)
+        client_end.read_cb, client_end.close_cb, client_end.pause_cb = \
+            conn_handler(client_end)
+
+
+class _Listener:
+    "What create_server returns."
+    def __init__(self, network, key):
+        self.network = network
+        self.key = key
+
+    def close(self):
+        "Stop accepting connections."
+        self.network._listeners.pop(self.key, None)
+
+
+class _Event:
+    "A scheduled event; what schedule returns."
+    def __init__(self, event):
+        self._event = event
+
+    def delete(self):
+        "Don't run the event after all."
+        self._event[2] = None
+
+
+class _NoEvent:
+    "Stands in for pyevent's events and the socket; the Loopback polls."
+    def pending(self):
+        return False
+
+    def add(self):
+        pass
+    delete = close = add
+
+_no_event = _NoEvent()
+
+
+class _End(push_tcp._TcpConnection):
+    """
+    One end of a loopback connection. Bytes are sent by putting them in the
+    peer's inbound queue, as long as there's room in its window.
+    """
+    __slots__ = ['peer', '_network', '_inbound', '_inbound_size', '_eof']
+
+    def __init__(self, network, host, port, tls=None):
+        self.peer = None
+        self._network = network
+        self._inbound = deque()
+        self._inbound_size = 0
+        self._eof = False # the peer has closed
+        push_tcp._TcpConnection.__init__(self, None, host, port)
+        if tls:
+            self.tls = True
+
+    def _register(self, sock):
+        # nothing to poll; the Loopback does it.
+        asyncore.dispatcher.__init__(self, None)
+        self.socket = self._revent = self._wevent = _no_event
+
+    def _recv(self, size):
+        inbound = self._inbound
+        if not inbound:
+            if self._eof:
+                self._network._activity += 1
+                return ""
+            return None
+        data = inbound.popleft()
+        while inbound and len(data) < size:
+            data += inbound.popleft()
+        if len(data) > size:
+            inbound.appendleft(data[size:])
+            data = data[:size]
+        self._inbound_size -= len(data)
+        self._network._activity += 1
+        return data
+
+    def _send(self, data):
+        peer = self.peer
+        if peer is None or not peer.tcp_connected:
+            return None # as if reset
+        room = self._network.window - peer._inbound_size
+        if room <= 0:
+            return 0
+        if len(data) > room:
+            data = data[:room]
+        peer._inbound.append(data)
+        peer._inbound_size += len(data)
+        network = self._network
+        network._activity += 1
+        network.stats['bytes'] += len(data)
+        return len(data)
+
+    def close(self):
+        push_tcp._TcpConnection.close(self)
+        if not self.tcp_connected: # not still flushing
+            self._network._activity += 1
+            if self.peer:
+                self.peer._eof = True
+                self.peer = None
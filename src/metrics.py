@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+"""
+Metrics for nbhttp processes
+
+Counters and histograms are kept in a Registry, and rendered in the
+Prometheus text exposition format. Updating them is cheap (a dictionary
+update), so they're updated directly from the server's and client's hot
+paths; other values (open connections, bytes transferred, connection pool
+statistics, timer queue depth) are collected when the metrics are read.
+
+To expose them under a reserved path of an existing Server:
+
+> server = Server(host, port, handler)
+> server.metrics_path = "/.well-known/metrics"
+
+or on a separate port:
+
+> metrics.serve(host, 9100)
+
+Applications can add their own metrics to the registry;
+
+> hits = metrics.registry.counter("myapp_hits_total", "Cache hits")
+> hits.inc()
+> latency = metrics.registry.histogram("myapp_seconds", "Latency",
+>                                      labelnames=['backend'])
+> latency.observe(0.02, ('db1',))
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from bisect import bisect_left
+
+import push_tcp
+from http_common import dummy
+
+content_type = "text/plain; version=0.0.4"
+
+default_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n") \
+        .replace('"', '\\"')
+
+def _labels(names, values, extra=None):
+    pairs = zip(names, values)
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (n, _escape(v))
+                              for (n, v) in pairs])
+
+def _number(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+class _Metric:
+    "Base class for metrics."
+    kind = None
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        "Return the metric in the text exposition format, as a list of lines."
+        lines = [
+            "# HELP %s %s" % (self.name, self.help.replace("\n", " ")),
+            "# TYPE %s %s" % (self.name, self.kind),
+        ]
+        lines.extend(self.samples())
+        return lines
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    "A value that only goes up."
+    kind = "counter"
+    def __init__(self, name, help, labelnames=()):
+        _Metric.__init__(self, name, help, labelnames)
+        self.values = {}    # label values tuple -> value
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        return ["%s%s %s" % (self.name, _labels(self.labelnames, k),
+                             _number(v))
+                for (k, v) in sorted(self.values.items())]
+
+
+class Histogram(_Metric):
+    "Counts of observations in buckets, with their sum."
+    kind = "histogram"
+    def __init__(self, name, help, labelnames=(), buckets=None):
+        _Metric.__init__(self, name, help, labelnames)
+        self.buckets = sorted(buckets or default_buckets)
+        self.values = {}    # label values tuple -> [counts, sum]
+
+    def observe(self, value, labels=()):
+        try:
+            counts_sum = self.values[labels]
+        except KeyError:
+            counts_sum = self.values[labels] = \
+                [[0] * (len(self.buckets) + 1), 0]
+        counts_sum[0][bisect_left(self.buckets, value)] += 1
+        counts_sum[1] += value
+
+    def samples(self):
+        lines = []
+        bounds = self.buckets + [float('inf')]
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append("%s_bucket%s %s" % (self.name,
+                    _labels(self.labelnames, labels, ('le', _number(bound))),
+                    cumulative))
+            lines.append("%s_sum%s %s" % (self.name,
+                _labels(self.labelnames, labels), _number(total)))
+            lines.append("%s_count%s %s" % (self.name,
+                _labels(self.labelnames, labels), cumulative))
+        return lines
+
+
+class Collected(_Metric):
+    """
+    A metric whose value is collected when the metrics are read. collect
+    returns a number, a list of (label values tuple, number), or None if
+    there's nothing to report.
+    """
+    def __init__(self, name, help, kind, collect, labelnames=()):
+        _Metric.__init__(self, name, help, labelnames)
+        self.kind = kind
+        self.collect = collect
+
+    def samples(self):
+        values = self.collect()
+        if values is None:
+            return []
+        if not isinstance(values, list):
+            values = [((), values)]
+        return ["%s%s %s" % (self.name, _labels(self.labelnames, k),
+                             _number(v))
+                for (k, v) in values]
+
+
+class Registry:
+    "A collection of metrics."
+    def __init__(self):
+        self.metrics = []
+        self._names = {}
+
+    def add(self, metric):
+        if self._names.has_key(metric.name):
+            raise ValueError, "Duplicate metric %s" % metric.name
+        self._names[metric.name] = metric
+        self.metrics.append(metric)
+        return metric
+
+    def get(self, name):
+        return self._names.get(name, None)
+
+    def counter(self, name, help, labelnames=()):
+        return self.add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=None):
+        return self.add(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, collect, labelnames=()):
+        return self.add(Collected(name, help, "gauge", collect, labelnames))
+
+    def collected_counter(self, name, help, collect, labelnames=()):
+        return self.add(Collected(name, help, "counter", collect,
+                                  labelnames))
+
+    def render(self):
+        "Return all of the metrics in the text exposition format."
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+
+# metrics updated by nbhttp itself
+
+server_accepted = registry.counter("nbhttp_server_connections_accepted_total",
+    "Connections accepted by the server")
+server_requests = registry.counter("nbhttp_server_requests_total",
+    "Responses started by the server, by status", ['status'])
+server_duration = registry.histogram("nbhttp_server_request_seconds",
+    "Time from request headers to the end of the response")
+server_errors = registry.counter("nbhttp_server_errors_total",
+    "Problems with requests, by error", ['error'])
+client_errors = registry.counter("nbhttp_client_errors_total",
+    "Problems with client requests, by error", ['error'])
+
+def _pool_stat(name):
+    def collect():
+        import client # avoid a circular import
+        return client.pool_stats()[name]
+    return collect
+
+def _pool_conns():
+    import client # avoid a circular import
+    values = [0, 0, 0]
+    for counts in client.pool_stats()['origins'].values():
+        for i in range(3):
+            values[i] += counts[i]
+    return [(('idle',), values[0]), (('open',), values[1]),
+            (('waiting',), values[2])]
+
+registry.gauge("nbhttp_tcp_connections_open",
+    "Open TCP connections (server and client)",
+    lambda: push_tcp.open_connections())
+registry.collected_counter("nbhttp_tcp_received_bytes_total",
+    "Bytes read from TCP connections",
+    lambda: push_tcp.stats['bytes_in'])
+registry.collected_counter("nbhttp_tcp_sent_bytes_total",
+    "Bytes written to TCP connections",
+    lambda: push_tcp.stats['bytes_out'])
+registry.collected_counter("nbhttp_client_pool_hits_total",
+    "Client requests that used a pooled connection", _pool_stat('hits'))
+registry.collected_counter("nbhttp_client_pool_misses_total",
+    "Client requests that needed a new connection", _pool_stat('misses'))
+registry.collected_counter("nbhttp_client_pool_queued_total",
+    "Client requests that waited for a connection", _pool_stat('queued'))
+registry.gauge("nbhttp_client_pool_connections",
+    "Client pool connections, by state", _pool_conns, ['state'])
+registry.gauge("nbhttp_loop_timers",
+    "Scheduled events waiting to run", lambda: push_tcp.pending_events())
+
+
+def respond(res_start, reg=None):
+    "Send the metrics in reg (default the global registry) as a response."
+    body = (reg or registry).render()
+    res_body, res_done = res_start("200", "OK", [
+        ("Content-Type", content_type),
+        ("Content-Length", str(len(body))),
+        ("Cache-Control", "no-store"),
+    ], dummy)
+    res_body(body)
+    res_done(None)
+
+def handler(method, uri, req_hdrs, res_start, req_pause):
+    "A request_handler that serves the metrics for any request."
+    respond(res_start)
+    return dummy, dummy
+
+def serve(host, port):
+    "Serve the metrics on a separate port."
+    from server import Server # avoid a circular import
+    return Server(host, port, handler)
@@ -6,7 +6,9 @@ push-based asynchronous TCP
 This is a generic library for building event-based / asynchronous
 TCP servers and clients. 
 
-By default, it uses the asyncore library included with Python. 
+By default, it uses the asyncore library included with Python (with 
+poll() where it's available, so that it isn't limited to FD_SETSIZE 
+connections). 
 However, if the pyevent library 
 <http://www.monkey.org/~dugsong/pyevent/> is available, it will 
 use that, offering higher concurrency and, perhaps, performance.
@@ -43,6 +45,24 @@ conn_handler is called every time a new client connects; see
 The server object itself keeps track of all of the open connections, and
 can be used to do things like idle connection management, etc.
 
+*** TLS
+
+To use TLS, give create_server or create_client an ssl.SSLContext as tls;
+
+> push_tcp.create_server(host, port, conn_handler,
+>                        tls=push_tcp.server_context(certfile, keyfile))
+> push_tcp.create_client(host, port, conn_handler, error_handler,
+>                        tls=push_tcp.client_context())
+
+The handshake is done by the loop before conn_handler is called, so the
+connection works in the same way as any other (tcp_conn.tls is True). If it
+fails or takes longer than handshake_timeout seconds, a client's
+error_handler is called, and a server's connection is closed. Use one
+context for many connections; a server context issues session tickets, so
+returning clients can resume their sessions with an abbreviated handshake,
+and a client context only loads its CA certificates once. Bytes aren't
+spliced when relaying to or from a TLS connection.
+
 *** Working with Connections
 
 Every time a new connection is established -- whether as a client
@@ -86,6 +106,13 @@ temporarily;
 >   else:
 >       # it's OK to start again
 
+The buffer is full when more than write_high bytes are waiting to be
+sent; pause_cb is then called with False once it drains to write_low
+bytes or fewer. It's only called when that state changes. Both can be
+set for each connection;
+
+> tcp_conn.set_watermarks(1024 * 256, 1024 * 64)
+
 Note that this is advisory; if you ignore it, the data will still be
 buffered, but the buffer will grow.
 
@@ -117,6 +144,45 @@ the event loop before anything actually happens;
 To stop it, just stop it;
 
 > push_tcp.stop()
+
+*** Threads
+
+push_tcp isn't thread-safe; connections (and anything using them) must 
+only be used from the thread running the loop. To have something done from
+another thread, use call_from_thread;
+
+> push_tcp.call_from_thread(cb, "foo")
+
+cb will be called with the argument "foo" in the loop's thread, as soon as
+it gets to it (the loop is woken up if it's waiting). Note that once this
+has been used, run doesn't return until stop is called.
+
+*** Relaying
+
+To move bytes from one connection to another without handing them to
+Python (e.g., to pass a response body through a proxy untouched), use
+relay;
+
+> push_tcp.relay(src_conn, dst_conn, length, done_cb, idle_timeout)
+
+It moves length bytes -- or if length is None, everything until src_conn
+is closed -- using splice() through a pipe where it's available, and
+falls back to reading and writing otherwise. Anything already written to
+dst_conn is sent first. While relaying, src_conn's read_cb isn't called.
+When it's done, done_cb is called with the number of bytes moved and
+None, or a string describing the problem (including relay_timeout if
+nothing moved for idle_timeout seconds).
+
+To relay both ways between two connections (e.g., for a CONNECT tunnel),
+use tunnel;
+
+> push_tcp.tunnel(conn1, conn2, done_cb, idle_timeout)
+
+When one side closes, the other is shut down for writing, and bytes keep
+moving the other way until it closes too. Then both connections are
+closed, and done_cb is called with the bytes moved from conn1 to conn2,
+from conn2 to conn1, and None or a string describing the problem. The
+tunnel is closed if nothing moves either way for idle_timeout seconds.
 """
 
 __author__ = "Mark Nottingham <mnot@mnot.net>"
@@ -145,20 +211,74 @@ THE SOFTWARE.
 import asyncore
 import bisect
 import errno
+import fcntl
 import os
+import select
 import sys
 import socket
+import ssl
+import threading
 import time
+from collections import deque
 
 try:
     import event      # http://www.monkey.org/~dugsong/pyevent/
 except ImportError:
     event = None
 
-class _TcpConnection(asyncore.dispatcher):
-    "Base class for a TCP connection."
-    write_bufsize = 16
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+try:
+    _splice = os.splice
+except AttributeError:
+    try:
+        import ctypes
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc_splice = _libc.splice
+        _libc_splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+            ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+        _libc_splice.restype = ctypes.c_ssize_t
+        def _splice(src, dst, count, flags=0):
+            sent = _libc_splice(src, None, dst, None, count, flags)
+            if sent < 0:
+                err = ctypes.get_errno()
+                raise OSError, (err, os.strerror(err))
+            return sent
+    except (ImportError, OSError, AttributeError):
+        _splice = None
+
+_closed_errnos = [errno.EBADF, errno.ECONNRESET, errno.ESHUTDOWN,
+                  errno.ECONNABORTED, errno.ECONNREFUSED, errno.ENOTCONN,
+                  errno.EPIPE]
+
+_no_data = () # shared by connections with nothing buffered
+
+# bytes transferred over all connections
+stats = {
+    'bytes_in': 0,
+    'bytes_out': 0,
+}
+
+class _TcpConnection(asyncore.dispatcher, object):
+    """
+    Base class for a TCP connection.
+
+    There can be a great many of these, mostly idle, so their state is kept
+    in slots, rather than a dictionary for each. Defaults that are rarely
+    changed (like the watermarks) are class attributes; setting them, or
+    anything else that doesn't have a slot, creates the instance's
+    __dict__ when it's needed.
+    """
+    __slots__ = ['socket', 'host', 'port', 'read_cb', 'close_cb',
+                 'pause_cb', 'tcp_connected', 'write_paused', '_paused',
+                 '_closing', '_close_cb_called', '_write_buffer',
+                 '_write_buffered', '_relay_reader', '_relay_writer',
+                 '_revent', '_wevent', '_map', '_fileno', 'connected',
+                 'addr', '__dict__']
+    write_high = 1024 * 64 # bytes buffered before pause_cb(True)
+    write_low = 1024 * 16 # bytes buffered before pause_cb(False)
     read_bufsize = 1024 * 16
+    tls = False
     def __init__(self, sock, host, port):
         self.socket = sock
         self.host = host
@@ -170,7 +290,15 @@ class _TcpConnection(asyncore.dispatcher):
         self.tcp_connected = True # we assume a connected socket
         self._paused = False # TODO: should be paused by default
         self._closing = False
-        self._write_buffer = []
+        self._write_buffer = _no_data # a list, once there's something
+        self._write_buffered = 0
+        self.write_paused = False
+        self._relay_reader = None # a relay reading from this connection
+        self._relay_writer = None # a relay writing to this connection
+        self._register(sock)
+
+    def _register(self, sock):
+        "Start watching sock for reading and writing."
         if event:
             self._revent = event.read(sock, self.handle_read)
             self._wevent = event.write(sock, self.handle_write)
@@ -191,7 +319,9 @@ class _TcpConnection(asyncore.dispatcher):
         if self._close_cb_called:
             status.append('close cb called')
         if self._write_buffer:
-            status.append('%s write buffered' % len(self._write_buffer))
+            status.append('%s write buffered' % self._write_buffered)
+        if self.write_paused:
+            status.append('write paused')
         return "<%s at %#x>" % (", ".join(status), id(self))
 
     def handle_connect(self): # asyncore
@@ -202,60 +332,90 @@ class _TcpConnection(asyncore.dispatcher):
         The connection has data read for reading; call read_cb
         if appropriate.
         """
-        try:
-            data = self.socket.recv(self.read_bufsize)
-        except socket.error, why:
-            if why[0] in [errno.EBADF, errno.ECONNRESET, errno.ESHUTDOWN, 
-                          errno.ECONNABORTED, errno.ECONNREFUSED, 
-                          errno.ENOTCONN, errno.EPIPE]:
-                self.conn_closed()
-                return
-            else:
-                raise
+        if self._relay_reader:
+            self._relay_reader.pump_in()
+            if event and self.tcp_connected and not self._paused:
+                return self._revent
+            return
+        data = self._recv(self.read_bufsize)
         if data == "":
             self.conn_closed()
-        else:
+            return
+        if data is not None:
+            stats['bytes_in'] += len(data)
             self.read_cb(data)
-            if event:
-                if self.read_cb and self.tcp_connected and not self._paused:
-                    return self._revent
+        if event:
+            if self.read_cb and self.tcp_connected and not self._paused:
+                return self._revent
         
     def handle_write(self):
         "The connection is ready for writing; write any buffered data."
         if len(self._write_buffer) > 0:
-            data = "".join(self._write_buffer)
-            try:
-                sent = self.socket.send(data)
-            except socket.error, why:
-                if why[0] == errno.EWOULDBLOCK:
-                    return
-                elif why[0] in [errno.EBADF, errno.ECONNRESET, 
-                                errno.ESHUTDOWN, errno.ECONNABORTED,
-                                errno.ECONNREFUSED, errno.ENOTCONN, 
-                                errno.EPIPE]:
-                    self.conn_closed()
-                    return
-                else:
-                    raise
+            if len(self._write_buffer) > 1:
+                data = "".join(self._write_buffer)
+            else:
+                data = self._write_buffer[0]
+            sent = self._send(data)
+            if sent is None:
+                self.conn_closed()
+                return
+            stats['bytes_out'] += sent
             if sent < len(data):
                 self._write_buffer = [data[sent:]]
             else:
-                self._write_buffer = []
-        if self.pause_cb and len(self._write_buffer) < self.write_bufsize:
-            self.pause_cb(False)
+                self._write_buffer = _no_data
+            self._write_buffered = len(data) - sent
+        if self.write_paused and self._write_buffered <= self.write_low:
+            self.write_paused = False
+            if self.pause_cb:
+                self.pause_cb(False)
+        if self._relay_writer and not self._write_buffer:
+            self._relay_writer.pump_out()
         if self._closing:
             self.close()
         if event:
-            if self.tcp_connected \
-            and (len(self._write_buffer) > 0 or self._closing):
+            if self.tcp_connected and (len(self._write_buffer) > 0 \
+            or self._closing or \
+            (self._relay_writer and self._relay_writer.pending)):
                 return self._wevent
 
+    def _recv(self, size):
+        """
+        Read up to size bytes; returns "" if the connection has closed, or
+        None if there's nothing to read after all.
+        """
+        try:
+            return self.socket.recv(size)
+        except socket.error, why:
+            if why[0] in _closed_errnos:
+                return ""
+            if why[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                return None
+            raise
+
+    def _send(self, data):
+        "Send what we can of data; returns how much, or None if closed."
+        try:
+            return self.socket.send(data)
+        except socket.error, why:
+            if why[0] == errno.EWOULDBLOCK:
+                return 0
+            if why[0] in _closed_errnos:
+                return None
+            raise
+
     def conn_closed(self):
         """
         The connection has been closed by the other side. Do local cleanup
         and then call close_cb.
         """
         self.tcp_connected = False
+        reader, writer = self._relay_reader, self._relay_writer
+        if writer:
+            writer.conn_closed(self)
+        if reader:
+            reader.conn_closed(self)
+            return # the relay's done_cb deals with it
         if self._close_cb_called:
             return
         elif self.close_cb:
@@ -270,13 +430,32 @@ class _TcpConnection(asyncore.dispatcher):
     def write(self, data):
         "Write data to the connection."
 #        assert not self._paused
-        self._write_buffer.append(data)
-        if self.pause_cb and len(self._write_buffer) > self.write_bufsize:
-            self.pause_cb(True)
+        if self._write_buffer:
+            self._write_buffer.append(data)
+        else:
+            self._write_buffer = [data]
+        self._write_buffered += len(data)
+        if not self.write_paused and self._write_buffered > self.write_high:
+            self.write_paused = True
+            if self.pause_cb:
+                self.pause_cb(True)
         if event:
             if not self._wevent.pending():
                 self._wevent.add()
 
+    def set_watermarks(self, high, low=None):
+        """
+        Set the number of buffered bytes that pauses writing (high), and
+        that it has to drain to before writing is unpaused (low; default
+        a quarter of high).
+        """
+        if low is None:
+            low = high / 4
+        if low > high:
+            raise ValueError, "low watermark is above high watermark"
+        self.write_high = high
+        self.write_low = low
+
     def pause(self, paused):
         """
         Temporarily stop/start reading from the connection and pushing
@@ -293,6 +472,9 @@ class _TcpConnection(asyncore.dispatcher):
 
     def close(self):
         "Flush buffered data (if any) and close the connection."
+        for relay in [self._relay_reader, self._relay_writer]:
+            if relay:
+                relay.finish("connection closed")
         self.pause(True)
         if len(self._write_buffer) > 0:
             self._closing = True
@@ -309,12 +491,14 @@ class _TcpConnection(asyncore.dispatcher):
 
     def readable(self):
         "asyncore-specific readable method"
-        return self.read_cb and self.tcp_connected and not self._paused
+        return (self.read_cb or self._relay_reader) and self.tcp_connected \
+            and not self._paused
     
     def writable(self):
         "asyncore-specific writable method"
-        return self.tcp_connected and \
-            (len(self._write_buffer) > 0 or self._closing)
+        return self.tcp_connected and (len(self._write_buffer) > 0 \
+            or self._closing or \
+            (self._relay_writer is not None and self._relay_writer.pending))
 
     def handle_error(self):
         """
@@ -323,10 +507,494 @@ class _TcpConnection(asyncore.dispatcher):
         raise
 
 
-def create_server(host, port, conn_handler):
-    """Listen to host:port and send connections to conn_handler."""
+class _TlsConnection(_TcpConnection):
+    """
+    A TCP connection using TLS. Once the handshake is done, connected_cb is
+    called with the connection, and returns its (read_cb, close_cb,
+    pause_cb); if it fails, error_cb is called with the reason instead.
+    """
+    __slots__ = ['_handshaking', '_want_write', '_connected_cb',
+                 '_error_cb', '_timeout_ev']
+    tls = True
+    handshake_timeout = 30
+
+    def __init__(self, sock, host, port, connected_cb, error_cb):
+        self._handshaking = True
+        self._want_write = False
+        self._connected_cb = connected_cb
+        self._error_cb = error_cb
+        _TcpConnection.__init__(self, sock, host, port)
+        self._timeout_ev = schedule(self.handshake_timeout,
+            self._handshake_failed,
+            (errno.ETIMEDOUT, "TLS handshake timed out"))
+        self._handshake()
+
+    def _handshake(self):
+        "Take the handshake as far as it can go without blocking."
+        try:
+            self.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self._want_write = False
+        except ssl.SSLWantWriteError:
+            self._want_write = True
+        except (socket.error, ssl.CertificateError), why:
+            self._handshake_failed(_reason(why))
+            return
+        else:
+            self._handshaking = self._want_write = False
+            self._timeout_ev.delete()
+            connected_cb = self._connected_cb
+            self._connected_cb = self._error_cb = None
+            self.read_cb, self.close_cb, self.pause_cb = connected_cb(self)
+        if event and self.tcp_connected:
+            if self._handshaking:
+                wait_for = [self._want_write and self._wevent or self._revent]
+            else:
+                wait_for = []
+                if not self._paused:
+                    wait_for.append(self._revent)
+                if self._write_buffer:
+                    wait_for.append(self._wevent)
+            for ev in wait_for:
+                if not ev.pending():
+                    ev.add()
+
+    def _handshake_failed(self, reason):
+        if not self._handshaking:
+            return
+        self._handshaking = False
+        self._timeout_ev.delete()
+        error_cb = self._error_cb
+        self._connected_cb = self._error_cb = None
+        _TcpConnection.close(self)
+        error_cb(reason)
+
+    def handle_read(self):
+        if self._handshaking:
+            self._handshake()
+            return
+        result = _TcpConnection.handle_read(self)
+        # a record bigger than read_bufsize leaves some behind in the
+        # SSL object, where polling won't see it.
+        while self.tcp_connected and self.read_cb and not self._paused \
+        and not self._relay_reader and self.socket.pending():
+            result = _TcpConnection.handle_read(self)
+        return result
+
+    def handle_write(self):
+        if self._handshaking:
+            self._handshake()
+            return
+        return _TcpConnection.handle_write(self)
+
+    def conn_closed(self):
+        if self._handshaking:
+            self._handshake_failed((errno.ECONNRESET,
+                                    "Connection closed during TLS handshake"))
+            return
+        _TcpConnection.conn_closed(self)
+    handle_close = conn_closed # for asyncore
+
+    def _recv(self, size):
+        try:
+            return self.socket.recv(size)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return None
+        except ssl.SSLError: # e.g., a bad record
+            return ""
+        except socket.error, why:
+            if why[0] in _closed_errnos:
+                return ""
+            raise
+
+    def _send(self, data):
+        try:
+            return self.socket.send(data)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return 0
+        except ssl.SSLError:
+            return None
+        except socket.error, why:
+            if why[0] in _closed_errnos:
+                return None
+            raise
+
+    def readable(self):
+        "asyncore-specific readable method"
+        if self._handshaking:
+            return self.tcp_connected and not self._want_write
+        return _TcpConnection.readable(self)
+
+    def writable(self):
+        "asyncore-specific writable method"
+        if self._handshaking:
+            return self.tcp_connected and self._want_write
+        return _TcpConnection.writable(self)
+
+
+def _reason(why):
+    "Return an (errno, description) tuple for an exception."
+    if len(why.args) < 2:
+        return (None, str(why))
+    return tuple(why.args[:2])
+
+def server_context(certfile, keyfile=None):
+    "Return an ssl.SSLContext for a server using the given certificate."
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | \
+        ssl.OP_NO_COMPRESSION | ssl.OP_CIPHER_SERVER_PREFERENCE
+    context.load_cert_chain(certfile, keyfile)
+    return context
+
+_client_context = None
+
+def client_context(cafile=None):
+    """
+    Return an ssl.SSLContext for clients that verifies servers' certificates
+    (against cafile, if given, or the system's CA certificates). Without
+    cafile, the same context is returned each time.
+    """
+    global _client_context
+    if cafile:
+        return ssl.create_default_context(cafile=cafile)
+    if _client_context is None:
+        _client_context = ssl.create_default_context()
+    return _client_context
+
+
+relay_timeout = "idle timeout"
+
+def relay(src, dst, length, done_cb, idle_timeout=None):
+    "Move length bytes (or all, if None) from src to dst; see above."
+    return _Relay(src, dst, length, done_cb, idle_timeout)
+
+def tunnel(conn1, conn2, done_cb, idle_timeout=None):
+    "Relay bytes both ways between conn1 and conn2; see above."
+    return _Tunnel(conn1, conn2, done_cb, idle_timeout)
+
+class _Relay:
+    """
+    Bytes moving from one _TcpConnection to another.
+
+    A pipe is only held while bytes are in it, so that idle relays (e.g.,
+    in long-lived tunnels) don't use up file descriptors.
+    """
+    pipe_size = 1024 * 64
+    max_spare_pipes = 64
+    _spare_pipes = []
+
+    def __init__(self, src, dst, length, done_cb, idle_timeout=None):
+        self.src = src
+        self.dst = dst
+        self.left = length # bytes still to read from src; None until close
+        self.done_cb = done_cb
+        self.moved = 0
+        self.pending = 0   # bytes in the pipe
+        self.idle_timeout = idle_timeout
+        self.last_active = now()
+        self._eof = False
+        self._done = False
+        self._idle_ev = None
+        self._pipe = None
+        self._splice = _splice and not (src.tls or dst.tls)
+        src._relay_reader = self
+        dst._relay_writer = self
+        if idle_timeout:
+            self._idle_ev = schedule(idle_timeout, self._check_idle)
+        if self.left == 0:
+            self.finish(None)
+        else:
+            src.pause(False)
+
+    def __repr__(self):
+        return "<_Relay %s moved, %s left, %s pending at %#x>" % (
+            self.moved, self.left, self.pending, id(self))
+
+    def pump_in(self):
+        "Move what we can from src."
+        want = self.pipe_size - self.pending
+        if self.left is not None:
+            want = min(want, self.left)
+        if want <= 0:
+            self.src.pause(True)
+            return
+        if self._splice and self._pipe is None:
+            self._pipe = self._get_pipe() # if None, recv this time.
+        try:
+            if self._pipe:
+                got = _splice(self.src.socket.fileno(), self._pipe[1], want,
+                              flags=SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+                data = None
+            else:
+                data = self.src._recv(want)
+                if data is None:
+                    return
+                got = len(data)
+        except (OSError, socket.error), why:
+            if why[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                return
+            if why[0] in _closed_errnos:
+                self._src_eof()
+                return
+            raise
+        if got == 0:
+            self._src_eof()
+            return
+        stats['bytes_in'] += got
+        self.last_active = now()
+        if self.left is not None:
+            self.left -= got
+        if data is None:
+            self.pending += got
+            self.pump_out()
+        else:
+            self.moved += got
+            self.dst.write(data)
+            if self.dst.write_paused and not self._done:
+                self.src.pause(True) # pump_out will unpause
+            self._check_done()
+
+    def pump_out(self):
+        "Move what we can to dst."
+        if self.pending and not self.dst._write_buffer:
+            try:
+                sent = _splice(self._pipe[0], self.dst.socket.fileno(),
+                    self.pending, flags=SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+            except OSError, why:
+                if why[0] in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    sent = 0
+                elif why[0] in _closed_errnos:
+                    self.dst.conn_closed()
+                    return
+                else:
+                    raise
+            self.pending -= sent
+            self.moved += sent
+            stats['bytes_out'] += sent
+            if sent:
+                self.last_active = now()
+            if self.pending == 0:
+                self._put_pipe(self._pipe)
+                self._pipe = None
+            elif event and not self.dst._wevent.pending():
+                self.dst._wevent.add()
+        if self._check_done():
+            return
+        if not self._eof and self.pending < self.pipe_size \
+        and not self.dst.write_paused:
+            self.src.pause(False)
+
+    def conn_closed(self, conn):
+        "One of the connections has closed."
+        if conn is self.src:
+            self._src_eof()
+        else:
+            self.finish("destination closed")
+
+    def finish(self, err):
+        "Stop relaying, and call done_cb."
+        if self._done:
+            return
+        self._done = True
+        self.src._relay_reader = None
+        self.dst._relay_writer = None
+        if self._idle_ev:
+            self._idle_ev.delete()
+            self._idle_ev = None
+        if self._pipe:
+            # only an empty pipe can be used again.
+            os.close(self._pipe[0])
+            os.close(self._pipe[1])
+            self._pipe = None
+        done_cb, self.done_cb = self.done_cb, None
+        done_cb(self.moved, err)
+
+    def _src_eof(self):
+        self._eof = True
+        self.src.pause(True)
+        if self.left:
+            self.finish("source closed with %s bytes left" % self.left)
+        else:
+            self.left = 0
+            self._check_done()
+
+    def _check_done(self):
+        "Finish if everything's been moved; return True if so."
+        if self.left == 0 and self.pending == 0 \
+        and not self.dst._write_buffer and not self._done:
+            self.finish(None)
+        return self._done
+
+    def _check_idle(self):
+        self._idle_ev = None
+        if self._done:
+            return
+        idle = now() - self.last_active
+        if idle >= self.idle_timeout:
+            self.finish(relay_timeout)
+        else:
+            self._idle_ev = schedule(self.idle_timeout - idle,
+                                     self._check_idle)
+
+    def _get_pipe(self):
+        "Return an empty non-blocking pipe, or None if we can't make one."
+        if self._spare_pipes:
+            return self._spare_pipes.pop()
+        try:
+            pipe = os.pipe()
+        except OSError:
+            return None
+        for fd in pipe:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        return pipe
+
+    def _put_pipe(self, pipe):
+        if len(self._spare_pipes) < self.max_spare_pipes:
+            self._spare_pipes.append(pipe)
+        else:
+            os.close(pipe[0])
+            os.close(pipe[1])
+
+
+class _Tunnel:
+    "A relay each way between two connections."
+    def __init__(self, conn1, conn2, done_cb, idle_timeout=None):
+        self.conns = [conn1, conn2]
+        self.done_cb = done_cb
+        self.idle_timeout = idle_timeout
+        self.moved = [0, 0]
+        self._open = 2
+        self._done = False
+        self._idle_ev = None
+        self.relays = [
+            _Relay(conn1, conn2, None, self._relay_done_cb(0)),
+            _Relay(conn2, conn1, None, self._relay_done_cb(1)),
+        ]
+        if idle_timeout:
+            self._idle_ev = schedule(idle_timeout, self._check_idle)
+
+    def __repr__(self):
+        return "<_Tunnel %s:%s <-> %s:%s, %s/%s moved at %#x>" % (
+            self.conns[0].host, self.conns[0].port, self.conns[1].host,
+            self.conns[1].port, self.moved[0], self.moved[1], id(self))
+
+    def _relay_done_cb(self, way):
+        def relay_done(moved, err):
+            self.moved[way] = moved
+            if self._done:
+                return
+            if err:
+                self.finish(err)
+                return
+            self._open -= 1
+            if self._open == 0:
+                self.finish(None)
+                return
+            # pass the half-close on, and keep going the other way.
+            # (TLS can't be half-closed.)
+            if not self.conns[1 - way].tls:
+                try:
+                    self.conns[1 - way].socket.shutdown(socket.SHUT_WR)
+                except socket.error:
+                    pass
+        return relay_done
+
+    def finish(self, err):
+        "Close both connections, and call done_cb."
+        if self._done:
+            return
+        self._done = True
+        if self._idle_ev:
+            self._idle_ev.delete()
+            self._idle_ev = None
+        for relay in self.relays:
+            relay.finish(err or "tunnel closed")
+        for conn in self.conns:
+            conn.close()
+        done_cb, self.done_cb = self.done_cb, None
+        done_cb(self.moved[0], self.moved[1], err)
+
+    def _check_idle(self):
+        self._idle_ev = None
+        if self._done:
+            return
+        idle = now() - max([r.last_active for r in self.relays])
+        if idle >= self.idle_timeout:
+            self.finish(relay_timeout)
+        else:
+            self._idle_ev = schedule(self.idle_timeout - idle,
+                                     self._check_idle)
+
+
+class _Waker(asyncore.file_dispatcher):
+    "Runs callbacks queued by other threads, waking the loop to do so."
+    def __init__(self):
+        self.calls = deque()
+        self._rfd, self._wfd = os.pipe()
+        for fd in [self._rfd, self._wfd]:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        if event:
+            self._event = event.event(self.handle_read, handle=self._rfd,
+                        evtype=event.EV_READ|event.EV_PERSIST)
+            self._event.add()
+        else: # asyncore
+            asyncore.file_dispatcher.__init__(self, self._rfd)
+
+    def call(self, callback, args):
+        self.calls.append((callback, args))
+        try:
+            os.write(self._wfd, "x")
+        except OSError, why:
+            if why[0] != errno.EAGAIN: # if the pipe is full, it's awake.
+                raise
+
+    def handle_read(self, *args):
+        try:
+            os.read(self._rfd, 4096)
+        except OSError:
+            pass
+        while self.calls:
+            callback, args = self.calls.popleft()
+            callback(*args)
+
+    def writable(self):
+        return False
+
+    def handle_error(self):
+        stop() # FIXME: handle unscheduled errors more gracefully
+        raise
+
+_waker = None
+_waker_lock = threading.Lock()
+
+def call_from_thread(callback, *args):
+    "From any thread, have callback(*args) run in the loop's thread."
+    global _waker
+    waker = _waker
+    if waker is None or (not event and \
+    not _loop.socket_map.has_key(waker._fileno)):
+        _waker_lock.acquire()
+        try:
+            if _waker is None:
+                _waker = _Waker()
+            elif not event and not _loop.socket_map.has_key(_waker._fileno):
+                _waker.add_channel() # the loop was stopped.
+            waker = _waker
+        finally:
+            _waker_lock.release()
+    waker.call(callback, args)
+
+
+def create_server(host, port, conn_handler, tls=None):
+    """
+    Listen to host:port and send connections to conn_handler, using TLS if
+    tls (an ssl.SSLContext) is given. Returns the server object; call its
+    close method to stop listening.
+    """
     sock = server_listen(host, port)
-    attach_server(host, port, sock, conn_handler)
+    return attach_server(host, port, sock, conn_handler, tls)
 
 def server_listen(host, port):
     "Return a socket listening to host:port."
@@ -339,17 +1007,28 @@ def server_listen(host, port):
     
 class attach_server(asyncore.dispatcher):
     "Attach a server to a listening socket."
-    def __init__(self, host, port, sock, conn_handler):
+    def __init__(self, host, port, sock, conn_handler, tls=None):
         self.host = host
         self.port = port
         self.conn_handler = conn_handler
+        self.tls = tls
         if event:
-            event.event(self.handle_accept, handle=sock,
-                        evtype=event.EV_READ|event.EV_PERSIST).add()
+            self._sock = sock
+            self._event = event.event(self.handle_accept, handle=sock,
+                        evtype=event.EV_READ|event.EV_PERSIST)
+            self._event.add()
         else: # asyncore
             asyncore.dispatcher.__init__(self, sock=sock)
             self.accepting = True
 
+    def close(self):
+        "Stop listening; connections already accepted aren't affected."
+        if event:
+            self._event.delete()
+            self._sock.close()
+        else:
+            asyncore.dispatcher.close(self)
+
     def handle_accept(self, *args):
         try:
             if event:
@@ -360,6 +1039,17 @@ class attach_server(asyncore.dispatcher):
             # sometimes accept() returns None if we have 
             # multiple processes listening
             return
+        if self.tls:
+            conn.setblocking(0)
+            try:
+                conn = self.tls.wrap_socket(conn, server_side=True,
+                                            do_handshake_on_connect=False)
+            except socket.error:
+                conn.close()
+                return
+            _TlsConnection(conn, self.host, self.port, self.conn_handler,
+                           _tls_refused)
+            return
         tcp_conn = _TcpConnection(conn, self.host, self.port)
         tcp_conn.read_cb, tcp_conn.close_cb, tcp_conn.pause_cb = \
             self.conn_handler(tcp_conn)
@@ -368,14 +1058,19 @@ class attach_server(asyncore.dispatcher):
         stop() # FIXME: handle unscheduled errors more gracefully
         raise
 
+def _tls_refused(reason):
+    "A client's TLS handshake failed; its connection is already closed."
+    pass
+
 class create_client(asyncore.dispatcher):
     "An asynchronous TCP client."
     def __init__(self, host, port, conn_handler, 
-        connect_error_handler, connect_timeout=None):
+        connect_error_handler, connect_timeout=None, tls=None):
         self.host = host
         self.port = port
         self.conn_handler = conn_handler
         self.connect_error_handler = connect_error_handler
+        self.tls = tls
         self._timeout_ev = None
         self._error_sent = False
         # TODO: socket.getaddrinfo(); needs to be non-blocking.
@@ -420,6 +1115,16 @@ class create_client(asyncore.dispatcher):
             return
         if sock is None: # asyncore
             sock = self.socket
+        if self.tls:
+            try:
+                sock = self.tls.wrap_socket(sock, server_hostname=self.host,
+                                            do_handshake_on_connect=False)
+            except socket.error, why:
+                self.handle_conn_error(_reason(why))
+                return
+            _TlsConnection(sock, self.host, self.port, self.conn_handler,
+                           self.handle_conn_error)
+            return
         tcp_conn = _TcpConnection(sock, self.host, self.port)
         tcp_conn.read_cb, tcp_conn.close_cb, tcp_conn.pause_cb = \
             self.conn_handler(tcp_conn)
@@ -436,8 +1141,6 @@ class create_client(asyncore.dispatcher):
         else:
             ex_type = socket.error
         if ex_type in [socket.error, socket.gaierror]:
-            if ex_value[0] == errno.ECONNREFUSED:
-                return # OS will retry
             if self._timeout_ev:
                 self._timeout_ev.delete()
             if self._error_sent:
@@ -451,6 +1154,12 @@ class create_client(asyncore.dispatcher):
             raise
     
     def handle_error(self):
+        ex_type, ex_value = sys.exc_info()[:2]
+        if ex_type in [socket.error, socket.gaierror]:
+            # asyncore reports failed connections (e.g., refused) this way.
+            asyncore.dispatcher.close(self)
+            self.handle_conn_error(ex_value)
+            return
         stop() # FIXME: handle unscheduled errors more gracefully
         raise
 
@@ -465,6 +1174,10 @@ class _AsyncoreLoop:
         self.timeout = 1
         self.granularity = 1
         self.socket_map = asyncore.socket_map
+        if hasattr(select, 'poll'): # not limited to FD_SETSIZE descriptors
+            self.poll = asyncore.poll2
+        else:
+            self.poll = asyncore.poll
         self._now = None
         self._running = False
 
@@ -492,7 +1205,7 @@ class _AsyncoreLoop:
             self.num_channels = n
             if n > self.max_channels:
                 self.max_channels = n
-            asyncore.poll(self.timeout) # TODO: use poll2 when available
+            self.poll(self.timeout)
             
     def stop(self):
         "Stop the loop."
@@ -534,6 +1247,19 @@ def _event_stop(*args):
     _event_running = False
     event.abort(*args)
 
+def open_connections():
+    "Return the number of open connections, or None if it isn't known."
+    if event:
+        return None
+    return len([c for c in _loop.socket_map.values()
+                if isinstance(c, _TcpConnection)])
+
+def pending_events():
+    "Return the number of scheduled events, or None if it isn't known."
+    if event:
+        return None
+    return len(_loop.events)
+
 if event:
     schedule = event.timeout
     run = _event_run
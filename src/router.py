@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+"""
+Request routing for Server
+
+A Router is a Server request_handler that hands each request to another
+request_handler, chosen by method, host and path;
+
+> router = Router()
+> router.add("/", home)
+> router.add("/users/{user}", user, methods=['GET', 'PUT'])
+> router.add("/users/{user}/photos/{photo}", photo)
+> router.mount("/static/", StaticFiles("/var/www", prefix="/static/"))
+> router.add("/", other_home, host="other.example.com")
+> server = Server(host, port, router)
+
+A path segment in braces is a parameter; it matches any one segment, and
+its (unquoted) value is passed to the handler as a keyword argument;
+
+> def photo(method, uri, req_hdrs, res_start, req_pause, user, photo):
+
+A mounted handler gets everything at or below its prefix (the longest
+matching prefix wins), with the uri unchanged. Routes for a specific
+host are tried first, then those added without one. A literal segment is
+preferred to a parameter in the same position; once a literal matches,
+the parameter isn't tried as well.
+
+Routes are kept in a trie of path segments, so finding one takes time in
+proportion to the number of segments in the path, not the number of
+routes. Paths that match a route without any parameters (rather than a
+mount, or nothing) are cached, up to cache_size of them, so that requests
+for arbitrary paths can't churn the cache.
+
+Requests that don't match get a 404 (Not Found), or are passed to the
+not_found request_handler, if given; a path that matches, but not for the
+request method, gets a 405 (Method Not Allowed).
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import urllib
+from urlparse import urlsplit
+
+from http_common import dummy
+
+
+class _Node:
+    "A point in the routing trie; one per path segment."
+    def __init__(self):
+        self.children = {}   # literal segment -> _Node
+        self.param = None    # (name, _Node) for any other segment
+        self.handlers = None # method (or None for any) -> handler
+        self.mount = None    # method (or None for any) -> handler
+
+
+class Router:
+    "A request_handler that dispatches requests to other request_handlers."
+    cache_size = 10000
+
+    def __init__(self, not_found=None):
+        self.not_found = not_found
+        self._roots = {None: _Node()} # host (or None for any) -> _Node
+        self._by_host = False
+        self._cache = {}
+
+    def add(self, path, handler, methods=None, host=None):
+        """
+        Send requests for path (which may contain {parameters}) to
+        handler; if methods is given, only for those methods, and if host
+        is, only for that host.
+        """
+        node = self._node(host, path.split("/")[1:])
+        node.handlers = _add_methods(node.handlers, handler, methods)
+
+    def mount(self, prefix, handler, methods=None, host=None):
+        """
+        Send requests for prefix and anything below it to handler, unless
+        there's a more specific route.
+        """
+        segments = prefix.rstrip("/").split("/")[1:]
+        node = self._node(host, segments)
+        node.mount = _add_methods(node.mount, handler, methods)
+
+    def route(self, method, host, path):
+        """
+        Find the handler for a request. Returns (handler, params),
+        (None, allowed methods) if the path matches but the method
+        doesn't, or (None, None) if nothing matches.
+        """
+        key = (host, path)
+        try:
+            handlers, params = self._cache[key]
+        except KeyError:
+            handlers, params, exact = None, None, False
+            if host is not None:
+                root = self._roots.get(host, None)
+                if root is not None:
+                    handlers, params, exact = _match(root, path)
+            if handlers is None:
+                handlers, params, exact = _match(self._roots[None], path)
+            if exact and params is None:
+                if len(self._cache) >= self.cache_size:
+                    self._cache.clear()
+                self._cache[key] = (handlers, params)
+        if handlers is None:
+            return None, None
+        handler = handlers.get(method, None)
+        if handler is None:
+            if method == "HEAD":
+                handler = handlers.get("GET", None)
+            if handler is None:
+                handler = handlers.get(None, None)
+            if handler is None:
+                allowed = handlers.keys()
+                if "GET" in allowed and "HEAD" not in allowed:
+                    allowed.append("HEAD")
+                return None, sorted(allowed)
+        return handler, params
+
+    def __call__(self, method, uri, req_hdrs, res_start, req_pause):
+        host = None
+        if uri[:1] == "/":
+            path = uri.split("?", 1)[0]
+            if self._by_host:
+                for name, value in req_hdrs:
+                    if name.lower() == "host":
+                        host = value
+                        break
+        else: # absolute-form
+            parts = urlsplit(uri)
+            path = parts.path or "/"
+            host = parts.netloc
+        if host is not None:
+            host = host.strip().lower().split(":", 1)[0]
+        handler, params = self.route(method, host, path)
+        if handler is not None:
+            if params:
+                return handler(method, uri, req_hdrs, res_start, req_pause,
+                               **params)
+            return handler(method, uri, req_hdrs, res_start, req_pause)
+        if params is not None:
+            _error(res_start, "405", "Method Not Allowed",
+                   [("Allow", ", ".join(params))])
+            return dummy, dummy
+        if self.not_found:
+            return self.not_found(method, uri, req_hdrs, res_start,
+                                  req_pause)
+        _error(res_start, "404", "Not Found")
+        return dummy, dummy
+
+    def _node(self, host, segments):
+        "Return the trie node for segments, creating it if necessary."
+        self._cache.clear()
+        if host is not None:
+            host = host.lower()
+            self._by_host = True
+        try:
+            node = self._roots[host]
+        except KeyError:
+            node = self._roots[host] = _Node()
+        for segment in segments:
+            if segment[:1] == "{" and segment[-1:] == "}":
+                name = segment[1:-1]
+                if node.param is None:
+                    node.param = (name, _Node())
+                elif node.param[0] != name:
+                    raise ValueError, \
+                        "Parameter {%s} conflicts with {%s}" % (
+                        name, node.param[0])
+                node = node.param[1]
+            else:
+                child = node.children.get(segment, None)
+                if child is None:
+                    child = node.children[segment] = _Node()
+                node = child
+        return node
+
+
+def _add_methods(handlers, handler, methods):
+    if handlers is None:
+        handlers = {}
+    for method in methods or [None]:
+        handlers[method] = handler
+    return handlers
+
+def _match(root, path):
+    """
+    Walk the trie from root for path; return (handlers, params, exact),
+    where exact is True if a route (rather than a mount) matched, or
+    (None, None, False).
+    """
+    node = root
+    params = None
+    mounted, mount_params = root.mount, None
+    for segment in path.split("/")[1:]:
+        child = node.children.get(segment, None)
+        if child is None:
+            if node.param is None:
+                return mounted, mount_params, False
+            name, child = node.param
+            if params is None:
+                params = {}
+            else:
+                params = params.copy()
+            params[name] = urllib.unquote(segment)
+        node = child
+        if node.mount is not None:
+            mounted, mount_params = node.mount, params
+    if node.handlers is not None:
+        return node.handlers, params, True
+    return mounted, mount_params, False
+
+def _error(res_start, status, phrase, res_hdrs=None):
+    "Send a short error response."
+    body = "%s %s" % (status, phrase)
+    hdrs = (res_hdrs or []) + [
+        ("Content-Type", "text/plain"),
+        ("Content-Length", str(len(body))),
+    ]
+    res_body, res_done = res_start(status, phrase, hdrs, dummy)
+    res_body(body)
+    res_done(None)
@@ -13,6 +13,7 @@ Instantiate a Server with the following parameters:
   - host (string)
   - port (int)
   - req_start (callable)
+  - tls (optional ssl.SSLContext; see push_tcp.server_context)
   
 req_start is called when a request starts. It must take the following
 arguments:
@@ -61,6 +62,61 @@ Where possible, errors in the request will be responded to with the
 appropriate 4xx HTTP status code. However, if a response has already been
 started, the connection will be dropped (for example, when the request
 chunking or indicated length are incorrect).
+
+If timing_sink is set on the Server, it's called with a TimingRecord for each
+request once its response is done; see the timing module.
+
+If access_log is set on the Server (to an access_log.AccessLog), each 
+response is logged to it.
+
+If metrics_path is set on the Server, requests for it are answered with the
+process's metrics (see the metrics module), instead of going to req_start.
+
+A response whose body comes from another connection unchanged (e.g., in a 
+proxy) can be relayed with res_body_relay, so that the body doesn't pass 
+through Python; see push_tcp.relay.
+
+If connect_handler is set on the Server, CONNECT requests go to it instead
+of req_start. It must take the following arguments:
+  - authority (string; "host:port")
+  - req_hdrs (list of (name, value) tuples)
+  - res_start (callable)
+  - detach (callable)
+To open the tunnel, call res_start with a 2xx status, then detach; this 
+stops handling the connection as HTTP (the response doesn't need res_done)
+and returns:
+  - tcp_conn (the push_tcp connection to the client, paused)
+  - data (string; anything the client has already sent through the tunnel)
+e.g., to pass to push_tcp.tunnel. detach must not be called until 
+connect_handler has returned. Any other response is sent as usual, and then
+the connection is closed.
+
+Connections waiting for a request are closed after idle_timeout seconds 
+(60 by default), and once a connection has had max_requests requests, it's closed after the
+response to the last one. If max_conns is set and a new connection would 
+take the server over it, the least recently used idle connections are 
+closed to make room (connections that are in use are left alone).
+
+Slow clients are shed, too: a request whose headers take more than 
+header_timeout seconds to arrive (counting from its first byte), or whose
+body stops arriving for body_timeout seconds, or arrives more slowly than 
+min_body_rate bytes a second (averaged over rate_interval seconds), gets a 
+408 (Request Timeout) response if one hasn't been started, and then the 
+connection is closed. While the application has paused the request body, 
+these clocks are stopped. By default, header_timeout is 30, body_timeout 
+is 60 and min_body_rate is None; set any of these (or idle_timeout) to 
+None to turn it off.
+
+If websocket_handler is set on the Server, WebSocket upgrade requests go to
+it instead of req_start; see the websocket module.
+
+If http2 is set on the Server, clients can also use HTTP/2 (without TLS), 
+either from the start of the connection or by upgrading from HTTP/1.1;
+requests are passed to req_start in the same way. See the http2 module.
+
+To shut down gracefully, call drain on the Server. It stops accepting 
+connections, closes idle ones, and closes the others once their current
+responses are done, calling done_cb (if given) when they're all closed.
 """
 
 __author__ = "Mark Nottingham <mnot@mnot.net>"
@@ -89,16 +145,23 @@ THE SOFTWARE.
 import os
 import sys
 import logging
+import socket
+import time
+from collections import OrderedDict
 
+import http2
+import metrics
 import push_tcp
+import timing
+import websocket
 from http_common import HttpMessageHandler, \
-    CLOSE, COUNTED, CHUNKED, \
+    CLOSE, COUNTED, CHUNKED, NOBODY, \
     WAITING, \
-    hop_by_hop_hdrs, \
+    hop_by_hop_hdrs, no_body_status, \
     dummy, get_hdr
 
 from error import ERR_HTTP_VERSION, ERR_HOST_REQ, \
-    ERR_WHITESPACE_HDR, ERR_TRANSFER_CODE
+    ERR_WHITESPACE_HDR, ERR_TRANSFER_CODE, ERR_REQ_TIMEOUT
 
 logging.basicConfig()
 log = logging.getLogger('server')
@@ -110,19 +173,221 @@ log.setLevel(logging.WARNING)
 
 class Server:
     "An asynchronous HTTP server."
-    def __init__(self, host, port, request_handler):
+    timing_sink = None
+    access_log = None
+    metrics_path = None
+    write_high = None # per-connection write watermarks; see push_tcp
+    write_low = None
+    connect_handler = None
+    websocket_handler = None
+    idle_timeout = 60
+    max_requests = None
+    max_conns = None
+    header_timeout = 30
+    body_timeout = 60
+    min_body_rate = None # bytes per second
+    rate_interval = 10
+    sweep_interval = 1
+    http2 = False
+
+    def __init__(self, host, port, request_handler, tls=None):
         self.request_handler = request_handler
-        push_tcp.create_server(host, port, self.handle_connection)
+        self.draining = False
+        self._conns = {}
+        self._idle = OrderedDict() # idle conn -> time, least recent first
+        self._deadlines = _Deadlines()
+        self._sweep_ev = None
+        self._drain_cb = None
+        self._listener = push_tcp.create_server(host, port, 
+                                                self.handle_connection, tls)
+
+    def drain(self, done_cb=None):
+        """
+        Stop accepting connections, close idle ones and close the rest once
+        their responses are done; then call done_cb.
+        """
+        self.draining = True
+        self._drain_cb = done_cb
+        if self._listener:
+            self._listener.close()
+            self._listener = None
+        while self._idle:
+            self._idle.iterkeys().next().close()
+        self._check_drained()
+
+    def stats(self):
+        "Return a dictionary of connection counts."
+        return {
+            'conns': len(self._conns),
+            'idle': len(self._idle),
+        }
         
     def handle_connection(self, tcp_conn):
         "Process a new push_tcp connection, tcp_conn."
-        conn = HttpServerConnection(self.request_handler, tcp_conn)
-        return conn._handle_input, conn._conn_closed, conn._res_body_pause
+        metrics.server_accepted.inc()
+        if self.max_conns and len(self._conns) >= self.max_conns:
+            self._shed(len(self._conns) - self.max_conns + 1)
+        if self.write_high:
+            tcp_conn.set_watermarks(self.write_high, self.write_low)
+        if self.metrics_path:
+            request_handler = self._metrics_handler
+        else:
+            request_handler = self.request_handler
+        conn = HttpServerConnection(request_handler, tcp_conn,
+            self.timing_sink, self.access_log, self.connect_handler, self)
+        self._conns[conn] = None
+        self._conn_idle(conn)
+        if self.timing_sink:
+            read_cb = conn._timed_input
+        else:
+            read_cb = conn._handle_input
+        return read_cb, conn._conn_closed, conn._res_body_pause
+
+    def _metrics_handler(self, method, uri, req_hdrs, res_start, req_pause):
+        "Answer requests for metrics_path; pass others to request_handler."
+        if uri.split("?", 1)[0] == self.metrics_path \
+        and method in ['GET', 'HEAD']:
+            metrics.respond(res_start)
+            return dummy, dummy
+        return self.request_handler(method, uri, req_hdrs, res_start, 
+                                    req_pause)
+
+    def _conn_idle(self, conn):
+        "conn is waiting for a request."
+        if self.draining:
+            conn.close()
+            return
+        self._idle.pop(conn, None)
+        self._idle[conn] = push_tcp.now()
+        if self._sweep_ev is None and self.idle_timeout:
+            self._sweep_ev = push_tcp.schedule(self.sweep_interval,
+                                               self._sweep)
+
+    def _conn_busy(self, conn):
+        "conn has started a request."
+        self._idle.pop(conn, None)
+
+    def _conn_gone(self, conn):
+        "conn has closed."
+        conn._deadline = None
+        self._idle.pop(conn, None)
+        self._conns.pop(conn, None)
+        if self.draining:
+            self._check_drained()
+
+    def _set_deadline(self, conn, when):
+        "Check on conn's request at when (or None to stop checking)."
+        self._deadlines.set(conn, when)
+        if when is not None and self._sweep_ev is None:
+            self._sweep_ev = push_tcp.schedule(self.sweep_interval,
+                                               self._sweep)
+
+    def _shed(self, num):
+        "Close up to num idle connections, least recently used first."
+        while num > 0 and self._idle:
+            self._idle.iterkeys().next().close()
+            num -= 1
+
+    def _sweep(self):
+        """
+        Close connections that have been idle for too long, and check on
+        requests whose deadlines have passed.
+        """
+        self._sweep_ev = None
+        now = push_tcp.now()
+        if self.idle_timeout:
+            cutoff = now - self.idle_timeout
+            while self._idle:
+                conn, idle_since = self._idle.iteritems().next()
+                if idle_since > cutoff:
+                    break
+                conn.close()
+        self._deadlines.expire(now)
+        if (self._idle and self.idle_timeout) or self._deadlines:
+            self._sweep_ev = push_tcp.schedule(self.sweep_interval,
+                                               self._sweep)
+
+    def _check_drained(self):
+        if not self._conns and self._drain_cb:
+            done_cb, self._drain_cb = self._drain_cb, None
+            done_cb()
+
+
+class _Deadlines:
+    """
+    Connection deadlines, in one-second buckets. Putting a deadline off is
+    just an assignment to conn._deadline; if a connection's bucket comes up
+    before its deadline, it's moved to a later one then. When a deadline
+    passes, conn._deadline_reached is called.
+    """
+    def __init__(self):
+        self._buckets = {} # second -> list of conns
+        self._next = None  # no bucket is earlier than this
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def set(self, conn, when):
+        conn._deadline = when
+        if when is not None:
+            self._add(conn, int(when))
+
+    def _add(self, conn, second):
+        if conn._deadline_bucket is not None \
+        and conn._deadline_bucket <= second:
+            return # it'll be looked at in time.
+        conn._deadline_bucket = second
+        try:
+            self._buckets[second].append(conn)
+        except KeyError:
+            self._buckets[second] = [conn]
+        if self._next is None or second < self._next:
+            self._next = second
+
+    def expire(self, now):
+        if self._next is None:
+            return
+        end = int(now)
+        while self._next <= end and self._buckets:
+            second = self._next
+            self._next += 1
+            for conn in self._buckets.pop(second, []):
+                if conn._deadline_bucket != second:
+                    continue # it was moved to an earlier bucket
+                conn._deadline_bucket = None
+                when = conn._deadline
+                if when is None:
+                    continue
+                if when > now:
+                    self._add(conn, max(int(when), end + 1))
+                else:
+                    conn._deadline = None
+                    conn._deadline_reached()
+        if not self._buckets:
+            self._next = None
 
 
 class HttpServerConnection(HttpMessageHandler):
-    "A handler for an HTTP server connection."
-    def __init__(self, request_handler, tcp_conn):
+    """
+    A handler for an HTTP server connection. Its state is kept in slots,
+    since most of them are usually idle; per-request references are
+    dropped when it becomes idle.
+    """
+    __slots__ = ['request_handler', '_tcp_conn', 'req_body_cb',
+                 'req_done_cb', 'method', 'req_version', 'connection_hdr',
+                 '_res_body_pause_cb', 'timing_sink', '_timing',
+                 '_requests', '_msg_arrived', '_pending_in', 'access_log',
+                 '_remote', '_req_method', '_req_uri', '_req_time',
+                 '_res_status', '_res_bytes', 'connect_handler',
+                 '_tunnel_data', 'server', '_served', '_idle',
+                 '_req_complete', '_res_complete', '_close_after',
+                 '_deadline', '_deadline_bucket', '_req_begun',
+                 '_req_paused', '_last_read', '_bytes_read', '_rate_since',
+                 '_rate_bytes', '_upgrade', '_upgrade_data', '_ws_key',
+                 '_ws_data']
+
+    def __init__(self, request_handler, tcp_conn, timing_sink=None,
+                 access_log=None, connect_handler=None, server=None):
         HttpMessageHandler.__init__(self)
         self.request_handler = request_handler
         self._tcp_conn = tcp_conn
@@ -132,6 +397,43 @@ class HttpServerConnection(HttpMessageHandler):
         self.req_version = None
         self.connection_hdr = []
         self._res_body_pause_cb = None
+        self.timing_sink = timing_sink
+        self._timing = None
+        self._requests = 0
+        self._msg_arrived = None
+        self._pending_in = 0
+        self.access_log = access_log
+        self._remote = None
+        self._req_method = None
+        self._req_uri = None
+        self._req_time = None
+        self._res_status = None
+        self._res_bytes = 0
+        self.connect_handler = connect_handler
+        self._tunnel_data = None
+        self.server = server
+        self._served = 0
+        self._idle = True
+        self._req_complete = False
+        self._res_complete = False
+        self._close_after = False
+        self._deadline = None
+        self._deadline_bucket = None
+        self._req_begun = None
+        self._req_paused = False
+        self._last_read = None
+        self._bytes_read = 0
+        self._rate_since = None
+        self._rate_bytes = 0
+        self._upgrade = None
+        self._upgrade_data = None
+        self._ws_key = None
+        self._ws_data = None
+        if access_log:
+            try:
+                self._remote = tcp_conn.socket.getpeername()[0]
+            except (socket.error, AttributeError):
+                pass
 
     def res_start(self, status_code, status_phrase, res_hdrs, res_body_pause):
         "Start a response. Must only be called once per response."
@@ -143,25 +445,76 @@ class HttpServerConnection(HttpMessageHandler):
             body_len = int(get_hdr(res_hdrs, "content-length").pop(0))
         except (IndexError, ValueError):
             body_len = None
-        if body_len is not None:
-            delimit = COUNTED
-            res_hdrs.append(("Connection", "keep-alive"))
-        elif 2.0 > self.req_version >= 1.1:
-            delimit = CHUNKED
-            res_hdrs.append(("Transfer-Encoding", "chunked"))
+        if self._tunnel_data is not None: # CONNECT
+            if status_code[:1] == "2":
+                delimit = NOBODY
+                res_hdrs = [i for i in res_hdrs if i[0].lower() not in
+                            ['content-length', 'transfer-encoding']]
+            else:
+                delimit = CLOSE
+                res_hdrs.append(("Connection", "close"))
         else:
-            delimit = CLOSE
-            res_hdrs.append(("Connection", "close"))
-
+            if status_code in no_body_status or self.method == "HEAD":
+                delimit = NOBODY
+            elif body_len is not None:
+                delimit = COUNTED
+            elif 2.0 > self.req_version >= 1.1:
+                delimit = CHUNKED
+                res_hdrs.append(("Transfer-Encoding", "chunked"))
+            else:
+                delimit = CLOSE
+            server = self.server
+            if server and (server.draining or (server.max_requests and \
+            self._served >= server.max_requests)):
+                self._close_after = True
+            if delimit == CLOSE or self._close_after:
+                res_hdrs.append(("Connection", "close"))
+            elif delimit != CHUNKED:
+                res_hdrs.append(("Connection", "keep-alive"))
+
+        self._res_status = status_code
+        metrics.server_requests.inc(labels=(status_code,))
+        if self._timing:
+            self._timing.status = status_code
+        # the connection may still be draining an earlier response
+        was_paused = self._tcp_conn and self._tcp_conn.write_paused
         self._output_start("HTTP/1.1 %s %s" % (status_code, status_phrase),
             res_hdrs, delimit
         )
+        if was_paused:
+            res_body_pause(True)
         return self.res_body, self.res_done
 
     def res_body(self, chunk):
         "Send part of the response body. May be called zero to many times."
         self._output_body(chunk)
 
+    def res_body_relay(self, src_conn, length, done_cb, idle_timeout=None):
+        """
+        Send the rest of the response body -- length bytes, or if length is
+        None, everything until it closes -- straight from the push_tcp 
+        connection src_conn, if the response is delimited the same way. 
+        Returns True if it's being relayed; done_cb is then called as
+        described in push_tcp.relay, and res_done still needs to be called.
+        """
+        if not self._tcp_conn or not self._tcp_conn.tcp_connected:
+            return False
+        if length is None:
+            if self._output_delimit != CLOSE:
+                return False
+        elif self._output_delimit != COUNTED:
+            return False
+        def relayed(moved, err):
+            self._res_bytes += moved
+            if self._timing:
+                self._timing.mark('res_first_byte')
+                self._timing.marks['res_last_byte'] = time.time()
+                self._timing.bytes_out += moved
+            done_cb(moved, err)
+        push_tcp.relay(src_conn, self._tcp_conn, length, relayed,
+                       idle_timeout)
+        return True
+
     def res_done(self, err=None):
         """
         Signal the end of the response, whether or not there was a body. MUST
@@ -172,12 +525,38 @@ class HttpServerConnection(HttpMessageHandler):
         in the generation of the response; this is useful for debugging.
         """
         self._output_end(err)
+        if self._timing:
+            record, self._timing = self._timing, None
+            record.finish(self.timing_sink, err)
+        duration = time.time() - self._req_time
+        metrics.server_duration.observe(duration)
+        if self.access_log:
+            self.access_log.log(self._remote, self._req_method,
+                self._req_uri, self._res_status, self._res_bytes, duration)
+        if self._tunnel_data is not None and self._output_delimit == NOBODY:
+            return # the connection is about to be detached.
+        tcp_conn = self._tcp_conn
+        if not tcp_conn or not tcp_conn.tcp_connected or tcp_conn._closing \
+        or self._close_after or (self.server and self.server.draining):
+            self.close()
+        else:
+            self._res_complete = True
+            self._check_idle()
+
+    def close(self):
+        "Close the connection (after writing anything buffered)."
+        if self._tcp_conn:
+            self._tcp_conn.close()
+            self._tcp_conn = None
+        if self.server:
+            self.server._conn_gone(self)
 
     def req_body_pause(self, paused):
         """
         Indicate that the server should pause (True) or unpause (False) the
         request.
         """
+        self._req_paused = paused
         if self._tcp_conn and self._tcp_conn.tcp_connected:
             self._tcp_conn.pause(paused)
 
@@ -189,18 +568,127 @@ class HttpServerConnection(HttpMessageHandler):
             self._res_body_pause_cb(paused)
 
     def _conn_closed(self):
-        "The server connection has closed."
-        if self._output_state != WAITING:
-            pass # FIXME: any cleanup necessary?
-#        self.pause()
-#        self._queue = []
-#        self.tcp_conn.handler = None
-#        self.tcp_conn = None
+        "The client has closed the connection."
+        # anything the application still writes is dropped.
+        self._tcp_conn = None
+        if self.server:
+            self.server._conn_gone(self)
+
+    def _check_idle(self):
+        "If the request and response are both done, wait for another."
+        if self._req_complete and self._res_complete and self._tcp_conn:
+            self._req_complete = self._res_complete = False
+            self._idle = True
+            self.req_body_cb = self.req_done_cb = None
+            self._res_body_pause_cb = None
+            if self.server:
+                self.server._conn_idle(self)
+
+    def _handle_input(self, instr):
+        if self._served == 0 and self._input_state == WAITING \
+        and self.server and self.server.http2:
+            data = self._input_buffer + instr
+            if data[:len(http2.preface)] == http2.preface:
+                self._input_buffer = ""
+                self._start_http2(data)
+                return
+            if http2.preface[:len(data)] == data:
+                self._input_buffer = data
+                return
+        self._last_read = now = push_tcp.now()
+        self._bytes_read += len(instr)
+        if self._idle and instr:
+            self._idle = False
+            self._req_begun = now
+            if self.server:
+                self.server._conn_busy(self)
+        HttpMessageHandler._handle_input(self, instr)
+        if self._upgrade is not None:
+            self._switch_to_h2c()
+            return
+        if self._deadline is None and self.server:
+            # the request didn't all arrive at once; keep an eye on it.
+            self._deadline_reached()
+
+    def _body_deadline(self):
+        "Return when the request body should next be checked on, or None."
+        server = self.server
+        deadlines = []
+        if server.body_timeout:
+            deadlines.append(self._last_read + server.body_timeout)
+        if server.min_body_rate:
+            deadlines.append(self._rate_since + server.rate_interval)
+        return deadlines and min(deadlines) or None
+
+    def _deadline_reached(self):
+        "See if the request is arriving quickly enough."
+        server = self.server
+        if self._idle or self._req_complete or not self._tcp_conn \
+        or self._tunnel_data is not None or self._ws_data is not None:
+            return
+        now = push_tcp.now()
+        if self._input_state == WAITING: # still reading headers
+            if not server.header_timeout:
+                return
+            if now - self._req_begun >= server.header_timeout:
+                self._request_timeout("headers took too long")
+            else:
+                server._set_deadline(self,
+                                     self._req_begun + server.header_timeout)
+            return
+        if self._req_paused:
+            self._last_read = self._rate_since = now
+            self._rate_bytes = self._bytes_read
+        elif server.body_timeout \
+        and now - self._last_read >= server.body_timeout:
+            self._request_timeout("request body stalled")
+            return
+        elif server.min_body_rate \
+        and now - self._rate_since >= server.rate_interval:
+            rate = (self._bytes_read - self._rate_bytes) / \
+                   (now - self._rate_since)
+            if rate < server.min_body_rate:
+                self._request_timeout("request body too slow")
+                return
+            self._rate_since = now
+            self._rate_bytes = self._bytes_read
+        server._set_deadline(self, self._body_deadline())
+
+    def _request_timeout(self, detail):
+        "The client is taking too long to send the request; give up on it."
+        if self._input_state == WAITING: # nothing has been seen of it
+            self.method = None
+            self._req_time = self._req_begun
+            self._req_method = self._req_uri = "-"
+            self._res_bytes = 0
+            self._handle_error(ERR_REQ_TIMEOUT, detail)
+        elif self._output_state == WAITING and not self._res_complete:
+            self._handle_error(ERR_REQ_TIMEOUT, detail)
+            self.req_done_cb(ERR_REQ_TIMEOUT)
+        else: # the response has started, or finished already.
+            self._input_error(ERR_REQ_TIMEOUT, detail)
 
     # Methods called by common.HttpRequestHandler
 
     def _output(self, chunk):
-        self._tcp_conn.write(chunk)
+        self._res_bytes += len(chunk)
+        if self._timing:
+            now = time.time()
+            self._timing.mark('res_first_byte', now)
+            self._timing.marks['res_last_byte'] = now
+            self._timing.bytes_out += len(chunk)
+        if self._tcp_conn: # the connection may have failed.
+            self._tcp_conn.write(chunk)
+
+    def _timed_input(self, instr):
+        "_handle_input, keeping track of timing."
+        if self._timing:
+            self._timing.bytes_in += len(instr)
+        else:
+            if not self._pending_in:
+                self._msg_arrived = time.time()
+            self._pending_in += len(instr)
+        self._handle_input(instr)
 
     def _input_start(self, top_line, hdr_tuples, conn_tokens, 
         transfer_codes, content_length):
@@ -209,6 +697,11 @@ class HttpServerConnection(HttpMessageHandler):
         and queue the request to be processed by the application.
         """
         assert self._input_state == WAITING, "pipelining not supported" 
+        self._req_time = time.time()
+        self._served += 1
+        if self.access_log:
+            self._req_method = self._req_uri = "-"
+            self._res_bytes = 0
         # FIXME: pipelining
         try: 
             method, _req_line = top_line.split(None, 1)
@@ -234,15 +727,161 @@ class HttpServerConnection(HttpMessageHandler):
         #        name and colon
         self.method = method
         self.connection_hdr = conn_tokens
+        if 'close' in conn_tokens or (self.req_version < 1.1 and \
+        'keep-alive' not in conn_tokens):
+            self._close_after = True
 
         log.info("%s server req_start %s %s %s" % (
             id(self), method, uri, self.req_version)
         )
-        self.req_body_cb, self.req_done_cb = self.request_handler(
+        if self.timing_sink:
+            self._start_timing(method, uri)
+        if self.access_log:
+            self._req_method, self._req_uri = method, uri
+        previous, timing.current = timing.current, self._timing
+        try:
+            if method == "CONNECT" and self.connect_handler:
+                # anything after the request is for the tunnel; hold it,
+                # reading the rest of the input as if close-delimited.
+                self._tunnel_data = []
+                self.req_body_cb = self._tunnel_data.append
+                self.req_done_cb = dummy
+                self.connect_handler(uri, hdr_tuples, self.res_start,
+                                     self._detach)
+                return True
+            if method == "GET" and self.server \
+            and self.server.websocket_handler \
+            and self._wants_websocket(hdr_tuples, conn_tokens):
+                # the response is either the handshake, or the last one.
+                self._close_after = True
+                self._ws_data = []
+                self.req_body_cb = self._ws_data.append
+                self.req_done_cb = dummy
+                self.server.websocket_handler(uri, hdr_tuples,
+                    self.res_start, self._accept_websocket)
+                return True
+            if self.server and self.server.http2 and not transfer_codes \
+            and not content_length \
+            and self._wants_h2c(method, uri, hdr_tuples, conn_tokens):
+                return True
+            self.req_body_cb, self.req_done_cb = self.request_handler(
                 method, uri, hdr_tuples, self.res_start, self.req_body_pause)
+        finally:
+            timing.current = previous
         allows_body = (content_length) or (transfer_codes != [])
+        self._deadline = None
+        self._rate_since = self._req_time
+        self._rate_bytes = self._bytes_read
         return allows_body
 
+    def _detach(self):
+        """
+        Stop handling the connection as HTTP, after a 2xx response to
+        CONNECT. Returns the push_tcp connection and any tunnel data
+        already received.
+        """
+        data = "".join(self._tunnel_data or [])
+        if self._output_state != WAITING:
+            self.res_done()
+        self._tunnel_data = None
+        tcp_conn, self._tcp_conn = self._tcp_conn, None
+        if tcp_conn:
+            tcp_conn.pause(True)
+            tcp_conn.read_cb = tcp_conn.close_cb = tcp_conn.pause_cb = dummy
+        self.req_body_cb = self.req_done_cb = dummy
+        if self.server:
+            self.server._conn_gone(self)
+        return tcp_conn, data
+
+    def _wants_websocket(self, hdr_tuples, conn_tokens):
+        "Return True if the request is a WebSocket opening handshake."
+        if 'upgrade' not in conn_tokens or 'websocket' not in \
+        [t.lower() for t in get_hdr(hdr_tuples, 'upgrade')]:
+            return False
+        keys = get_hdr(hdr_tuples, 'sec-websocket-key')
+        if len(keys) != 1 or \
+        get_hdr(hdr_tuples, 'sec-websocket-version') != ['13']:
+            return False
+        self._ws_key = keys[0]
+        return True
+
+    def _accept_websocket(self, message_cb, close_cb, pause_cb,
+                          protocol=None):
+        """
+        Finish the WebSocket handshake, and hand the connection over to a
+        WebSocket, which is returned (or None, if the client has gone).
+        """
+        data = "".join(self._ws_data)
+        self._ws_data = None
+        self.req_body_cb = self.req_done_cb = dummy
+        self._timing = None
+        tcp_conn, self._tcp_conn = self._tcp_conn, None
+        if self.server:
+            self.server._conn_gone(self)
+        if not tcp_conn:
+            close_cb(websocket.ABNORMAL, "")
+            return None
+        res_hdrs = [
+            "HTTP/1.1 101 Switching Protocols",
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            "Sec-WebSocket-Accept: %s" % websocket.accept_key(self._ws_key),
+        ]
+        if protocol:
+            res_hdrs.append("Sec-WebSocket-Protocol: %s" % protocol)
+        tcp_conn.write("\r\n".join(res_hdrs) + "\r\n\r\n")
+        metrics.server_requests.inc(labels=("101",))
+        if self.access_log:
+            self.access_log.log(self._remote, self._req_method,
+                self._req_uri, "101", 0, time.time() - self._req_time)
+        conn = websocket.WebSocket(tcp_conn, message_cb, close_cb, pause_cb)
+        if data:
+            conn.handle_input(data)
+        return conn
+
+    def _wants_h2c(self, method, uri, hdr_tuples, conn_tokens):
+        """
+        If the request asks to upgrade to HTTP/2, get ready to, holding
+        anything that follows it, and return True.
+        """
+        if 'upgrade' not in conn_tokens \
+        or 'http2-settings' not in conn_tokens \
+        or 'h2c' not in [t.lower() for t in get_hdr(hdr_tuples, 'upgrade')]:
+            return False
+        settings = get_hdr(hdr_tuples, 'http2-settings')
+        if len(settings) != 1:
+            return False
+        strip = conn_tokens + hop_by_hop_hdrs + ['http2-settings']
+        req_hdrs = [(n, v) for (n, v) in hdr_tuples
+                    if n.strip().lower() not in strip]
+        self._upgrade = (method, uri, req_hdrs, settings[0])
+        self._upgrade_data = []
+        self.req_body_cb = self._upgrade_data.append
+        self.req_done_cb = dummy
+        return True
+
+    def _switch_to_h2c(self):
+        "Answer an upgrade request, and start using HTTP/2."
+        upgrade, self._upgrade = self._upgrade, None
+        data = "".join(self._upgrade_data)
+        self._upgrade_data = None
+        self._timing = None
+        if self._tcp_conn:
+            self._tcp_conn.write("HTTP/1.1 101 Switching Protocols\r\n"
+                "Connection: Upgrade\r\nUpgrade: h2c\r\n\r\n")
+            self._start_http2(data, upgrade)
+
+    def _start_http2(self, data, upgrade=None):
+        "Hand the connection over to HTTP/2."
+        tcp_conn, self._tcp_conn = self._tcp_conn, None
+        self.req_body_cb = self.req_done_cb = dummy
+        conn = http2.Http2ServerConnection(tcp_conn, self.request_handler,
+            self.server, self.access_log, upgrade)
+        if self.server:
+            self.server._conn_gone(self)
+        if data:
+            conn.handle_input(data)
+
     def _input_body(self, chunk):
         "Process a request body chunk from the wire."
         self.req_body_cb(chunk)
@@ -250,25 +889,44 @@ class HttpServerConnection(HttpMessageHandler):
     def _input_end(self):
         "Indicate that the request body is complete."
         self.req_done_cb(None)
+        self._req_complete = True
+        self._deadline = None
+        self._check_idle()
 
     def _input_error(self, err, detail=None):
         "Indicate a parsing problem with the request body."
+        metrics.server_errors.inc(labels=(err['desc'],))
         err['detail'] = detail
-        if self._tcp_conn:
-            self._tcp_conn.close()
-            self._tcp_conn = None
-        self.req_done_cb(err)
+        if self._timing:
+            record, self._timing = self._timing, None
+            record.finish(self.timing_sink, err)
+        self.close()
+        if self.req_done_cb: # None if the connection was idle
+            self.req_done_cb(err)
+
+    def _start_timing(self, method, uri):
+        "Start a TimingRecord for the request that's just arrived."
+        self._requests += 1
+        record = timing.TimingRecord('server', method, uri,
+                                     start=self._msg_arrived)
+        record.conn_reused = self._requests > 1
+        record.mark('req_headers')
+        record.bytes_in = self._pending_in
+        self._pending_in = 0
+        self._timing = record
 
     def _handle_error(self, err, detail=None):
         """
         Handle a problem with the request by generating an appropriate
         response.
         """
+        metrics.server_errors.inc(labels=(err['desc'],))
 #   self._queue.append(ErrorHandler(status_code, status_phrase, body, self))
         assert self._output_state == WAITING
         if detail:
             err['detail'] = detail
         status_code, status_phrase = err.get('status', ('400', 'Bad Request'))
+        self._close_after = True
         hdrs = [
             ('Content-Type', 'text/plain'),
         ]
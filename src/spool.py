@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+"""
+Request body spooling
+
+A BodySpool collects a request body for a request_handler that needs all
+of it before it can respond. Bodies up to threshold bytes are kept in
+memory; past that, the body is written to a temporary file, by a thread,
+so that the loop doesn't wait for the disk;
+
+> def request_handler(method, uri, req_hdrs, res_start, req_pause):
+>     def done(body, err):
+>         if err:
+>             return
+>         data = body.read(1024)
+>         ...
+>     spool = BodySpool(req_pause, done)
+>     return spool.req_body, spool.req_done
+
+done is called once the whole body has been collected, with:
+  - body (file-like object, at the start of the body; None if err)
+  - err (error dictionary, or None)
+err is the error the request failed with, or ERR_SPOOL if the body
+couldn't be written. The body's length is in spool.size, and spool.spooled
+is True if it went to a file. Closing body removes the file.
+
+Writes to the file are gathered into write_size bytes each. When more than
+max_pending bytes are waiting to be written, the request is paused (with
+req_pause), until the writer catches up.
+
+spooled wraps a function that takes the whole body as a request_handler;
+
+> def handle(method, uri, req_hdrs, res_start, body):
+>     ...
+> server = Server(host, port, spooled(handle))
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import logging
+import tempfile
+import threading
+from cStringIO import StringIO
+from Queue import Queue
+
+import push_tcp
+from http_common import dummy
+
+log = logging.getLogger('spool')
+
+ERR_SPOOL = {
+    'desc': "Request body couldn't be stored",
+    'status': ("500", "Internal Server Error"),
+}
+
+_DONE = object() # tells the writer that a body is complete
+
+
+class BodySpool:
+    "Collects a request body, in memory or in a temporary file."
+    threshold = 1024 * 256 # bytes kept in memory
+    write_size = 1024 * 64 # bytes gathered for each write to the file
+    max_pending = 1024 * 1024 # bytes waiting to be written before pausing
+    spool_dir = None # where temporary files go; default is tempfile's
+
+    def __init__(self, req_pause, done_cb):
+        self.req_pause = req_pause
+        self.done_cb = done_cb
+        self.size = 0
+        self.spooled = False
+        self._body = StringIO() # or the temporary file, once spooled
+        self._buffer = []
+        self._buffered = 0
+        self._pending = 0 # bytes given to the writer, not yet written
+        self._paused = False
+        self._done = False
+        self._cancelled = False # the request failed
+        self._err = None # set by the writer if a write fails
+
+    # Methods called in the loop's thread
+
+    def req_body(self, chunk):
+        "Collect part of the body."
+        if self._done:
+            return
+        self.size += len(chunk)
+        if not self.spooled:
+            self._body.write(chunk)
+            if self.size > self.threshold:
+                self._spool()
+            return
+        self._buffer.append(chunk)
+        self._buffered += len(chunk)
+        if self._buffered >= self.write_size:
+            self._flush()
+
+    def req_done(self, err):
+        "The body is complete (or the request failed, if err is set)."
+        if self._done:
+            return
+        self._done = True
+        if self._paused: # there's nothing more to hold back.
+            self._paused = False
+            self.req_pause(False)
+        if err:
+            self._cancelled = True
+            self._buffer = []
+            if self.spooled:
+                _writer().queue.put((self, _DONE)) # it closes the file
+            else:
+                self._body = None
+            self.done_cb(None, err)
+        elif self.spooled:
+            self._flush()
+            _writer().queue.put((self, _DONE))
+        else:
+            self._body.seek(0)
+            body, self._body = self._body, None
+            self.done_cb(body, None)
+
+    def _spool(self):
+        "Move the body to a temporary file."
+        data = self._body.getvalue()
+        try:
+            self._body = tempfile.TemporaryFile(dir=self.spool_dir)
+        except (IOError, OSError), why:
+            log.error("Can't create spool file: %s" % why)
+            self._fail()
+            return
+        self.spooled = True
+        self._buffer = [data]
+        self._buffered = len(data)
+        self._flush()
+
+    def _flush(self):
+        "Give what's buffered to the writer."
+        if not self._buffer:
+            return
+        data = "".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._pending += len(data)
+        _writer().queue.put((self, data))
+        if not self._paused and self._pending > self.max_pending:
+            self._paused = True
+            self.req_pause(True)
+
+    def _written(self, size):
+        "The writer has written size bytes."
+        self._pending -= size
+        if self._paused and self._pending <= self.max_pending / 2:
+            self._paused = False
+            self.req_pause(False)
+
+    def _finished(self):
+        "The writer is done with the body."
+        if self._cancelled:
+            return
+        if self._err:
+            self._fail()
+            return
+        body, self._body = self._body, None
+        self.done_cb(body, None)
+
+    def _fail(self):
+        "The body can't be stored; discard it and report the error."
+        self._done = True
+        self._buffer = []
+        if self._paused:
+            self._paused = False
+            self.req_pause(False)
+        self.done_cb(None, ERR_SPOOL)
+
+    # Methods called in the writer's thread
+
+    def _write(self, data):
+        if data is _DONE:
+            if not (self._cancelled or self._err):
+                try:
+                    self._body.flush()
+                    self._body.seek(0)
+                except (IOError, OSError), why:
+                    self._write_error(why)
+            if self._cancelled or self._err:
+                self._body.close()
+            push_tcp.call_from_thread(self._finished)
+            return
+        if self._err is None:
+            try:
+                self._body.write(data)
+            except (IOError, OSError), why:
+                self._write_error(why)
+        push_tcp.call_from_thread(self._written, len(data))
+
+    def _write_error(self, why):
+        log.error("Can't write to spool file: %s" % why)
+        self._err = why
+
+
+class _Writer:
+    "A thread that writes spooled bodies to their files, in order."
+    def __init__(self):
+        self.queue = Queue()
+        thread = threading.Thread(target=self._work, name="spool-writer")
+        thread.setDaemon(True)
+        thread.start()
+
+    def _work(self):
+        while True:
+            spool, data = self.queue.get()
+            try:
+                spool._write(data)
+            except:
+                log.error("Error in spool writer", exc_info=True)
+            spool = data = None # so that an abandoned body can be freed
+
+_the_writer = None
+_writer_lock = threading.Lock()
+
+def _writer():
+    "Return the writer, starting it if necessary."
+    global _the_writer
+    if _the_writer is None:
+        _writer_lock.acquire()
+        try:
+            if _the_writer is None:
+                _the_writer = _Writer()
+        finally:
+            _writer_lock.release()
+    return _the_writer
+
+
+def spooled(body_handler):
+    """
+    Return a request_handler that collects each request's body with a
+    BodySpool, then calls body_handler with (method, uri, req_hdrs,
+    res_start, body). If the request fails, body_handler isn't called;
+    if the body can't be stored, a 500 (Internal Server Error) is sent.
+    """
+    def request_handler(method, uri, req_hdrs, res_start, req_pause):
+        def done(body, err):
+            if err is ERR_SPOOL:
+                _send_error(res_start)
+            elif not err:
+                body_handler(method, uri, req_hdrs, res_start, body)
+        spool = BodySpool(req_pause, done)
+        return spool.req_body, spool.req_done
+    return request_handler
+
+def _send_error(res_start):
+    status, phrase = ERR_SPOOL['status']
+    body = "%s %s" % (status, phrase)
+    res_body, res_done = res_start(status, phrase, [
+        ("Content-Type", "text/plain"),
+        ("Content-Length", str(len(body))),
+    ], dummy)
+    res_body(body)
+    res_done(None)
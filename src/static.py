@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+
+"""
+Static file serving
+
+StaticFiles is a Server request_handler that serves files from a
+directory;
+
+> server = Server(host, port, StaticFiles("/var/www", prefix="/static/"))
+
+It supports conditional requests (If-None-Match, If-Modified-Since) and
+byte ranges (including multiple ranges, with If-Range).
+
+The results of stat() are cached for stat_ttl seconds, so busy files
+aren't checked on every request. Files no bigger than max_cached_size are
+kept in memory (up to max_cache_bytes in all, least recently used first
+out); larger files are read and sent chunk_size bytes at a time, observing
+res_body_pause.
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import mimetypes
+import os
+import random
+import stat
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from urllib import unquote
+from urlparse import urlsplit
+
+import push_tcp
+from http_common import dummy, header_dict
+
+
+class StaticFiles:
+    "A request_handler that serves files from a directory."
+    stat_ttl = 2
+    max_cached_size = 1024 * 64
+    max_cache_bytes = 1024 * 1024 * 16
+    chunk_size = 1024 * 64
+    max_ranges = 16
+    default_type = "application/octet-stream"
+
+    def __init__(self, root, prefix="/"):
+        self.root = os.path.abspath(root)
+        self.prefix = prefix
+        self._meta = {}     # path -> _FileMeta
+        self._cache = {}    # path -> [content, last used]
+        self._cached_bytes = 0
+        self._uses = 0
+
+    def __call__(self, method, uri, req_hdrs, res_start, req_pause):
+        if method not in ['GET', 'HEAD']:
+            _error(res_start, "405", "Method Not Allowed",
+                   [("Allow", "GET, HEAD")])
+            return dummy, dummy
+        path = self._path(uri)
+        meta = path and self._stat(path)
+        if not meta:
+            _error(res_start, "404", "Not Found")
+            return dummy, dummy
+        hdrs = header_dict(req_hdrs)
+        res_hdrs = [
+            ("ETag", meta.etag),
+            ("Last-Modified", meta.last_modified),
+        ]
+        if self._not_modified(meta, hdrs):
+            res_body, res_done = res_start("304", "Not Modified",
+                                           res_hdrs, dummy)
+            res_done(None)
+            return dummy, dummy
+        res_hdrs.append(("Accept-Ranges", "bytes"))
+        ranges = None
+        if method == "GET" and hdrs.has_key('range') \
+        and self._if_range(meta, hdrs):
+            ranges = _parse_ranges(hdrs['range'], meta.size)
+            if ranges == []:
+                res_hdrs.append(("Content-Range", "bytes */%s" % meta.size))
+                _error(res_start, "416", "Requested Range Not Satisfiable",
+                       res_hdrs)
+                return dummy, dummy
+            if ranges and len(ranges) > self.max_ranges:
+                ranges = None
+        if ranges is None:
+            status, phrase = "200", "OK"
+            res_hdrs.append(("Content-Type", meta.content_type))
+            parts = [(0, meta.size)]
+            length = meta.size
+        elif len(ranges) == 1:
+            status, phrase = "206", "Partial Content"
+            start, end = ranges[0]
+            res_hdrs.append(("Content-Type", meta.content_type))
+            res_hdrs.append(("Content-Range", "bytes %s-%s/%s" % (
+                start, end - 1, meta.size)))
+            parts = [(start, end)]
+            length = end - start
+        else:
+            status, phrase = "206", "Partial Content"
+            boundary = "%x" % random.getrandbits(64)
+            res_hdrs.append(("Content-Type",
+                "multipart/byteranges; boundary=%s" % boundary))
+            parts = []
+            for (start, end) in ranges:
+                parts.append("\r\n--%s\r\nContent-Type: %s\r\n"
+                    "Content-Range: bytes %s-%s/%s\r\n\r\n" % (
+                    boundary, meta.content_type, start, end - 1, meta.size))
+                parts.append((start, end))
+            parts.append("\r\n--%s--\r\n" % boundary)
+            length = sum([isinstance(p, str) and len(p) or p[1] - p[0]
+                          for p in parts])
+        res_hdrs.append(("Content-Length", str(length)))
+        if method == "HEAD":
+            res_body, res_done = res_start(status, phrase, res_hdrs, dummy)
+            res_done(None)
+            return dummy, dummy
+        content = self._content(path, meta)
+        _FileSender(path, content, parts, res_start, status, phrase,
+                    res_hdrs, self.chunk_size)
+        return dummy, dummy
+
+    def invalidate(self, path=None):
+        "Forget what we know about path (relative to root), or everything."
+        if path is None:
+            self._meta = {}
+            self._cache = {}
+            self._cached_bytes = 0
+        else:
+            path = os.path.join(self.root, path.lstrip("/"))
+            self._meta.pop(path, None)
+            self._uncache(path)
+
+    def _path(self, uri):
+        "Map uri to a file under root, or return None."
+        path = unquote(urlsplit(uri)[2])
+        if not path.startswith(self.prefix) or "\0" in path:
+            return None # the OS can't look up a path with a NUL in it.
+        path = os.path.normpath(
+            os.path.join(self.root, path[len(self.prefix):].lstrip("/")))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def _stat(self, path):
+        "Return the (possibly cached) _FileMeta for path, or None."
+        now = push_tcp.now()
+        meta = self._meta.get(path, None)
+        if meta and now - meta.checked < self.stat_ttl:
+            return meta
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            if meta:
+                del self._meta[path]
+                self._uncache(path)
+            return None
+        if meta and (meta.mtime, meta.size) == (int(st.st_mtime),
+                                                st.st_size):
+            meta.checked = now
+            return meta
+        self._uncache(path)
+        meta = self._meta[path] = _FileMeta(path, st, now,
+                                            self.default_type)
+        return meta
+
+    def _not_modified(self, meta, hdrs):
+        "Whether the request's conditional headers allow a 304."
+        if hdrs.has_key('if-none-match'):
+            etags = [e.strip() for e in hdrs['if-none-match'].split(",")]
+            return meta.etag in etags or "*" in etags
+        if hdrs.has_key('if-modified-since'):
+            since = _parse_date(hdrs['if-modified-since'])
+            return since is not None and meta.mtime <= since
+        return False
+
+    def _if_range(self, meta, hdrs):
+        "Whether an If-Range condition (if any) holds."
+        if not hdrs.has_key('if-range'):
+            return True
+        cond = hdrs['if-range']
+        if cond.startswith('"') or cond.startswith('W/'):
+            return cond == meta.etag
+        return _parse_date(cond) == meta.mtime
+
+    def _content(self, path, meta):
+        "Return the content of a small file, from cache if possible."
+        if meta.size > self.max_cached_size:
+            return None
+        self._uses += 1
+        try:
+            entry = self._cache[path]
+            entry[1] = self._uses
+            return entry[0]
+        except KeyError:
+            pass
+        try:
+            fh = open(path, 'rb')
+            try:
+                content = fh.read(meta.size)
+            finally:
+                fh.close()
+        except IOError:
+            return None
+        if len(content) != meta.size: # changed under us
+            return None
+        self._cache[path] = [content, self._uses]
+        self._cached_bytes += len(content)
+        while self._cached_bytes > self.max_cache_bytes:
+            lru = min([(e[1], p) for (p, e) in self._cache.items()])[1]
+            self._uncache(lru)
+        return content
+
+    def _uncache(self, path):
+        entry = self._cache.pop(path, None)
+        if entry:
+            self._cached_bytes -= len(entry[0])
+
+
+class _FileMeta:
+    "What we know about a file."
+    def __init__(self, path, st, checked, default_type):
+        self.mtime = int(st.st_mtime)
+        self.size = st.st_size
+        self.checked = checked
+        self.etag = '"%x-%x"' % (self.mtime, self.size)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.content_type = mimetypes.guess_type(path)[0] or default_type
+
+
+class _FileSender:
+    """
+    Send a response body made of parts, observing pause. Each part is
+    either a string or a (start, end) byte range of the file, which is
+    read from content if it's in memory.
+    """
+    def __init__(self, path, content, parts, res_start, status, phrase,
+                 res_hdrs, chunk_size):
+        self.path = path
+        self.content = content
+        self.parts = parts
+        self.chunk_size = chunk_size
+        self.fh = None
+        self.paused = False
+        self.res_body, self.res_done = res_start(
+            status, phrase, res_hdrs, self.pause
+        )
+        self.send()
+
+    def pause(self, paused):
+        self.paused = paused
+        if not paused:
+            self.send()
+
+    def send(self):
+        while not self.paused and self.parts:
+            part = self.parts[0]
+            if isinstance(part, str):
+                self.parts.pop(0)
+                self.res_body(part)
+                continue
+            start, end = part
+            if start >= end:
+                self.parts.pop(0)
+                continue
+            stop = min(end, start + self.chunk_size)
+            self.parts[0] = (stop, end)
+            if self.content is not None:
+                self.res_body(self.content[start:stop])
+                continue
+            try:
+                if self.fh is None:
+                    self.fh = open(self.path, 'rb')
+                self.fh.seek(start)
+                chunk = self.fh.read(stop - start)
+            except IOError:
+                chunk = ""
+            if len(chunk) != stop - start: # the file has shrunk.
+                self.finish({'desc': "File changed while being sent"})
+                return
+            self.res_body(chunk)
+        if not self.parts and self.res_done:
+            self.finish(None)
+
+    def finish(self, err):
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+        self.parts = []
+        res_done, self.res_done = self.res_done, None
+        if res_done:
+            res_done(err)
+
+
+def _error(res_start, status, phrase, res_hdrs=None):
+    "Send a short error response."
+    body = "%s %s" % (status, phrase)
+    hdrs = (res_hdrs or []) + [
+        ("Content-Type", "text/plain"),
+        ("Content-Length", str(len(body))),
+    ]
+    res_body, res_done = res_start(status, phrase, hdrs, dummy)
+    res_body(body)
+    res_done(None)
+
+def _parse_date(value):
+    "Parse an HTTP date into seconds since the epoch, or None."
+    try:
+        return mktime_tz(parsedate_tz(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def _parse_ranges(value, size):
+    """
+    Parse a Range header value into a list of (start, end) tuples (end
+    exclusive). Returns None if the header should be ignored, and an empty
+    list if none of the ranges can be satisfied.
+    """
+    try:
+        unit, specs = value.split("=", 1)
+    except ValueError:
+        return None
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        try:
+            first, last = spec.split("-", 1)
+            if first.strip() == "": # suffix range
+                length = int(last)
+                if length <= 0:
+                    continue
+                start, end = max(0, size - length), size
+            else:
+                start = int(first)
+                if last.strip() == "":
+                    end = size
+                elif int(last) < start:
+                    return None # syntactically invalid
+                else:
+                    end = min(size, int(last) + 1)
+        except ValueError:
+            return None
+        if start < size and end > start:
+            ranges.append((start, end))
+    return ranges
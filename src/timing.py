@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+Per-message timing records
+
+If a Server or Client has a timing_sink, each request it handles gets a
+TimingRecord, which is passed to timing_sink once the exchange is over;
+
+> def sink(record):
+>     print record.as_dict()
+> server = Server(host, port, handler)
+> server.timing_sink = sink
+
+A record's marks are timestamps for:
+  - conn: the connection was handed over by the pool (client only)
+  - req_headers: the request headers were parsed (server) or sent (client)
+  - res_headers: the response headers were received (client only)
+  - res_first_byte: the first response byte was sent or received
+  - res_last_byte: the last response byte was sent or received
+  - done: the exchange is over
+Records also count bytes_in and bytes_out, and note the status, any
+error, and whether the connection had been used before (conn_reused).
+
+While a Server's request_handler is running, its record is the current
+one, and records for Client requests started then are added to its
+children; for example, the record for a proxied request contains the
+record for its upstream leg, even if only the Server has a timing_sink.
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import time
+
+current = None # the record of the server request being dispatched, if any
+
+mark_names = ['conn', 'req_headers', 'res_headers', 'res_first_byte',
+              'res_last_byte', 'done']
+
+
+class TimingRecord:
+    "Timing for one HTTP request/response exchange."
+    def __init__(self, role, method, uri, parent=None, start=None):
+        self.role = role # 'server' or 'client'
+        self.method = method
+        self.uri = uri
+        self.start = start or time.time()
+        self.marks = {}
+        self.status = None
+        self.error = None
+        self.conn_reused = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.parent = parent
+        self.children = []
+        self.finished = False
+        if parent is not None:
+            parent.children.append(self)
+
+    def __repr__(self):
+        return "<TimingRecord %s %s %s %s>" % (self.role, self.method,
+            self.uri, self.elapsed('done'))
+
+    def mark(self, name, when=None):
+        "Note the time that name happened, unless it already has been."
+        if not self.marks.has_key(name):
+            self.marks[name] = when or time.time()
+
+    def elapsed(self, name):
+        "Return the seconds from the start until name, or None."
+        try:
+            return self.marks[name] - self.start
+        except KeyError:
+            return None
+
+    def finish(self, sink, error=None):
+        "The exchange is over; give the record to sink (if any)."
+        if self.finished:
+            return
+        self.finished = True
+        if error is not None:
+            self.error = error.get('desc', error)
+        self.mark('done')
+        if sink:
+            sink(self)
+
+    def as_dict(self):
+        "Return the record as a dictionary, with marks in milliseconds."
+        marks = {}
+        for name in mark_names:
+            elapsed = self.elapsed(name)
+            if elapsed is not None:
+                marks[name] = round(elapsed * 1000, 3)
+        return {
+            'role': self.role,
+            'method': self.method,
+            'uri': self.uri,
+            'start': self.start,
+            'status': self.status,
+            'error': self.error,
+            'conn_reused': self.conn_reused,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'marks_ms': marks,
+            'children': [c.as_dict() for c in self.children],
+        }
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+"""
+Upstream groups for the HTTP client
+
+An upstream group maps a logical authority (host and port) to a number
+of backend servers. Requests that Client makes to that authority are
+spread across the backends, instead of going to the host named in the URI;
+the Host header still carries the logical authority.
+
+> group = UpstreamGroup('app.internal', 80,
+>     [('10.0.0.1', 8080), ('10.0.0.2', 8080), ('10.0.0.3', 8080)],
+>     strategy='least_outstanding'
+> )
+> add_group(group)
+
+Available strategies are:
+  - round_robin: take backends in turn
+  - least_outstanding: choose the backend with the fewest requests in
+    progress
+  - p2c: choose two backends at random, and use the one with fewer
+    requests in progress ("power of two choices")
+
+Backends are ejected from the group after fail_threshold consecutive
+connection errors or timeouts. After eject_time seconds, one request is
+allowed through as a probe; if it succeeds, the backend is returned to the
+group, otherwise it's ejected again for twice as long (up to eject_time_max).
+
+If check_path is set on a group, each backend is also sent a GET request for
+it every check_interval seconds; responses with a 5xx status count as
+failures. Only the checks' responses count; their connections don't.
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import random
+
+import push_tcp
+from http_common import dummy
+
+# backend states
+HEALTHY, EJECTED, PROBING = 'healthy', 'ejected', 'probing'
+
+_groups = {}    # (host, port) -> UpstreamGroup
+
+def add_group(group):
+    "Start sending requests for group's authority to its backends."
+    remove_group(group.host, group.port)
+    _groups[(group.host, group.port)] = group
+    group.start_checks()
+
+def remove_group(host, port):
+    "Stop using the group for (host, port), if there is one."
+    group = _groups.pop((host, port), None)
+    if group:
+        group.stop_checks()
+
+def lookup(host, port):
+    "Return the UpstreamGroup for (host, port), or None."
+    return _groups.get((host, port), None)
+
+
+class UpstreamGroup:
+    "A logical authority served by a number of backends."
+    strategy = 'round_robin'
+    fail_threshold = 3
+    eject_time = 10
+    eject_time_max = 300
+    check_path = None
+    check_interval = 10
+
+    def __init__(self, host, port, addresses, strategy=None):
+        self.host = host
+        self.port = port
+        self.backends = [_Backend(self, h, p) for (h, p) in addresses]
+        if strategy is not None:
+            self.strategy = strategy
+        try:
+            self._choose = getattr(self, "_choose_%s" % self.strategy)
+        except AttributeError:
+            raise ValueError, "Unknown strategy %s" % self.strategy
+        self._next = 0
+        self._check_ev = None
+
+    def __repr__(self):
+        return "<UpstreamGroup %s:%s %s>" % (self.host, self.port,
+            ", ".join([repr(b) for b in self.backends]))
+
+    def select(self):
+        "Return the backend to send the next request to, or None."
+        now = push_tcp.now()
+        available = [b for b in self.backends if b.available(now)]
+        if not available:
+            return None
+        chosen = self._choose(available)
+        if chosen.state != HEALTHY: # time's up; let a probe through.
+            chosen.state = PROBING
+            chosen.ejected_until = now + self.eject_time
+        return chosen
+
+    def _choose_round_robin(self, available):
+        self._next += 1
+        return available[self._next % len(available)]
+
+    def _choose_least_outstanding(self, available):
+        self._next += 1
+        start = self._next % len(available)
+        ordered = available[start:] + available[:start]
+        return min([(b.outstanding, i, b) for (i, b)
+                    in enumerate(ordered)])[2]
+
+    def _choose_p2c(self, available):
+        if len(available) == 1:
+            return available[0]
+        a, b = random.sample(available, 2)
+        if b.outstanding < a.outstanding:
+            return b
+        return a
+
+    # active health checks
+
+    def start_checks(self):
+        "Start checking the backends, if check_path is set."
+        if self.check_path and not self._check_ev:
+            self._check_ev = push_tcp.schedule(self.check_interval,
+                                               self._check)
+
+    def stop_checks(self):
+        if self._check_ev:
+            self._check_ev.delete()
+            self._check_ev = None
+
+    def _check(self):
+        from client import Client # avoid a circular import
+        for b in self.backends:
+            def res_start(version, status, phrase, res_hdrs, res_pause,
+                          b=b):
+                def res_done(err):
+                    if status[:1] == "5":
+                        b.failure()
+                    else:
+                        b.success()
+                return dummy, res_done
+            c = Client(res_start)
+            c.retry_limit = 0
+            req_body, req_done = c.req_start("GET", "http://%s:%s%s" % (
+                b.host, b.port, self.check_path), [], dummy)
+            req_done(None)
+        self._check_ev = push_tcp.schedule(self.check_interval, self._check)
+
+
+class _Backend:
+    "A server in an UpstreamGroup, and its health."
+    def __init__(self, group, host, port):
+        self.group = group
+        self.host = host
+        self.port = port
+        self.state = HEALTHY
+        self.outstanding = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = None
+
+    def __repr__(self):
+        return "<%s:%s %s, %s outstanding>" % (
+            self.host, self.port, self.state, self.outstanding)
+
+    def available(self, now):
+        "Whether the backend can take a request."
+        if self.state == HEALTHY:
+            return True
+        # ejected, or probing (in which case, only one probe at a time
+        # unless it takes too long to find out).
+        return now >= self.ejected_until
+
+    def success(self):
+        "The backend has handled a request."
+        self.state = HEALTHY
+        self.failures = 0
+        self.ejections = 0
+
+    def failure(self):
+        "The backend has failed to connect or respond in time."
+        self.failures += 1
+        if self.state == PROBING or \
+        self.failures >= self.group.fail_threshold:
+            eject_for = min(self.group.eject_time_max,
+                            self.group.eject_time * (2 ** self.ejections))
+            self.state = EJECTED
+            self.ejections += 1
+            self.ejected_until = push_tcp.now() + eject_for
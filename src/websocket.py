@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+
+"""
+WebSockets for Server (RFC 6455)
+
+If websocket_handler is set on a Server, requests to upgrade to the
+WebSocket protocol go to it, instead of req_start. It must take the
+following arguments:
+  - uri (string)
+  - req_hdrs (list of (name, value) tuples)
+  - res_start (callable)
+  - accept (callable)
+
+To refuse the upgrade, send a response with res_start as usual. To accept
+it, call accept with:
+  - message_cb (callable)
+  - close_cb (callable)
+  - pause_cb (callable)
+  - protocol (string; the subprotocol chosen, if any)
+It sends the 101 (Switching Protocols) response, stops handling the
+connection as HTTP and returns a WebSocket. accept doesn't have to be called
+straight away, but nothing else can happen on the connection until it (or
+res_start) is.
+
+message_cb is called with each message as it's completed, with the
+arguments:
+  - data (string; text messages are checked to be UTF-8, and passed on
+    encoded)
+  - binary (boolean)
+
+close_cb is called once the connection is closed, with the arguments:
+  - code (int; 1006 if the connection closed without a close frame)
+  - reason (string)
+
+pause_cb is called with True when the connection's write buffer is full
+(so sending should stop for the time being), and with False when more can
+be sent. Calling pause on the WebSocket stops (True) and restarts (False)
+reading messages from the client, so that it's held up by TCP flow
+control.
+
+Pings are answered automatically. Fragmented messages are put back
+together; messages (or frames) bigger than max_message_size close the
+connection.
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import base64
+import logging
+import struct
+from binascii import hexlify, unhexlify
+from hashlib import sha1
+
+import push_tcp
+
+log = logging.getLogger('websocket')
+
+guid = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# opcodes
+CONTINUATION, TEXT, BINARY = 0x0, 0x1, 0x2
+CLOSE, PING, PONG = 0x8, 0x9, 0xA
+
+# close codes
+NORMAL, GOING_AWAY, PROTOCOL_ERROR, UNSUPPORTED = 1000, 1001, 1002, 1003
+NO_STATUS, ABNORMAL, INVALID_DATA, TOO_BIG = 1005, 1006, 1007, 1009
+
+_short = struct.Struct("!H")
+_long = struct.Struct("!Q")
+
+
+def accept_key(key):
+    "Return the Sec-WebSocket-Accept value for a Sec-WebSocket-Key."
+    return base64.b64encode(sha1(key.strip() + guid).digest())
+
+def unmask(data, mask):
+    """
+    XOR data with the four-byte mask, repeated; the whole of data is done
+    at once, as one (long) integer.
+    """
+    size = len(data)
+    if not size:
+        return data
+    key = mask * (size / 4 + 1)
+    value = int(hexlify(data), 16) ^ int(hexlify(key[:size]), 16)
+    return unhexlify("%0*x" % (size * 2, value))
+
+def frame(opcode, payload, fin=True):
+    "Return an (unmasked) frame."
+    size = len(payload)
+    first = chr((fin and 0x80 or 0) | opcode)
+    if size < 126:
+        return first + chr(size) + payload
+    elif size < 65536:
+        return first + chr(126) + _short.pack(size) + payload
+    return first + chr(127) + _long.pack(size) + payload
+
+
+class _ProtocolError(Exception):
+    "The client broke the protocol; close with code."
+    def __init__(self, code, detail):
+        Exception.__init__(self, detail)
+        self.code = code
+
+
+class WebSocket:
+    "A server WebSocket connection."
+    max_message_size = 1024 * 1024 * 16
+    close_timeout = 5
+
+    def __init__(self, tcp_conn, message_cb, close_cb, pause_cb):
+        self._tcp_conn = tcp_conn
+        self.message_cb = message_cb
+        self.close_cb = close_cb
+        self.pause_cb = pause_cb
+        self._chunks = []
+        self._buffered = 0
+        self._need = 2 # bytes buffered before there's anything to do
+        self._fragments = None # parts of a fragmented message
+        self._frag_opcode = None
+        self._frag_size = 0
+        self._paused = False
+        self._reading = False # in handle_input; don't start again
+        self._close_sent = False
+        self._close_ev = None
+        self._done = False
+        tcp_conn.read_cb = self.handle_input
+        tcp_conn.close_cb = self._conn_closed
+        tcp_conn.pause_cb = self._write_pause
+
+    def send(self, data, binary=False):
+        "Send a message; unicode is encoded as UTF-8."
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._write(frame(binary and BINARY or TEXT, data))
+
+    def ping(self, data=""):
+        "Send a ping; the client's pong is ignored."
+        self._write(frame(PING, data[:125]))
+
+    def pause(self, paused):
+        "Stop (True) or restart (False) reading messages from the client."
+        self._paused = paused
+        if self._tcp_conn:
+            self._tcp_conn.pause(paused)
+            if not paused:
+                self.handle_input("") # anything already read
+
+    def close(self, code=NORMAL, reason=""):
+        """
+        Start closing the connection; it's closed when the client answers,
+        or after close_timeout seconds.
+        """
+        if self._close_sent or not self._tcp_conn:
+            return
+        self._close_sent = True
+        self._write(frame(CLOSE, _short.pack(code) + reason[:123]))
+        self._close_ev = push_tcp.schedule(self.close_timeout, self._finish,
+                                           ABNORMAL, "close timed out")
+
+    def handle_input(self, data):
+        "Process data from the client."
+        if data:
+            self._chunks.append(data)
+            self._buffered += len(data)
+        if self._reading or self._buffered < self._need:
+            # if reading, e.g. when message_cb un-pauses, the loop below
+            # carries on.
+            return
+        self._reading = True
+        try:
+            self._read()
+        finally:
+            self._reading = False
+
+    def _read(self):
+        "Process the frames that have been buffered."
+        buf = "".join(self._chunks)
+        self._chunks = [] # taken; anything added while reading follows it.
+        end = len(buf)
+        pos = 0
+        try:
+            while self._tcp_conn:
+                if self._paused:
+                    self._need = 0
+                    break
+                if end - pos < 2:
+                    self._need = 2
+                    break
+                first, second = ord(buf[pos]), ord(buf[pos + 1])
+                size = second & 0x7F
+                head = 6 # including the mask
+                if size == 126:
+                    head = 8
+                    if end - pos >= 4:
+                        size = _short.unpack_from(buf, pos + 2)[0]
+                elif size == 127:
+                    head = 14
+                    if end - pos >= 10:
+                        size = _long.unpack_from(buf, pos + 2)[0]
+                if not second & 0x80:
+                    raise _ProtocolError(PROTOCOL_ERROR, "unmasked frame")
+                if size > self.max_message_size:
+                    raise _ProtocolError(TOO_BIG, "frame too big")
+                if end - pos < head + size:
+                    self._need = head + size
+                    break
+                payload = unmask(buf[pos + head:pos + head + size],
+                                 buf[pos + head - 4:pos + head])
+                pos += head + size
+                self._frame(first, payload)
+        except _ProtocolError, why:
+            log.info("%s closing: %s" % (id(self), why))
+            self._chunks = []
+            self._buffered = 0
+            self._fail(why.code, str(why))
+            return
+        rest = buf[pos:]
+        if rest:
+            self._chunks.insert(0, rest)
+        self._buffered = sum([len(c) for c in self._chunks])
+
+    def _frame(self, first, payload):
+        if first & 0x70:
+            raise _ProtocolError(PROTOCOL_ERROR, "reserved bits set")
+        fin = first & 0x80
+        opcode = first & 0x0F
+        if opcode & 0x8: # control frame
+            if not fin or len(payload) > 125:
+                raise _ProtocolError(PROTOCOL_ERROR, "bad control frame")
+            if opcode == PING:
+                if not self._close_sent:
+                    self._write(frame(PONG, payload))
+            elif opcode == CLOSE:
+                self._closed_by_client(payload)
+            elif opcode != PONG:
+                raise _ProtocolError(PROTOCOL_ERROR, "unknown opcode")
+            return
+        if opcode == CONTINUATION:
+            if self._fragments is None:
+                raise _ProtocolError(PROTOCOL_ERROR, "nothing to continue")
+            self._frag_size += len(payload)
+            if self._frag_size > self.max_message_size:
+                raise _ProtocolError(TOO_BIG, "message too big")
+            self._fragments.append(payload)
+            if not fin:
+                return
+            opcode = self._frag_opcode
+            payload = "".join(self._fragments)
+            self._fragments = self._frag_opcode = None
+            self._frag_size = 0
+        elif opcode not in [TEXT, BINARY]:
+            raise _ProtocolError(PROTOCOL_ERROR, "unknown opcode")
+        elif self._fragments is not None:
+            raise _ProtocolError(PROTOCOL_ERROR, "expected continuation")
+        elif not fin:
+            self._fragments = [payload]
+            self._frag_opcode = opcode
+            self._frag_size = len(payload)
+            return
+        if opcode == TEXT:
+            try:
+                payload.decode('utf-8')
+            except UnicodeDecodeError:
+                raise _ProtocolError(INVALID_DATA, "text isn't UTF-8")
+        if not self._close_sent:
+            self.message_cb(payload, opcode == BINARY)
+
+    def _closed_by_client(self, payload):
+        "The client has sent a close frame."
+        code, reason = NO_STATUS, ""
+        if len(payload) == 1:
+            raise _ProtocolError(PROTOCOL_ERROR, "bad close frame")
+        if payload:
+            code = _short.unpack_from(payload)[0]
+            reason = payload[2:]
+        if not self._close_sent:
+            self._close_sent = True
+            self._write(frame(CLOSE, payload[:2]))
+        self._finish(code, reason)
+
+    def _fail(self, code, reason):
+        "Close the connection because of a problem."
+        if not self._close_sent:
+            self._close_sent = True
+            self._write(frame(CLOSE, _short.pack(code)))
+        self._finish(code, reason)
+
+    def _finish(self, code, reason):
+        if self._close_ev:
+            self._close_ev.delete()
+            self._close_ev = None
+        if self._tcp_conn:
+            tcp_conn, self._tcp_conn = self._tcp_conn, None
+            tcp_conn.close()
+        if not self._done:
+            self._done = True
+            self.close_cb(code, reason)
+
+    def _write(self, data):
+        if self._tcp_conn:
+            self._tcp_conn.write(data)
+
+    # Methods called by push_tcp
+
+    def _write_pause(self, paused):
+        if not self._close_sent:
+            self.pause_cb(paused)
+
+    def _conn_closed(self):
+        "The client has closed the connection."
+        self._tcp_conn = None
+        self._finish(ABNORMAL, "")
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+
+"""
+WSGI gateway for Server
+
+WsgiGateway is a Server request_handler that runs a WSGI (PEP 333)
+application;
+
+> server = Server(host, port, WsgiGateway(app))
+
+The request body is collected before the application is called, so that
+reading wsgi.input never blocks; bodies up to spool_threshold bytes are
+kept in memory, and larger ones are written to a temporary file.
+
+By default, the application is run in the loop's thread, so (like any
+other request_handler) it must not block. With threads set, it's run on
+a pool of that many threads instead, and up to max_queue requests wait for
+a free one; past that, requests get a 503 (Service Unavailable) response.
+
+Response bodies (from the returned iterable or the write callable) are
+sent as they're produced. When the connection's write buffer is full, the
+iterable isn't advanced until it drains; on a thread, write blocks for up
+to pause_timeout seconds too (in the loop's thread, write can't wait, so
+what's written is buffered). If the application doesn't say how long the
+body is and returns a single string in a list or tuple, Content-Length is
+added.
+"""
+
+__author__ = "Mark Nottingham <mnot@mnot.net>"
+__copyright__ = """\
+Copyright (c) 2008-2010 Mark Nottingham
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import logging
+import sys
+import tempfile
+import threading
+import urllib
+from cStringIO import StringIO
+from Queue import Queue, Full
+from urlparse import urlsplit
+
+import push_tcp
+from http_common import dummy
+
+log = logging.getLogger('wsgi')
+
+ERR_APP = {
+    'desc': "WSGI application error",
+}
+
+
+class WsgiGateway:
+    "A request_handler that runs a WSGI application."
+    threads = 0
+    max_queue = 100
+    spool_threshold = 1024 * 256
+    pause_timeout = 60
+    url_scheme = "http"
+    script_name = ""
+
+    def __init__(self, app, threads=None, server_name="localhost",
+                 server_port=80):
+        self.app = app
+        if threads is not None:
+            self.threads = threads
+        self.server_name = server_name
+        self.server_port = str(server_port)
+        self._workers = None
+        if self.threads:
+            self._workers = _Workers(self.threads, self.max_queue)
+
+    def __call__(self, method, uri, req_hdrs, res_start, req_pause):
+        request = _WsgiRequest(self, method, uri, req_hdrs, res_start)
+        return request.req_body, request.req_done
+
+    def environ(self, method, uri, req_hdrs, protocol="HTTP/1.1"):
+        """
+        Return the WSGI environ for a request (without wsgi.input);
+        protocol is the request's SERVER_PROTOCOL.
+        """
+        if uri[:1] != "/": # absolute-form
+            uri = urlsplit(uri)
+            path, query = uri.path or "/", uri.query
+        else:
+            path, query = (uri.split("?", 1) + [""])[:2]
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': self.script_name,
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server_name,
+            'SERVER_PORT': self.server_port,
+            'SERVER_PROTOCOL': protocol,
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': self.url_scheme,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': bool(self.threads),
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in req_hdrs:
+            key = name.strip().upper().replace("-", "_")
+            if key in ['CONTENT_TYPE', 'CONTENT_LENGTH']:
+                environ[key] = value.strip()
+                continue
+            key = "HTTP_" + key
+            if environ.has_key(key):
+                environ[key] += "," + value.strip()
+            else:
+                environ[key] = value.strip()
+        return environ
+
+
+class _WsgiRequest:
+    "A request being handled by a WSGI application."
+    def __init__(self, gateway, method, uri, req_hdrs, res_start):
+        self.gateway = gateway
+        self.method = method
+        self.environ = gateway.environ(method, uri, req_hdrs,
+                                       _protocol(res_start))
+        self.res_start = res_start
+        self.res_body = None
+        self.res_done = None
+        self._body = StringIO()
+        self._body_len = 0
+        self._spooled = False
+        self._status = None
+        self._res_hdrs = None
+        self._body_started = False # in the application's thread
+        self._result = None
+        self._iter = None
+        self._paused = False
+        self._unpaused = threading.Event()
+        self._unpaused.set()
+        if gateway.threads:
+            self._call = push_tcp.call_from_thread
+        else:
+            self._call = _call_now
+
+    # Methods called in the loop's thread
+
+    def req_body(self, chunk):
+        self._body.write(chunk)
+        self._body_len += len(chunk)
+        if self._body_len > self.gateway.spool_threshold \
+        and not self._spooled:
+            spool = tempfile.TemporaryFile()
+            spool.write(self._body.getvalue())
+            self._body = spool
+            self._spooled = True
+
+    def req_done(self, err):
+        if err:
+            return
+        self._body.seek(0)
+        self.environ['wsgi.input'] = self._body
+        if self.gateway._workers is None:
+            if self._start_app():
+                self._pump()
+        elif not self.gateway._workers.submit(self._run):
+            self._send_error("503", "Service Unavailable")
+
+    def _pause(self, paused):
+        self._paused = paused
+        if paused:
+            self._unpaused.clear()
+        else:
+            self._unpaused.set()
+            if self._iter is not None and self.gateway._workers is None:
+                self._pump()
+
+    def _pump(self):
+        "Send from the application's iterable until it's done or paused."
+        while not self._paused:
+            try:
+                chunk = self._iter.next()
+            except StopIteration:
+                self._end(None)
+                return
+            except:
+                self._app_error()
+                self._end(ERR_APP)
+                return
+            if chunk:
+                self.write(chunk)
+
+    def _send(self, chunk):
+        if self.res_done is None:
+            self._start()
+        self.res_body(chunk)
+
+    def _start(self):
+        code, phrase = (self._status.split(None, 1) + [""])[:2]
+        self.res_body, self.res_done = self.res_start(code, phrase,
+            self._res_hdrs, self._pause)
+
+    def _finish(self, err):
+        if self.res_done is None:
+            if self._status is None:
+                self._send_error("500", "Internal Server Error")
+                return
+            if self.method != "HEAD" and not self._length_known():
+                self._res_hdrs.append(("Content-Length", "0"))
+            self._start()
+        self.res_done(err)
+
+    def _send_error(self, status, phrase):
+        body = "%s %s" % (status, phrase)
+        res_body, res_done = self.res_start(status, phrase, [
+            ("Content-Type", "text/plain"),
+            ("Content-Length", str(len(body))),
+        ], dummy)
+        res_body(body)
+        res_done(None)
+
+    # Methods called in the application's thread
+
+    def start_response(self, status, res_hdrs, exc_info=None):
+        if exc_info:
+            try:
+                if self._body_started:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                exc_info = None
+        elif self._status is not None:
+            raise AssertionError, "start_response already called"
+        self._status = status
+        self._res_hdrs = list(res_hdrs)
+        return self.write
+
+    def write(self, chunk):
+        if self._status is None:
+            raise AssertionError, "write before start_response"
+        self._body_started = True
+        self._call(self._send, chunk)
+        if self._call is not _call_now and \
+        not self._unpaused.wait(self.gateway.pause_timeout):
+            raise IOError, "client isn't reading the response"
+
+    def _start_app(self):
+        "Call the application; return True if it returned an iterable."
+        try:
+            self._result = self.gateway.app(self.environ,
+                                            self.start_response)
+            if isinstance(self._result, (list, tuple)) \
+            and len(self._result) == 1 and self._status is not None \
+            and not self._length_known():
+                self._res_hdrs.append(
+                    ("Content-Length", str(len(self._result[0]))))
+            self._iter = iter(self._result)
+            return True
+        except:
+            self._app_error()
+            self._end(ERR_APP)
+            return False
+
+    def _run(self):
+        "Run the application on a worker thread."
+        if not self._start_app():
+            return
+        try:
+            for chunk in self._iter:
+                if chunk:
+                    self.write(chunk)
+        except:
+            self._app_error()
+            self._end(ERR_APP)
+            return
+        self._end(None)
+
+    def _end(self, err):
+        "The application is done; close its iterable and finish."
+        self._iter = None
+        if hasattr(self._result, 'close'):
+            try:
+                self._result.close()
+            except:
+                self._app_error()
+                err = ERR_APP
+        self._result = None
+        if err and not self._body_started:
+            self._status = None # send a 500 instead
+            err = None
+        self._call(self._finish, err)
+
+    def _app_error(self):
+        log.error("Error in WSGI application", exc_info=True)
+
+    def _length_known(self):
+        return 'content-length' in [n.lower() for (n, v) in self._res_hdrs]
+
+
+class _Workers:
+    "A pool of threads, taking jobs from a bounded queue."
+    def __init__(self, num, max_queue):
+        self.queue = Queue(max_queue)
+        self.threads = []
+        for i in range(num):
+            thread = threading.Thread(target=self._work, name="wsgi-%s" % i)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, job):
+        "Queue job to be run; return False if the queue is full."
+        try:
+            self.queue.put_nowait(job)
+        except Full:
+            return False
+        return True
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job()
+            except:
+                log.error("Error in WSGI worker", exc_info=True)
+
+
+def _protocol(res_start):
+    "Return the protocol of the request that res_start answers."
+    # res_start is a method of the connection (or HTTP/2 stream).
+    version = getattr(getattr(res_start, 'im_self', None), 'req_version',
+                      None)
+    if version is None:
+        return "HTTP/1.1"
+    if version >= 2:
+        return "HTTP/2"
+    return "HTTP/%s" % version
+
+def _call_now(callback, *args):
+    callback(*args)